@@ -2,11 +2,30 @@
 Flask API server for local LLM
 Wraps the LLMEngine to provide HTTP endpoints
 """
+import dataclasses
 import logging
-from flask import Flask, request, jsonify
+import os
+import threading
+import time
+from typing import Optional
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from werkzeug.serving import make_server
 
-from src.llm.engine import LLMEngine
+from src.api.openai import (
+    choices_payload, chunk_payload, completion_payload, embeddings_payload, models_payload, new_completion_id,
+    parse_embedding_input, parse_messages, parse_n, sse, usage_payload
+)
+from src.llm import metrics
+from src.llm.batch import BatchManager, batch_path, default_output_path
+from src.llm.constrained import GrammarError, response_format_regex
+from src.llm.context import ContextOverflow
+from src.llm.embeddings import decode_vector
+from src.llm.engine import LLMEngine, create_engine
+from src.llm.registry import ModelRegistry, UnknownModel
+from src.llm.reload import EngineReloader, admin_authorized
+from src.llm.response_cache import CachedResponse, ResponseCache
+from src.llm.tracing import Trace, TraceStore, span, trace_requested
 from src.config import Config
 
 # Setup logging
@@ -20,28 +39,242 @@ log = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)  # Allow cross-origin requests
 
-# Global engine instance
+# Global engine instance (the default model) and the registry of every loaded model
 engine = None
 config = None
+registry: Optional[ModelRegistry] = None
+# The engine being loaded at startup, so /health can report its progress
+loading: Optional[LLMEngine] = None
+# True when the engine is shared with the GUI (start_both.py), which owns its lifecycle
+shared = False
+
+# Set once the engine is loaded and the server socket is listening (or startup failed)
+ready = threading.Event()
+startup_error: Optional[BaseException] = None
 
-def initialize_engine():
-    """Load the LLM model"""
-    global engine, config
+HOST = '0.0.0.0'
+PORT = 5000
+
+def initialize_engine(shared_engine: Optional[LLMEngine] = None):
+    """Load the LLM model, or adopt an engine shared with another front-end"""
+    global shared, loading
     log.info("🤖 Initializing LLM Engine...")
-    config = Config()
-    engine = LLMEngine(config)
-    engine.load()
+    shared = shared_engine is not None
+    loading = shared_engine or create_engine(Config())
+    if loading.model is None:
+        loading.load()
+    set_engine(loading)
     log.info("✅ LLM Engine ready!")
 
+def set_engine(new_engine: LLMEngine, unload_old: bool = False) -> threading.Event:
+    """
+    Point the API at another (already loaded) engine as its default model.
+    With `unload_old`, the previous engine is unloaded once its in-flight requests
+    finish (the returned event is set then); otherwise its owner (e.g. the GUI) unloads it.
+    """
+    global engine, config, registry
+    if registry is None:
+        registry = ModelRegistry.from_config(new_engine.cfg)
+    drained = registry.swap(engine, new_engine, unload_old=unload_old)
+    engine, config = new_engine, new_engine.cfg
+    return drained
+
+reloader = EngineReloader(lambda new: set_engine(new, unload_old=True))
+batches = BatchManager()
+traces = TraceStore()
+
+def finish_trace(trace: Optional[Trace], started: float) -> None:
+    """Close a traced request's top-level span and keep the trace (GET /debug/traces/<id>, TRACE_DIR)"""
+    if trace is None:
+        return
+    trace.complete("request", started, time.perf_counter())
+    path = traces.add(trace, config.trace_dir if config else "")
+    log.info(f"🔬 Trace {trace.id}" + (f" written to {path}" if path else ""))
+
+def sse_events(chunks, completion_id: str, created: int, model: str, include_usage: bool = False,
+               cache: Optional[ResponseCache] = None, cache_key: Optional[str] = None,
+               trace: Optional[Trace] = None, started: float = 0.0):
+    """
+    Wrap a text stream as OpenAI-style chat.completion.chunk SSE events.
+    With `cache`, the full response is memoized under `cache_key` once the stream completes.
+    If the client disconnects, the generation is cancelled.
+    """
+    try:
+        yield sse(chunk_payload(completion_id, created, model, {"role": "assistant"}))
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield sse(chunk_payload(completion_id, created, model, {"content": chunk}))
+        if cache is not None:
+            cache.put(cache_key, CachedResponse("".join(parts), chunks.finish_reason, chunks.usage))
+        yield sse(chunk_payload(completion_id, created, model, {}, finish_reason=chunks.finish_reason or "stop"))
+        if include_usage:
+            yield sse(usage_payload(completion_id, created, model, chunks.usage))
+    except Exception as e:
+        log.error(f"❌ Streaming error: {e}", exc_info=True)
+        yield sse({"error": str(e)})
+    finally:
+        chunks.close()  # client disconnects close this generator; stop generating too
+        finish_trace(trace, started)
+    yield sse("[DONE]")
+
+def choice_sse_events(choices, completion_id: str, created: int, model: str, include_usage: bool = False,
+                      trace: Optional[Trace] = None, started: float = 0.0):
+    """Like sse_events, for n > 1 choices: each chunk is tagged with its choice's index as it is generated"""
+    try:
+        for index in range(choices.n):
+            yield sse(chunk_payload(completion_id, created, model, {"role": "assistant"}, index=index))
+        for index, chunk in choices:
+            yield sse(chunk_payload(completion_id, created, model, {"content": chunk}, index=index))
+        for index, finish_reason in enumerate(choices.finish_reasons):
+            yield sse(chunk_payload(completion_id, created, model, {}, finish_reason=finish_reason or "stop", index=index))
+        if include_usage:
+            yield sse(usage_payload(completion_id, created, model, choices.usage))
+    except Exception as e:
+        log.error(f"❌ Streaming error: {e}", exc_info=True)
+        yield sse({"error": str(e)})
+    finally:
+        choices.close()
+        finish_trace(trace, started)
+    yield sse("[DONE]")
+
+@app.after_request
+def add_trace_header(response):
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers['X-Trace-Id'] = trace.id
+    return response
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    stats = engine.stats() if engine else {}  # once: with replicas each call asks every worker
     return jsonify({
         "status": "ok",
         "model": config.model_id if config else "not loaded",
-        "ready": engine is not None
+        "ready": engine is not None,
+        "load": (engine or loading).progress.stats() if (engine or loading) else None,
+        "prefix_cache": engine.prefix_cache.stats() if engine else None,
+        "response_cache": engine.response_cache.stats() if engine else None,
+        "embedding_cache": engine.embedding_cache.stats() if engine else None,
+        "speculative": stats.get("speculative"),
+        "context": stats.get("context"),
+        "grammars": stats.get("grammars"),
+        "replicas": stats.get("replicas"),
+        "models": registry.stats() if registry else None,
+        "reload": reloader.status(),
     })
 
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """
+    Swap the default model without downtime:
+    {"model": "optional; defaults to the current MODEL_ID", "precision": "optional"}
+    The new engine loads in the background while the current one keeps serving;
+    new requests then go to it and the old engine is freed once its in-flight
+    generations finish. Progress is reported under "reload" in /health.
+    It is refused unless ADMIN_TOKEN is set, and the model must be one the
+    registry serves (the current MODEL_ID or one in SERVED_MODELS).
+    """
+    if engine is None:
+        return jsonify({"error": "Model is still loading"}), 503
+    if not config.admin_token:
+        return jsonify({"error": "Reloading is disabled; set ADMIN_TOKEN to enable it"}), 403
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token):
+        return jsonify({"error": "Unauthorized"}), 401
+    if shared:
+        return jsonify({"error": "The model is managed by the GUI; change it in Settings"}), 409
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    model_id = data.get('model') or config.model_id
+    if not registry.is_allowed(model_id):
+        return jsonify({"error": f"Model '{model_id}' is not served here"}), 404
+    new_cfg = dataclasses.replace(
+        config,
+        model_id=model_id,
+        precision=data.get('precision') or config.precision,
+    )
+    if not reloader.start(new_cfg):
+        return jsonify({"error": "A reload is already in progress", "reload": reloader.status()}), 409
+    log.info(f"🔁 Reloading: {new_cfg.model_id} (precision={new_cfg.precision})")
+    return jsonify({"reload": reloader.status()}), 202
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """
+    Start an offline batch job over a JSONL file on the server's disk:
+    {"input_file": "requests.jsonl", "output_file": "optional; default <input>.output.jsonl",
+     "model": "optional", "batch_size": optional}
+    Requests are run in padded, length-sorted batches and results appended
+    to the output file as they finish. Starting a job again with the same
+    files resumes it. As it reads and writes files, it is refused unless
+    ADMIN_TOKEN is set, and both paths must be inside BATCH_DIR.
+    """
+    if engine is None:
+        return jsonify({"error": "Model is still loading"}), 503, {"Retry-After": "1"}
+    if not config.admin_token:
+        return jsonify({"error": "Batch jobs are disabled; set ADMIN_TOKEN to enable them"}), 403
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token):
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    try:
+        input_file = batch_path(config.batch_dir, data.get('input_file') or "")
+        output_file = batch_path(config.batch_dir, data.get('output_file') or default_output_path(input_file))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not os.path.isfile(input_file):
+        return jsonify({"error": f"input_file not found: {data.get('input_file')}"}), 400
+    try:
+        lease = registry.acquire(data.get('model'))
+    except UnknownModel as e:
+        return jsonify({"error": str(e)}), 404
+    try:
+        job = batches.start(
+            lease.engine,
+            input_file,
+            output_file,
+            batch_size=int(data.get('batch_size') or lease.engine.cfg.batch_job_size),
+            on_done=lease.release,  # keeps the model resident until the job ends
+        )
+    except ValueError as e:
+        lease.release()
+        return jsonify({"error": str(e)}), 409
+    return jsonify(job.status())
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    return jsonify({"object": "list", "data": batches.list()})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    job = batches.get(batch_id)
+    if job is None:
+        return jsonify({"error": f"No batch {batch_id}"}), 404
+    return jsonify(job.status())
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """Stop a batch after its current bucket; rerun it later to resume"""
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token if config else ""):
+        return jsonify({"error": "Unauthorized"}), 401
+    job = batches.get(batch_id)
+    if job is None:
+        return jsonify({"error": f"No batch {batch_id}"}), 404
+    job.cancel()
+    return jsonify(job.status())
+
+@app.route('/v1/models', methods=['GET'])
+def list_models():
+    """OpenAI-compatible model list: every servable model and whether it is resident"""
+    return jsonify(models_payload(registry))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    body = metrics.render(engine.metrics_gauges() if engine else None)
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """
@@ -53,89 +286,258 @@ def chat_completions():
             {"role": "user", "content": "..."}
         ],
         "temperature": 0.7,
-        "max_tokens": 500
+        "max_tokens": 500,
+        "stream": false,
+        "stream_options": {"include_usage": false},
+        "model": "optional; any id from /v1/models, loaded on demand",
+        "conversation_id": "optional; reuses the KV cache from earlier turns",
+        "ignore_eos": false,
+        "n": 1,
+        "response_format": {"type": "json_schema", "json_schema": {"schema": {...}}}
     }
+    With "stream": true the reply is sent as Server-Sent Events carrying
+    chat.completion.chunk objects, terminated by "data: [DONE]".
+    Requests with "temperature": 0 are answered from the response cache
+    when an identical request has completed before. With "n" > 1 the prompt
+    is prefilled once and n choices are sampled together; streamed chunks
+    carry their choice's index.
+    "response_format" constrains the reply: {"type": "json_object"}, a JSON
+    schema as above, or {"type": "regex", "regex": "..."}.
+    Send "X-Trace: 1" (or "profile") to trace the request; the trace id comes
+    back in X-Trace-Id and the trace from GET /debug/traces/<id>.
     """
+    if engine is None:
+        return jsonify({"error": "Model is still loading"}), 503, {"Retry-After": "1"}
+    started = time.perf_counter()
+    g.trace = trace = trace_requested(request.headers.get('X-Trace'), config.trace, config.trace_profile_interval_ms)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    try:
+        with span(trace, "acquire_model"):
+            lease = registry.acquire(data.get('model'))
+    except UnknownModel as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        log.error(f"❌ Error: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+    streaming = False
     try:
-        data = request.json
+        llm = lease.engine
+        cfg = llm.cfg
         messages = data.get('messages', [])
-        temperature = data.get('temperature', config.temperature)
-        max_tokens = data.get('max_tokens', config.max_new_tokens)
-        
-        # Extract system prompt and user message
-        system_prompt = config.chat_system_prompt
-        history = []
-        user_msg = ""
+        temperature = data.get('temperature', cfg.temperature)
+        max_tokens = data.get('max_tokens', cfg.max_new_tokens)
         
-        for msg in messages:
-            role = msg.get('role')
-            content = msg.get('content', '')
-            
-            if role == 'system':
-                system_prompt = content
-            elif role == 'user':
-                user_msg = content
-            elif role == 'assistant':
-                # Add to history if there was a previous user message
-                if user_msg:
-                    history.append((user_msg, content))
-                    user_msg = ""
+        try:
+            system_prompt, history, user_msg = parse_messages(messages, cfg.chat_system_prompt)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         if not user_msg:
             return jsonify({"error": "No user message provided"}), 400
         
-        # Generate response (non-streaming for simplicity)
-        log.info(f"💬 Generating response for: {user_msg[:50]}...")
-        response_text = ""
-        for chunk in engine.generate_stream(
-            system_prompt=system_prompt,
-            history=history,
-            user_msg=user_msg,
-            max_new_tokens=max_tokens,
-            temperature=temperature
-        ):
-            response_text += chunk
+        ignore_eos = bool(data.get('ignore_eos', False))
+        grammar = response_format_regex(data.get('response_format'))
+        if grammar:
+            llm.check_grammar(grammar)  # a 400 before anything is queued if it cannot constrain decoding
+        try:
+            n = parse_n(data.get('n'), cfg.max_batch_size)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if n > 1:
+            log.info(f"💬 Generating {n} choices for: {user_msg[:50]}...")
+            choices = llm.generate_choices(
+                system_prompt=system_prompt,
+                history=history,
+                user_msg=user_msg,
+                n=n,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                conversation_id=data.get('conversation_id'),
+                ignore_eos=ignore_eos,
+                trace=trace,
+                grammar=grammar,
+            ).start()  # queued now, so a prompt that does not fit is a 400 even when streaming
+            completion_id, created = new_completion_id()
+            if data.get('stream'):
+                response = Response(
+                    stream_with_context(choice_sse_events(
+                        choices, completion_id, created, cfg.model_id,
+                        include_usage=bool((data.get('stream_options') or {}).get('include_usage')),
+                        trace=trace,
+                        started=started,
+                    )),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
+                response.call_on_close(lease.release)
+                streaming = True
+                return response
+            parts = [[] for _ in range(n)]
+            for index, chunk in choices:
+                parts[index].append(chunk)
+            texts = ["".join(p) for p in parts]
+            log.info(f"✅ {n} choices generated ({sum(map(len, texts))} chars)")
+            with span(trace, "serialize"):
+                return jsonify(choices_payload(
+                    completion_id, created, cfg.model_id, texts, choices.finish_reasons, choices.usage
+                ))
+
+        with span(trace, "response_cache_lookup"):
+            cache_key = llm.response_cache_key(
+                system_prompt, history, user_msg, max_tokens, temperature, ignore_eos, grammar=grammar
+            )
+            chunks = llm.response_cache.get(cache_key) if cache_key else None
+        if chunks is not None:
+            log.info(f"⚡ Cached response for: {user_msg[:50]}...")
+            cache_key = None  # already stored
+        else:
+            log.info(f"💬 Generating response for: {user_msg[:50]}...")
+            chunks = llm.generate_stream(
+                system_prompt=system_prompt,
+                history=history,
+                user_msg=user_msg,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                conversation_id=data.get('conversation_id'),
+                ignore_eos=ignore_eos,
+                trace=trace,
+                grammar=grammar,
+            ).start()
+        completion_id, created = new_completion_id()
+        
+        if data.get('stream'):
+            response = Response(
+                stream_with_context(sse_events(
+                    chunks, completion_id, created, cfg.model_id,
+                    include_usage=bool((data.get('stream_options') or {}).get('include_usage')),
+                    cache=llm.response_cache if cache_key else None,
+                    cache_key=cache_key,
+                    trace=trace,
+                    started=started,
+                )),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+            response.call_on_close(lease.release)  # keeps the model resident until the stream ends
+            streaming = True
+            return response
         
+        response_text = "".join(chunks)
+        if cache_key:
+            llm.response_cache.put(cache_key, CachedResponse(response_text, chunks.finish_reason, chunks.usage))
         log.info(f"✅ Response generated ({len(response_text)} chars)")
         
         # Return OpenAI-compatible format
-        return jsonify({
-            "choices": [{
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                },
-                "finish_reason": "stop"
-            }],
-            "model": config.model_id,
-            "usage": {
-                "prompt_tokens": 0,  # Not calculated
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
-        })
+        with span(trace, "serialize"):
+            return jsonify(completion_payload(
+                completion_id, created, cfg.model_id, response_text, chunks.finish_reason, chunks.usage
+            ))
         
+    except (ContextOverflow, GrammarError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.error(f"❌ Error: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if not streaming:
+            lease.release()
+            finish_trace(trace, started)
+
+@app.route('/debug/traces', methods=['GET'])
+def list_traces():
+    """Ids of the most recent traced requests (oldest first)"""
+    return jsonify({"traces": traces.ids()})
+
+@app.route('/debug/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """A traced request as Chrome trace-event JSON: save it and open it in ui.perfetto.dev"""
+    trace = traces.get(trace_id)
+    if trace is None:
+        return jsonify({"error": f"No trace {trace_id}"}), 404
+    return jsonify(trace.to_chrome())
+
+@app.route('/v1/embeddings', methods=['POST'])
+def embeddings():
+    """
+    OpenAI-compatible embeddings endpoint
+    Request format:
+    {
+        "input": "text" or ["text", ...],
+        "model": "optional; any id from /v1/models",
+        "encoding_format": "float" or "base64",
+        "pooling": "optional; mean or last (default: EMBEDDING_POOLING)"
+    }
+    Vectors are the model's final hidden states, pooled and L2-normalized.
+    Texts embedded before are answered from the embedding cache.
+    """
+    if engine is None:
+        return jsonify({"error": "Model is still loading"}), 503, {"Retry-After": "1"}
+    data = request.get_json(silent=True) or {}
+    encoding_format = data.get('encoding_format') or "float"
+    try:
+        texts = parse_embedding_input(data.get('input'))
+        if encoding_format not in ("float", "base64"):
+            raise ValueError(f"Unsupported encoding_format '{encoding_format}'")
+        lease = registry.acquire(data.get('model'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnknownModel as e:
+        return jsonify({"error": str(e)}), 404
+
+    try:
+        vectors, prompt_tokens = lease.engine.embed(texts, data.get('pooling'))
+        return jsonify(embeddings_payload(
+            lease.engine.cfg.model_id, [decode_vector(v, encoding_format) for v in vectors], prompt_tokens
+        ))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         log.error(f"❌ Error: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
+    finally:
+        lease.release()
 
-def main():
+def _load_in_background(server, shared_engine: Optional[LLMEngine]):
+    """Load the model while the server already answers /health (503 for completions until ready)"""
+    global startup_error
+    try:
+        initialize_engine(shared_engine)
+    except BaseException as e:
+        log.error(f"❌ Failed to load model: {e}", exc_info=True)
+        startup_error = e
+        server.shutdown()
+    finally:
+        ready.set()
+
+def main(shared_engine: Optional[LLMEngine] = None):
     """Run the Flask API server"""
+    global startup_error
     print("\n" + "="*60)
     print("🚀 Starting Local LLM API Server")
     print("="*60)
     
-    initialize_engine()
+    try:
+        server = make_server(HOST, PORT, app, threaded=True)
+    except BaseException as e:
+        startup_error = e
+        ready.set()
+        raise
     
     print("\n" + "="*60)
     print("✅ Server Running!")
     print("="*60)
-    print(f"📍 URL: http://localhost:5000")
-    print(f"🤖 Model: {config.model_id}")
-    print(f"🔍 Health check: http://localhost:5000/health")
+    print(f"📍 URL: http://localhost:{PORT}")
+    print(f"🤖 Model: {(shared_engine.cfg if shared_engine else Config()).model_id} (loading in the background)")
+    print(f"🔍 Health check: http://localhost:{PORT}/health")
     print("\nPress Ctrl+C to stop\n")
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    threading.Thread(target=_load_in_background, args=(server, shared_engine), name="engine-load", daemon=True).start()
+    server.serve_forever()
+    if startup_error is not None:
+        raise startup_error
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
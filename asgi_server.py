@@ -0,0 +1,578 @@
+"""
+ASGI API server for local LLM
+Same endpoints as api_server.py, served from an event loop instead of a
+thread per request. Generation results are awaited over an async channel,
+concurrent generations and queue depth are capped (429/503 + Retry-After
+when saturated), and every request has a timeout.
+
+Run with: python asgi_server.py
+"""
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import math
+import os
+import time
+from typing import Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from src.api.openai import (
+    choices_payload, chunk_payload, completion_payload, embeddings_payload, models_payload, new_completion_id,
+    parse_embedding_input, parse_messages, parse_n, sse, usage_payload
+)
+from src.config import Config
+from src.llm import metrics
+from src.llm.admission import AdmissionController, Saturated
+from src.llm.batch import BatchManager, batch_path, default_output_path
+from src.llm.constrained import GrammarError, response_format_regex
+from src.llm.context import ContextOverflow
+from src.llm.embeddings import decode_vector
+from src.llm.engine import LLMEngine, create_engine
+from src.llm.registry import ModelRegistry, UnknownModel
+from src.llm.reload import EngineReloader, admin_authorized
+from src.llm.response_cache import CachedResponse, ResponseCache
+from src.llm.tracing import Trace, TraceStore, span, trace_requested
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+HOST = '0.0.0.0'
+PORT = 5000
+
+config = Config()
+engine: Optional[LLMEngine] = None  # the default model, loaded at startup
+loading: Optional[LLMEngine] = None  # set while the startup load runs, for /health progress
+registry = ModelRegistry.from_config(config)
+admission = AdmissionController(config.max_concurrent_generations, config.max_queue_depth, config.retry_after_s)
+batches = BatchManager()
+traces = TraceStore()
+
+
+def _error(message: str, status: int, retry_after: Optional[float] = None) -> JSONResponse:
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after is not None else None
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+
+async def health(request: Request):
+    """Health check endpoint"""
+    # Once, off the event loop: with replicas each call asks every worker
+    stats = await asyncio.to_thread(engine.stats) if engine else {}
+    return JSONResponse({
+        "status": "ok",
+        "model": config.model_id,
+        "ready": engine is not None,
+        "load": (engine or loading).progress.stats() if (engine or loading) else None,
+        "admission": admission.stats(),
+        "prefix_cache": engine.prefix_cache.stats() if engine else None,
+        "response_cache": engine.response_cache.stats() if engine else None,
+        "embedding_cache": engine.embedding_cache.stats() if engine else None,
+        "speculative": stats.get("speculative"),
+        "context": stats.get("context"),
+        "grammars": stats.get("grammars"),
+        "replicas": stats.get("replicas"),
+        "models": registry.stats(),
+        "reload": reloader.status(),
+    })
+
+
+async def admin_reload(request: Request):
+    """Swap the default model without downtime (see api_server.admin_reload)"""
+    if engine is None:
+        return _error("Model is still loading", 503, config.retry_after_s)
+    if not config.admin_token:
+        return _error("Reloading is disabled; set ADMIN_TOKEN to enable it", 403)
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token):
+        return _error("Unauthorized", 401)
+    try:
+        data = await request.json() or {}
+    except ValueError:
+        data = {}  # no body: reload the current model and precision
+    if not isinstance(data, dict):
+        return _error("Request body must be a JSON object", 400)
+    model_id = data.get('model') or config.model_id
+    if not registry.is_allowed(model_id):
+        return _error(f"Model '{model_id}' is not served here", 404)
+    new_cfg = dataclasses.replace(
+        config,
+        model_id=model_id,
+        precision=data.get('precision') or config.precision,
+    )
+    if not reloader.start(new_cfg):
+        return JSONResponse({"error": "A reload is already in progress", "reload": reloader.status()}, status_code=409)
+    log.info(f"🔁 Reloading: {new_cfg.model_id} (precision={new_cfg.precision})")
+    return JSONResponse({"reload": reloader.status()}, status_code=202)
+
+
+async def create_batch(request: Request):
+    """Start an offline batch job over a JSONL file (see api_server.create_batch)"""
+    if engine is None:
+        return _error("Model is still loading", 503, config.retry_after_s)
+    if not config.admin_token:
+        return _error("Batch jobs are disabled; set ADMIN_TOKEN to enable them", 403)
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token):
+        return _error("Unauthorized", 401)
+    try:
+        data = await request.json() or {}
+    except ValueError:
+        return _error("Invalid JSON body", 400)
+    try:
+        input_file = batch_path(config.batch_dir, data.get('input_file') or "")
+        output_file = batch_path(config.batch_dir, data.get('output_file') or default_output_path(input_file))
+    except ValueError as e:
+        return _error(str(e), 400)
+    if not os.path.isfile(input_file):
+        return _error(f"input_file not found: {data.get('input_file')}", 400)
+    model_id = data.get('model') or registry.cfg.model_id
+    try:
+        lease = registry.acquire(model_id) if model_id in registry else await asyncio.to_thread(registry.acquire, model_id)
+    except UnknownModel as e:
+        return _error(str(e), 404)
+    try:
+        job = batches.start(
+            lease.engine,
+            input_file,
+            output_file,
+            batch_size=int(data.get('batch_size') or lease.engine.cfg.batch_job_size),
+            on_done=lease.release,
+        )
+    except ValueError as e:
+        lease.release()
+        return _error(str(e), 409)
+    return JSONResponse(job.status())
+
+
+async def list_batches(request: Request):
+    return JSONResponse({"object": "list", "data": batches.list()})
+
+
+async def get_batch(request: Request):
+    job = batches.get(request.path_params['batch_id'])
+    if job is None:
+        return _error(f"No batch {request.path_params['batch_id']}", 404)
+    return JSONResponse(job.status())
+
+
+async def cancel_batch(request: Request):
+    """Stop a batch after its current bucket; rerun it later to resume"""
+    if not admin_authorized(request.headers.get('Authorization'), config.admin_token):
+        return _error("Unauthorized", 401)
+    job = batches.get(request.path_params['batch_id'])
+    if job is None:
+        return _error(f"No batch {request.path_params['batch_id']}", 404)
+    job.cancel()
+    return JSONResponse(job.status())
+
+
+async def list_traces(request: Request):
+    """Ids of the most recent traced requests (oldest first)"""
+    return JSONResponse({"traces": traces.ids()})
+
+
+async def get_trace(request: Request):
+    """A traced request as Chrome trace-event JSON (see api_server.get_trace)"""
+    trace = traces.get(request.path_params['trace_id'])
+    if trace is None:
+        return _error(f"No trace {request.path_params['trace_id']}", 404)
+    return JSONResponse(trace.to_chrome())
+
+
+async def list_models(request: Request):
+    """OpenAI-compatible model list: every servable model and whether it is resident"""
+    return JSONResponse(models_payload(registry))
+
+
+async def prometheus_metrics(request: Request):
+    """Prometheus scrape endpoint"""
+    body = metrics.render(engine.metrics_gauges() if engine else None)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+async def chat_completions(request: Request):
+    """OpenAI-compatible chat completions endpoint (see api_server.chat_completions)"""
+    if engine is None:
+        return _error("Model is still loading", 503, config.retry_after_s)
+    try:
+        data = await request.json()
+    except ValueError:
+        return _error("Invalid JSON body", 400)
+    if not isinstance(data, dict):
+        return _error("Request body must be a JSON object", 400)
+
+    try:
+        system_prompt, history, user_msg = parse_messages(data.get('messages', []), config.chat_system_prompt)
+    except ValueError as e:
+        return _error(str(e), 400)
+    if not user_msg:
+        return _error("No user message provided", 400)
+    try:
+        grammar = response_format_regex(data.get('response_format'))
+    except GrammarError as e:
+        return _error(str(e), 400)
+
+    started = time.perf_counter()
+    trace = trace_requested(request.headers.get('X-Trace'), config.trace, config.trace_profile_interval_ms)
+    model_id = data.get('model') or registry.cfg.model_id
+    try:
+        # Loading an unloaded model takes a while; keep it off the event loop
+        with span(trace, "acquire_model"):
+            lease = registry.acquire(model_id) if model_id in registry else await asyncio.to_thread(registry.acquire, model_id)
+    except UnknownModel as e:
+        return _error(str(e), 404)
+    except Exception as e:
+        log.error(f"❌ Error loading {model_id}: {e}", exc_info=True)
+        return _error(str(e), 500)
+
+    streaming = False
+    try:
+        response = await _complete(request, data, lease, system_prompt, history, user_msg, trace, started, grammar)
+        streaming = isinstance(response, StreamingResponse)
+        if trace is not None:
+            response.headers['X-Trace-Id'] = trace.id
+        return response
+    finally:
+        if not streaming:
+            lease.release()
+            _finish_trace(trace, started)
+
+
+def _finish_trace(trace: Optional[Trace], started: float) -> None:
+    """Close a traced request's top-level span and keep the trace (see api_server.finish_trace)"""
+    if trace is None:
+        return
+    trace.complete("request", started, time.perf_counter())
+    path = traces.add(trace, config.trace_dir)
+    log.info(f"🔬 Trace {trace.id}" + (f" written to {path}" if path else ""))
+
+
+async def _complete(request: Request, data: dict, lease, system_prompt: str, history, user_msg: str,
+                    trace: Optional[Trace] = None, started: float = 0.0, grammar: Optional[str] = None):
+    """Serve one completion on the leased model; streaming responses release the lease when they end"""
+    llm = lease.engine
+    cfg = llm.cfg
+    max_tokens = data.get('max_tokens', cfg.max_new_tokens)
+    temperature = data.get('temperature', cfg.temperature)
+    ignore_eos = bool(data.get('ignore_eos', False))
+    try:
+        n = parse_n(data.get('n'), cfg.max_batch_size)
+    except ValueError as e:
+        return _error(str(e), 400)
+    if grammar:
+        try:
+            # A 400 before anything is queued if it cannot constrain decoding; compiling can take seconds
+            await asyncio.to_thread(llm.check_grammar, grammar)
+        except GrammarError as e:
+            return _error(str(e), 400)
+    completion_id, created = new_completion_id()
+
+    # Cache hits skip admission entirely: no model work to queue for
+    with span(trace, "response_cache_lookup"):
+        cache_key = llm.response_cache_key(
+            system_prompt, history, user_msg, max_tokens, temperature, ignore_eos, grammar=grammar
+        ) if n == 1 else None
+        cached = llm.response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        if data.get('stream'):
+            return StreamingResponse(
+                _cached_sse_events(
+                    cached, completion_id, created, cfg.model_id,
+                    include_usage=bool((data.get('stream_options') or {}).get('include_usage')),
+                ),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                background=BackgroundTask(_release_all, lease, _TraceDone(trace, started)),
+            )
+        return JSONResponse(completion_payload(
+            completion_id, created, cfg.model_id, cached.text, cached.finish_reason, cached.usage
+        ))
+
+    deadline = time.monotonic() + config.request_timeout_s
+    try:
+        with span(trace, "admission"):
+            slot = await admission.acquire(timeout=config.request_timeout_s)
+    except Saturated as e:
+        return _error(str(e), e.status, e.retry_after)
+
+    options = dict(
+        system_prompt=system_prompt,
+        history=history,
+        user_msg=user_msg,
+        max_new_tokens=max_tokens,
+        temperature=temperature,
+        conversation_id=data.get('conversation_id'),
+        ignore_eos=ignore_eos,
+        trace=trace,
+        grammar=grammar,
+    )
+    # n > 1: one prefill, n choices sampled together; chunks come as (choice index, text)
+    chunks = llm.agenerate_choices(n=n, **options) if n > 1 else llm.agenerate_stream(**options)
+    try:
+        # Queue it before answering, so a prompt that does not fit is a 400 even when streaming
+        async with asyncio.timeout(deadline - time.monotonic()):
+            await chunks.start()
+    except Exception as e:
+        await chunks.aclose()
+        slot.release()
+        if isinstance(e, TimeoutError):
+            return _error("Generation timed out", 504)
+        if isinstance(e, (ContextOverflow, GrammarError)):
+            return _error(str(e), 400)
+        log.error(f"❌ Error: {e}", exc_info=True)
+        return _error(str(e), 500)
+
+    if data.get('stream'):
+        include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+        return StreamingResponse(
+            _choice_sse_events(
+                chunks, slot, completion_id, created, cfg.model_id, deadline, include_usage=include_usage,
+            ) if n > 1 else _sse_events(
+                chunks, slot, completion_id, created, cfg.model_id, deadline,
+                include_usage=include_usage,
+                cache=llm.response_cache if cache_key else None,
+                cache_key=cache_key,
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # in case the stream never starts; the lease keeps the model resident until the end
+            background=BackgroundTask(_release_all, slot, lease, _TraceDone(trace, started)),
+        )
+
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, chunks))
+    try:
+        async with asyncio.timeout(deadline - time.monotonic()):
+            parts = [chunk async for chunk in chunks]
+    except TimeoutError:
+        return _error("Generation timed out", 504)
+    except Exception as e:
+        log.error(f"❌ Error: {e}", exc_info=True)
+        return _error(str(e), 500)
+    finally:
+        watcher.cancel()
+        await chunks.aclose()  # also cancels generation on timeout/error
+        slot.release()
+    if chunks.finish_reason == "cancelled":
+        log.info("🛑 Client disconnected; generation cancelled")
+        return _error("Client closed request", 499)
+    if n > 1:
+        by_choice = [[] for _ in range(n)]
+        for index, chunk in parts:
+            by_choice[index].append(chunk)
+        return JSONResponse(choices_payload(
+            completion_id, created, cfg.model_id, ["".join(c) for c in by_choice], chunks.finish_reasons, chunks.usage
+        ))
+    text = "".join(parts)
+    if cache_key:
+        llm.response_cache.put(cache_key, CachedResponse(text, chunks.finish_reason, chunks.usage))
+    return JSONResponse(completion_payload(
+        completion_id, created, cfg.model_id, text, chunks.finish_reason, chunks.usage
+    ))
+
+
+async def embeddings(request: Request):
+    """OpenAI-compatible embeddings endpoint (see api_server.embeddings)"""
+    if engine is None:
+        return _error("Model is still loading", 503, config.retry_after_s)
+    try:
+        data = await request.json()
+        texts = parse_embedding_input(data.get('input'))
+    except ValueError as e:
+        return _error(str(e), 400)
+    encoding_format = data.get('encoding_format') or "float"
+    if encoding_format not in ("float", "base64"):
+        return _error(f"Unsupported encoding_format '{encoding_format}'", 400)
+
+    model_id = data.get('model') or registry.cfg.model_id
+    try:
+        lease = registry.acquire(model_id) if model_id in registry else await asyncio.to_thread(registry.acquire, model_id)
+    except UnknownModel as e:
+        return _error(str(e), 404)
+    try:
+        slot = await admission.acquire(timeout=config.request_timeout_s)
+    except Saturated as e:
+        lease.release()
+        return _error(str(e), e.status, e.retry_after)
+    try:
+        # The forward pass runs on the scheduler thread; wait for it off the event loop
+        vectors, prompt_tokens = await asyncio.to_thread(lease.engine.embed, texts, data.get('pooling'))
+    except ValueError as e:
+        return _error(str(e), 400)
+    except Exception as e:
+        log.error(f"❌ Error: {e}", exc_info=True)
+        return _error(str(e), 500)
+    finally:
+        slot.release()
+        lease.release()
+    return JSONResponse(embeddings_payload(
+        lease.engine.cfg.model_id, [decode_vector(v, encoding_format) for v in vectors], prompt_tokens
+    ))
+
+
+def _release_all(*holds) -> None:
+    for hold in holds:
+        hold.release()
+
+
+class _TraceDone:
+    """Finishes a streamed request's trace once the response has been sent (a hold for _release_all)"""
+
+    def __init__(self, trace: Optional[Trace], started: float):
+        self.trace = trace
+        self.started = started
+
+    def release(self) -> None:
+        _finish_trace(self.trace, self.started)
+
+
+async def _cancel_on_disconnect(request: Request, chunks) -> None:
+    """Cancel generation as soon as the client goes away (the body has already been read)"""
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+    chunks.cancel()
+
+
+async def _sse_events(chunks, slot, completion_id: str, created: int, model: str, deadline: float,
+                      include_usage: bool = False, cache: Optional[ResponseCache] = None,
+                      cache_key: Optional[str] = None):
+    """
+    Stream chat.completion.chunk events; holds the admission slot until the stream ends.
+    With `cache`, the full response is memoized under `cache_key` once the stream completes.
+    Closing the stream (client disconnect, timeout) cancels the generation.
+    """
+    try:
+        yield sse(chunk_payload(completion_id, created, model, {"role": "assistant"}))
+        parts = []
+        async with asyncio.timeout(deadline - time.monotonic()):
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield sse(chunk_payload(completion_id, created, model, {"content": chunk}))
+        if cache is not None:
+            cache.put(cache_key, CachedResponse("".join(parts), chunks.finish_reason, chunks.usage))
+        yield sse(chunk_payload(
+            completion_id, created, model, {}, finish_reason=chunks.finish_reason or "stop"
+        ))
+        if include_usage:
+            yield sse(usage_payload(completion_id, created, model, chunks.usage))
+    except TimeoutError:
+        yield sse({"error": "Generation timed out"})
+    except Exception as e:
+        log.error(f"❌ Streaming error: {e}", exc_info=True)
+        yield sse({"error": str(e)})
+    finally:
+        await chunks.aclose()
+        slot.release()
+    yield sse("[DONE]")
+
+
+async def _choice_sse_events(choices, slot, completion_id: str, created: int, model: str, deadline: float,
+                             include_usage: bool = False):
+    """_sse_events for n > 1 choices: each chunk carries its choice's index"""
+    try:
+        for index in range(choices.n):
+            yield sse(chunk_payload(completion_id, created, model, {"role": "assistant"}, index=index))
+        async with asyncio.timeout(deadline - time.monotonic()):
+            async for index, chunk in choices:
+                yield sse(chunk_payload(completion_id, created, model, {"content": chunk}, index=index))
+        for index, finish_reason in enumerate(choices.finish_reasons):
+            yield sse(chunk_payload(
+                completion_id, created, model, {}, finish_reason=finish_reason or "stop", index=index
+            ))
+        if include_usage:
+            yield sse(usage_payload(completion_id, created, model, choices.usage))
+    except TimeoutError:
+        yield sse({"error": "Generation timed out"})
+    except Exception as e:
+        log.error(f"❌ Streaming error: {e}", exc_info=True)
+        yield sse({"error": str(e)})
+    finally:
+        await choices.aclose()
+        slot.release()
+    yield sse("[DONE]")
+
+
+async def _cached_sse_events(cached: CachedResponse, completion_id: str, created: int, model: str,
+                             include_usage: bool = False):
+    """Replay a memoized response as chat.completion.chunk events"""
+    yield sse(chunk_payload(completion_id, created, model, {"role": "assistant"}))
+    if cached.text:
+        yield sse(chunk_payload(completion_id, created, model, {"content": cached.text}))
+    yield sse(chunk_payload(
+        completion_id, created, model, {}, finish_reason=cached.finish_reason or "stop"
+    ))
+    if include_usage:
+        yield sse(usage_payload(completion_id, created, model, cached.usage))
+    yield sse("[DONE]")
+
+
+def set_engine(new_engine: LLMEngine, unload_old: bool = False):
+    """Serve `new_engine` as the default model; with `unload_old`, free the previous one once it drains"""
+    global engine, config
+    drained = registry.swap(engine, new_engine, unload_old=unload_old)
+    engine, config = new_engine, new_engine.cfg
+    return drained
+
+
+# Called from the reload thread; the swap itself is a few assignments under the registry lock
+reloader = EngineReloader(lambda new: set_engine(new, unload_old=True))
+
+
+async def _load_engine():
+    global loading
+    log.info("🤖 Initializing LLM Engine...")
+    loading = create_engine(config)
+    await asyncio.to_thread(loading.load)
+    set_engine(loading)
+    log.info("✅ LLM Engine ready!")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Load in the background so /health answers (and requests get 503) while weights load
+    task = asyncio.create_task(_load_engine()) if engine is None else None
+    yield
+    if task is not None:
+        task.cancel()
+    await asyncio.to_thread(registry.unload_all)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', prometheus_metrics, methods=['GET']),
+        Route('/v1/models', list_models, methods=['GET']),
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/v1/embeddings', embeddings, methods=['POST']),
+        Route('/v1/batches', create_batch, methods=['POST']),
+        Route('/v1/batches', list_batches, methods=['GET']),
+        Route('/v1/batches/{batch_id}', get_batch, methods=['GET']),
+        Route('/v1/batches/{batch_id}/cancel', cancel_batch, methods=['POST']),
+        Route('/admin/reload', admin_reload, methods=['POST']),
+        Route('/debug/traces', list_traces, methods=['GET']),
+        Route('/debug/traces/{trace_id}', get_trace, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
+
+
+def main():
+    """Run the ASGI API server"""
+    print("\n" + "="*60)
+    print("🚀 Starting Local LLM API Server (async)")
+    print("="*60)
+    print(f"📍 URL: http://localhost:{PORT}")
+    print(f"🤖 Model: {config.model_id}")
+    print(f"🚦 Max concurrent: {admission.max_concurrent}, queue depth: {admission.max_queue}")
+    print("\nPress Ctrl+C to stop\n")
+    uvicorn.run(app, host=HOST, port=PORT, log_level="info")
+
+
+if __name__ == '__main__':
+    main()
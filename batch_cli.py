@@ -0,0 +1,58 @@
+"""
+Offline batch inference over a JSONL file of chat completion requests
+
+Usage: python batch_cli.py requests.jsonl [results.jsonl] [--batch-size N]
+
+Each line is {"custom_id": "...", "body": {"messages": [...], "max_tokens": ...}}
+(or just the body). Results are appended to the output file as each batch
+finishes; if the run is interrupted, run the same command again to resume.
+"""
+import argparse
+import logging
+import sys
+import time
+
+from src.config import Config
+from src.llm.batch import BatchJob, default_output_path
+from src.llm.engine import LLMEngine
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+
+def main(argv=None) -> int:
+    """Run one batch job to completion with the model from the environment (.env)"""
+    cfg = Config()
+    parser = argparse.ArgumentParser(description="Run chat completions for every line of a JSONL file")
+    parser.add_argument("input", help="JSONL file of chat completion requests")
+    parser.add_argument("output", nargs="?", help="results JSONL (default: <input>.output.jsonl)")
+    parser.add_argument("--batch-size", type=int, default=cfg.batch_job_size, help="requests per length-sorted bucket")
+    args = parser.parse_args(argv)
+    output = args.output or default_output_path(args.input)
+
+    print(f"🤖 Loading {cfg.model_id} (precision={cfg.precision})...")
+    engine = LLMEngine(cfg)
+    engine.load()
+    job = BatchJob(engine, args.input, output, batch_size=args.batch_size)
+    t0 = time.perf_counter()
+    try:
+        job.run()
+    except KeyboardInterrupt:
+        print(f"\n🛑 Interrupted; run the same command again to resume ({output})")
+        return 130
+    finally:
+        engine.unload()
+
+    status = job.status()
+    counts = status["request_counts"]
+    print(f"📦 {status['status']}: {counts['completed']} completed, {counts['failed']} failed, "
+          f"{counts['resumed']} already done, in {time.perf_counter() - t0:.1f}s ({status['tokens_per_s']} tok/s)")
+    print(f"📄 Results: {output}")
+    return 0 if status["status"] == "completed" else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
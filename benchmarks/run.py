@@ -0,0 +1,302 @@
+"""
+Load-testing benchmark for LLMEngine and the chat completions API.
+
+Drives either `LLMEngine.generate_stream` directly (--mode engine) or
+/v1/chat/completions (--mode api: in-process Flask test client, or a running
+server with --url) at a fixed concurrency, and prints a JSON report with
+latency/TTFT percentiles, tokens/sec and peak RSS that can be diffed between
+commits. With no --model it builds a tiny random model, so it runs offline on CPU.
+
+    python -m benchmarks.run --mode engine --concurrency 8 --requests 64
+    python -m benchmarks.run --mode api --url http://localhost:5000 --output bench.json
+    python -m benchmarks.run --compare fp32 cpu-int8   # same model and load, per precision
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+WORDS = "hello world how are you today the quick brown fox jumps over lazy dog".split()
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "mean": sum(ordered) / len(ordered)}
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024  # bytes on macOS, KiB elsewhere
+
+
+def make_prompt(tokenizer, n_tokens: int, seed: int) -> str:
+    """Build a prompt of roughly n_tokens tokens; `seed` varies the wording between requests."""
+    words, i = [], seed
+    while len(tokenizer(" ".join(words))["input_ids"]) < n_tokens:
+        words.append(WORDS[i % len(WORDS)])
+        i += 7
+    return " ".join(words)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ===== Request drivers: each returns (latency_s, ttft_s, completion_tokens) =====
+def drive_engine(engine, prompt: str, max_new_tokens: int):
+    start = time.perf_counter()
+    ttft = None
+    stream = engine.generate_stream(
+        "You are a benchmark.", [], prompt, max_new_tokens=max_new_tokens, temperature=0, ignore_eos=True
+    )
+    for _ in stream:
+        if ttft is None:
+            ttft = time.perf_counter() - start
+    return time.perf_counter() - start, ttft, stream.usage["completion_tokens"]
+
+
+def _body(prompt: str, max_new_tokens: int) -> dict:
+    return {
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_new_tokens,
+        "temperature": 0,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "ignore_eos": True,
+    }
+
+
+def _read_sse(lines):
+    """Yield decoded chat.completion.chunk events from SSE lines until [DONE]"""
+    for line in lines:
+        line = line.strip()
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+
+def _consume(lines, start: float):
+    """Read a streamed completion; returns (ttft, completion_tokens from the usage chunk)"""
+    ttft, tokens = None, 0
+    for event in _read_sse(lines):
+        if "usage" in event:
+            tokens = event["usage"]["completion_tokens"]
+        elif ttft is None and event["choices"][0]["delta"].get("content"):
+            ttft = time.perf_counter() - start
+    return ttft, tokens
+
+
+def drive_test_client(client, prompt: str, max_new_tokens: int):
+    start = time.perf_counter()
+    resp = client.post("/v1/chat/completions", json=_body(prompt, max_new_tokens), buffered=False)
+    lines = (part for piece in resp.response for part in piece.decode().split("\n"))
+    ttft, tokens = _consume(lines, start)
+    return time.perf_counter() - start, ttft, tokens
+
+
+def drive_url(url: str, prompt: str, max_new_tokens: int):
+    start = time.perf_counter()
+    req = urllib.request.Request(
+        url.rstrip("/") + "/v1/chat/completions",
+        data=json.dumps(_body(prompt, max_new_tokens)).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as resp:
+        ttft, tokens = _consume((raw.decode() for raw in resp), start)
+    return time.perf_counter() - start, ttft, tokens
+
+
+# ===== Harness =====
+def run_load(drive, prompts: list[str], max_new_tokens: int, concurrency: int) -> dict:
+    results = []
+    lock = threading.Lock()
+
+    def one(prompt):
+        r = drive(prompt, max_new_tokens)
+        with lock:
+            results.append(r)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, prompts))
+    wall = time.perf_counter() - start
+
+    latencies = [r[0] for r in results]
+    ttfts = [r[1] for r in results if r[1] is not None]
+    tokens = sum(r[2] for r in results)
+    return {
+        "requests": len(results),
+        "wall_s": wall,
+        "latency_s": percentiles(latencies),
+        "ttft_s": percentiles(ttfts),
+        "completion_tokens": tokens,
+        "tokens_per_s": tokens / wall if wall > 0 else None,
+        "requests_per_s": len(results) / wall if wall > 0 else None,
+    }
+
+
+def run_benchmark(
+    mode: str = "engine",
+    model: Optional[str] = None,
+    url: Optional[str] = None,
+    concurrency: int = 4,
+    requests: int = 16,
+    prompt_tokens: int = 64,
+    max_new_tokens: int = 32,
+    precision: str = "auto",
+    warmup: int = 1,
+    threads: int = 0,
+) -> dict:
+    from transformers import AutoTokenizer
+
+    from src.config import Config
+    from src.llm.engine import LLMEngine
+
+    tmp = None
+    if model is None:
+        from benchmarks.tiny_model import build_tiny_model
+
+        tmp = tempfile.TemporaryDirectory(prefix="tiny-model-")
+        model = build_tiny_model(tmp.name)
+
+    engine = None
+    if url is None:
+        engine = LLMEngine(Config(model_id=model, precision=precision, device_map="cpu", cpu_threads=threads,
+                                  max_batch_size=max(concurrency, 1), response_cache_mb=0))
+        load_start = time.perf_counter()
+        engine.load()
+        load_s = time.perf_counter() - load_start
+        tokenizer = engine.tokenizer
+    else:
+        load_s = None
+        tokenizer = AutoTokenizer.from_pretrained(model)
+
+    if mode == "engine":
+        drive = lambda p, n: drive_engine(engine, p, n)
+    elif url is not None:
+        drive = lambda p, n: drive_url(url, p, n)
+    else:
+        import api_server
+
+        api_server.set_engine(engine)
+        client = api_server.app.test_client()
+        drive = lambda p, n: drive_test_client(client, p, n)
+
+    prompts = [make_prompt(tokenizer, prompt_tokens, seed=i) for i in range(requests)]
+    for p in prompts[:warmup]:
+        drive(p, max_new_tokens)
+
+    report = {
+        "commit": git_commit(),
+        "params": {
+            "mode": mode, "model": model if tmp is None else "tiny-random", "url": url,
+            "precision": precision, "concurrency": concurrency, "requests": requests,
+            "prompt_tokens": prompt_tokens, "max_new_tokens": max_new_tokens, "threads": threads,
+        },
+        "load_s": load_s,
+        "model_mb": engine.model_bytes / (1024 * 1024) if engine is not None else None,
+        **run_load(drive, prompts, max_new_tokens, concurrency),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    if engine is not None:
+        engine.scheduler.stop()
+    if tmp is not None:
+        tmp.cleanup()
+    return report
+
+
+def compare_precisions(precisions: list[str], model: Optional[str] = None, **kwargs) -> dict:
+    """
+    Engine benchmark of the same model at each precision (e.g. fp32 vs cpu-int8),
+    with tokens/sec and weight memory relative to the first one.
+    """
+    tmp = None
+    if model is None:
+        from benchmarks.tiny_model import build_tiny_model
+
+        tmp = tempfile.TemporaryDirectory(prefix="tiny-model-")
+        model = build_tiny_model(tmp.name)
+    try:
+        runs = {p: run_benchmark(mode="engine", model=model, precision=p, **kwargs) for p in precisions}
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    base = runs[precisions[0]]
+    return {
+        "commit": git_commit(),
+        "baseline": precisions[0],
+        "runs": runs,
+        "relative": {
+            p: {
+                "tokens_per_s": r["tokens_per_s"] / base["tokens_per_s"],
+                "model_mb": r["model_mb"] / base["model_mb"],
+                "latency_p50": r["latency_s"]["p50"] / base["latency_s"]["p50"],
+            }
+            for p, r in runs.items()
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["engine", "api"], default="engine")
+    parser.add_argument("--model", help="model id or local path (default: build a tiny random model)")
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process one (api mode)")
+    parser.add_argument("--precision", default="auto")
+    parser.add_argument("--compare", nargs="+", metavar="PRECISION",
+                        help="benchmark the engine at each precision, relative to the first (e.g. fp32 cpu-int8)")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (default: torch's choice)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--prompt-tokens", type=int, default=64)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--output", help="also write the JSON report here")
+    args = parser.parse_args(argv)
+
+    load = dict(
+        concurrency=args.concurrency, requests=args.requests, prompt_tokens=args.prompt_tokens,
+        max_new_tokens=args.max_new_tokens, threads=args.threads,
+    )
+    if args.compare:
+        report = compare_precisions(args.compare, model=args.model, **load)
+    else:
+        report = run_benchmark(mode=args.mode, model=args.model, url=args.url, precision=args.precision, **load)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
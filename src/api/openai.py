@@ -0,0 +1,136 @@
+"""
+OpenAI-compatible request parsing and response payloads,
+shared by the Flask (api_server.py) and ASGI (asgi_server.py) servers.
+"""
+import json
+import time
+import uuid
+
+
+def parse_messages(messages: list[dict], default_system: str):
+    """Split an OpenAI message list into (system_prompt, history, user_msg); ValueError if malformed"""
+    system_prompt = default_system
+    history = []
+    user_msg = ""
+
+    if not isinstance(messages, list) or not all(isinstance(msg, dict) for msg in messages):
+        raise ValueError("messages must be a list of objects")
+    for msg in messages:
+        role = msg.get('role')
+        content = msg.get('content', '')
+
+        if role == 'system':
+            system_prompt = content
+        elif role == 'user':
+            user_msg = content
+        elif role == 'assistant':
+            # Add to history if there was a previous user message
+            if user_msg:
+                history.append((user_msg, content))
+                user_msg = ""
+
+    return system_prompt, history, user_msg
+
+
+def new_completion_id() -> tuple[str, int]:
+    return f"chatcmpl-{uuid.uuid4().hex}", int(time.time())
+
+
+def parse_n(value, limit: int) -> int:
+    """The "n" of a completion request: how many choices to sample (1 to `limit`)"""
+    if value is None:
+        return 1
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= limit:
+        raise ValueError(f"n must be an integer from 1 to {limit}")
+    return value
+
+
+def completion_payload(completion_id: str, created: int, model: str, text: str,
+                       finish_reason: str = "stop", usage: dict = None) -> dict:
+    return choices_payload(completion_id, created, model, [text], [finish_reason], usage)
+
+
+def choices_payload(completion_id: str, created: int, model: str, texts: list[str],
+                    finish_reasons: list, usage: dict = None) -> dict:
+    """A chat.completion with one choice per text (n > 1)"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "choices": [
+            {
+                "index": i,
+                "message": {
+                    "role": "assistant",
+                    "content": text
+                },
+                "finish_reason": finish_reason or "stop"
+            }
+            for i, (text, finish_reason) in enumerate(zip(texts, finish_reasons))
+        ],
+        "model": model,
+        "usage": usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+
+def chunk_payload(completion_id: str, created: int, model: str, delta: dict, finish_reason=None,
+                  index: int = 0) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def usage_payload(completion_id: str, created: int, model: str, usage: dict) -> dict:
+    """Final chunk sent when the client asks for stream_options.include_usage"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [],
+        "usage": usage,
+    }
+
+
+def parse_embedding_input(value) -> list[str]:
+    """The "input" of an embeddings request as a list of strings (a single string is one input)"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value and all(isinstance(v, str) for v in value):
+        return value
+    raise ValueError("input must be a non-empty string or list of strings")
+
+
+def embeddings_payload(model: str, embeddings: list, prompt_tokens: int) -> dict:
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(embeddings)],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+def models_payload(registry) -> dict:
+    """/v1/models listing for a ModelRegistry: configured ids plus whatever is loaded"""
+    if registry is None:
+        return {"object": "list", "data": []}
+    loaded = {m["model"]: m for m in registry.stats()["models"]}
+    ids = [registry.cfg.model_id] + sorted((registry.allowed - {"*"}) | set(loaded))
+    return {
+        "object": "list",
+        "data": [
+            {"id": model_id, "object": "model", "owned_by": "local",
+             "loaded": model_id in loaded, "bytes": loaded.get(model_id, {}).get("bytes")}
+            for model_id in dict.fromkeys(ids)
+        ],
+    }
+
+
+def sse(payload) -> str:
+    """Format one Server-Sent Event; strings are sent verbatim (e.g. "[DONE]")"""
+    data = payload if isinstance(payload, str) else json.dumps(payload)
+    return f"data: {data}\n\n"
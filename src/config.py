@@ -5,13 +5,82 @@ from dataclasses import dataclass
 class Config:
     # Change these to taste (or via .env)
     model_id: str = os.getenv("MODEL_ID", "Qwen/Qwen2.5-3B-Instruct")
-    # Options: "auto", "fp16", "int4" (int4 needs bitsandbytes, usually Linux)
+    # Options: "auto", "fp16", "int4" (int4 needs bitsandbytes, usually Linux),
+    # "fp32", "cpu-int8" (CPU only: Linear layers dynamically quantized to int8)
     precision: str = os.getenv("PRECISION", "auto")
+    # CPU tuning: torch intra-op / inter-op thread counts (0 = torch's default), and
+    # TORCH_COMPILE=1 to compile the forward pass (slow first requests while it compiles)
+    cpu_threads: int = int(os.getenv("CPU_THREADS", "0"))
+    cpu_interop_threads: int = int(os.getenv("CPU_INTEROP_THREADS", "0"))
+    torch_compile: bool = os.getenv("TORCH_COMPILE", "0").lower() in ("1", "true", "yes")
     max_new_tokens: int = int(os.getenv("MAX_NEW_TOKENS", "256"))
     temperature: float = float(os.getenv("TEMPERATURE", "0.7"))
     top_p: float = float(os.getenv("TOP_P", "0.9"))
     device_map: str = os.getenv("DEVICE_MAP", "auto")   # "auto" spreads across GPU/CPU as needed
     chat_system_prompt: str = os.getenv("SYSTEM_PROMPT", "You are a helpful assistant.")
+    # API replica mode: REPLICAS > 1 runs that many engine worker processes (least-loaded dispatch),
+    # each with REPLICA_THREADS torch threads (0 = cores / replicas), all mapping one copy of the weights
+    replicas: int = int(os.getenv("REPLICAS", "0"))
+    replica_threads: int = int(os.getenv("REPLICA_THREADS", "0"))
+    # Optional directory for a local safetensors copy of each loaded (converted/quantized) model;
+    # later starts memory-map it instead of converting again
+    weight_cache_dir: str = os.getenv("WEIGHT_CACHE_DIR", "")
+    # GUI transcript store: every message is saved here; only the latest ones are kept in memory
+    chat_db: str = os.getenv("CHAT_DB", "chat_history.sqlite3")
+    # Prompt budget = CONTEXT_TOKENS (0 = the model's maximum) minus max_new_tokens. When history does not fit,
+    # CONTEXT_POLICY decides what goes: drop_oldest | last_n (keep CONTEXT_KEEP_TURNS turns) |
+    # summarize (fold old turns into a summary of up to CONTEXT_SUMMARY_TOKENS tokens)
+    context_tokens: int = int(os.getenv("CONTEXT_TOKENS", "0"))
+    context_policy: str = os.getenv("CONTEXT_POLICY", "drop_oldest")
+    context_keep_turns: int = int(os.getenv("CONTEXT_KEEP_TURNS", "8"))
+    context_summary_tokens: int = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "128"))
+    # Max sequences decoded together by the batch scheduler
+    max_batch_size: int = int(os.getenv("MAX_BATCH_SIZE", "8"))
+    # Offline batch jobs (/v1/batches, batch_cli.py): requests per length-sorted bucket (one checkpoint each)
+    batch_job_size: int = int(os.getenv("BATCH_JOB_SIZE", "32"))
+    # /v1/batches reads input files from and writes output files to this directory only
+    batch_dir: str = os.getenv("BATCH_DIR", "batches")
+    # Memory budget for KV caches kept between conversation turns
+    kv_cache_mb: int = int(os.getenv("KV_CACHE_MB", "512"))
+    # Shared prompt-prefix cache (system prompts etc.), stored in blocks of PREFIX_BLOCK_SIZE tokens
+    prefix_cache_mb: int = int(os.getenv("PREFIX_CACHE_MB", "256"))
+    prefix_block_size: int = int(os.getenv("PREFIX_BLOCK_SIZE", "16"))
+    # Speculative decoding: a small draft model from the same family (same tokenizer) proposes tokens
+    draft_model_id: str = os.getenv("DRAFT_MODEL_ID", "")
+    num_speculative_tokens: int = int(os.getenv("NUM_SPECULATIVE_TOKENS", "4"))
+    # Memoized responses for temperature-0 requests; set RESPONSE_CACHE_DIR to keep them across restarts
+    response_cache_mb: int = int(os.getenv("RESPONSE_CACHE_MB", "64"))
+    response_cache_dir: str = os.getenv("RESPONSE_CACHE_DIR", "")
+    response_cache_disk_mb: int = int(os.getenv("RESPONSE_CACHE_DISK_MB", "1024"))
+    # /v1/embeddings: pooling of the final hidden states (mean | last), inputs per forward pass,
+    # and an LRU of computed vectors keyed by text
+    embedding_pooling: str = os.getenv("EMBEDDING_POOLING", "mean")
+    embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+    embedding_cache_mb: int = int(os.getenv("EMBEDDING_CACHE_MB", "64"))
+    # Streamed text is flushed every STREAM_CHUNK_TOKENS tokens or STREAM_CHUNK_MS milliseconds (0 = no time
+    # limit), whichever comes first; larger batches mean fewer, bigger chunks (SSE events) per stream
+    stream_chunk_tokens: int = int(os.getenv("STREAM_CHUNK_TOKENS", "1"))
+    stream_chunk_ms: float = float(os.getenv("STREAM_CHUNK_MS", "0"))
+    # response_format (constrained decoding): compiled schemas/regexes kept with their token masks
+    grammar_cache_size: int = int(os.getenv("GRAMMAR_CACHE_SIZE", "64"))
+    # Extra models the API may load on demand from a request's "model" field (comma-separated, "*" = any),
+    # kept resident within MODEL_MEMORY_MB (0 = no limit), least recently used unloaded first
+    served_models: str = os.getenv("SERVED_MODELS", "")
+    model_memory_mb: int = int(os.getenv("MODEL_MEMORY_MB", "0"))
+    # Required as "Authorization: Bearer <token>" on admin endpoints; POST /admin/reload
+    # and /v1/batches are refused unless it is set
+    admin_token: str = os.getenv("ADMIN_TOKEN", "")
+    # Request tracing (Chrome trace JSON, see src/llm/tracing.py): TRACE=1 traces every request
+    # (or send "X-Trace: 1" per request), "profile" also samples the decode loop every
+    # TRACE_PROFILE_INTERVAL_MS; traces are kept for GET /debug/traces/<id> and written to TRACE_DIR if set
+    trace: str = os.getenv("TRACE", "")
+    trace_dir: str = os.getenv("TRACE_DIR", "")
+    trace_profile_interval_ms: float = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "2"))
+    # Async server admission control (asgi_server.py)
+    max_concurrent_generations: int = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "8"))
+    max_queue_depth: int = int(os.getenv("MAX_QUEUE_DEPTH", "32"))
+    request_timeout_s: float = float(os.getenv("REQUEST_TIMEOUT", "300"))
+    retry_after_s: float = float(os.getenv("RETRY_AFTER", "1"))
 
 def save_env(model_id: str, precision: str):
     path = os.path.join(os.getcwd(), ".env")
@@ -0,0 +1,68 @@
+import asyncio
+from typing import Optional
+
+
+class Saturated(Exception):
+    """Raised when a request cannot be admitted; `status` is the HTTP code to answer with."""
+
+    def __init__(self, message: str, status: int, retry_after: float):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Slot:
+    """A held generation slot; release() is idempotent so every exit path can call it."""
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+class AdmissionController:
+    """
+    Bounds work admitted to the engine from an asyncio server.
+
+    At most `max_concurrent` generations hold a slot at once and at most
+    `max_queue` more may wait for one. Past that, callers are turned away
+    immediately (429) rather than piling up; a caller that waits longer than
+    its timeout for a slot is turned away with 503.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, retry_after: float = 1.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+
+    async def acquire(self, timeout: Optional[float] = None) -> Slot:
+        if self.running >= self.max_concurrent and self.waiting >= self.max_queue:
+            raise Saturated("Server is at capacity", 429, self.retry_after)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise Saturated("Timed out waiting for a generation slot", 503, self.retry_after) from None
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return Slot(self)
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
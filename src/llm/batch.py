@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from src.api.openai import completion_payload, new_completion_id, parse_messages
+from src.llm.context import ContextOverflow
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchItem:
+    """One request of a batch job, encoded and ready to be bucketed"""
+    custom_id: str
+    input_ids: list[int]
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+
+
+def _sampling(body: dict, cfg) -> tuple[int, float, float]:
+    """A request's max_tokens, temperature and top_p (config defaults if absent); ValueError if mistyped"""
+    max_tokens = body.get("max_tokens", cfg.max_new_tokens)
+    temperature = body.get("temperature", cfg.temperature)
+    top_p = body.get("top_p", cfg.top_p)
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        raise ValueError(f"max_tokens must be a positive integer, not {max_tokens!r}")
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or temperature < 0:
+        raise ValueError(f"temperature must be a number >= 0, not {temperature!r}")
+    if isinstance(top_p, bool) or not isinstance(top_p, (int, float)) or not 0 < top_p <= 1:
+        raise ValueError(f"top_p must be a number in (0, 1], not {top_p!r}")
+    return max_tokens, float(temperature), float(top_p)
+
+
+def completed_ids(output_path: str) -> set[str]:
+    """
+    custom_ids already written to `output_path` by an earlier run of the job.
+    A partial last line (the process died mid-write) is cut off so the
+    resumed run appends after the last complete result.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+        for line in data[:end].splitlines():
+            if line.strip():
+                done.add(json.loads(line)["custom_id"])
+    return done
+
+
+class BatchJob:
+    """
+    Offline chat completions over a JSONL file.
+
+    Each input line is an OpenAI batch request (`{"custom_id": ..., "body":
+    {"messages": [...], ...}}`) or a bare chat completion body. Requests are
+    encoded up front, grouped by sampling settings, sorted by prompt length
+    and cut into buckets of `batch_size`, so rows decoded together need little
+    padding. Each bucket runs on the engine's batch scheduler next to live
+    requests (see LLMEngine.generate_batch). Results are appended to
+    `output_path` one bucket at a time (flushed and fsynced); running the
+    same job again skips every custom_id already there, so an interrupted job
+    resumes where it stopped. Output lines are in bucket order, not input
+    order: match them by custom_id.
+    """
+
+    def __init__(self, engine, input_path: str, output_path: str, batch_size: int = 32,
+                 on_done: Optional[Callable[[], None]] = None):
+        self.id = f"batch_{uuid.uuid4().hex}"
+        self.engine = engine
+        self.input_path = input_path
+        self.output_path = output_path
+        self.batch_size = max(1, batch_size)
+        self._on_done = on_done
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self.state = "validating"
+        self.error: Optional[str] = None
+        self.created_at = int(time.time())
+        self.completed_at: Optional[int] = None
+        self.total = self.completed = self.failed = self.resumed = 0
+        self.completion_tokens = 0
+        self._generate_s = 0.0
+
+    def cancel(self) -> None:
+        """Stop after the bucket in progress; finished results stay in the output file"""
+        self._cancel.set()
+        with self._lock:
+            if self.state in ("validating", "in_progress"):
+                self.state = "cancelling"
+
+    def run(self) -> None:
+        try:
+            self._run()
+        except Exception as e:
+            log.error(f"❌ Batch {self.id} failed: {e}", exc_info=True)
+            self._set_state("failed", error=str(e))
+        finally:
+            if self._on_done is not None:
+                self._on_done()
+
+    def _run(self) -> None:
+        done = completed_ids(self.output_path)
+        with open(self.output_path, "a", encoding="utf-8") as out:
+            items = self._read(done, out)
+            self._set_state("in_progress")
+            for bucket in self._buckets(items):
+                if self._cancel.is_set():
+                    self._set_state("cancelled")
+                    return
+                self._run_bucket(bucket, out)
+        self._set_state("completed")
+        log.info(f"✅ Batch {self.id}: {self.completed} completed, {self.failed} failed, {self.resumed} resumed")
+
+    def _read(self, done: set[str], out) -> list[BatchItem]:
+        """Encode every request not yet in the output; invalid ones are written as errors right away"""
+        cfg = self.engine.cfg
+        items, seen = [], set()
+        with open(self.input_path, encoding="utf-8") as f:
+            for n, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                self.total += 1
+                custom_id = f"request-{n}"
+                try:
+                    request = json.loads(line)
+                    custom_id = str(request.get("custom_id") or custom_id)
+                    if custom_id in seen:
+                        raise ValueError(f"Duplicate custom_id '{custom_id}' (line {n})")
+                    seen.add(custom_id)
+                    if custom_id in done:
+                        self.resumed += 1
+                        continue
+                    body = request.get("body", request)
+                    system_prompt, history, user_msg = parse_messages(body.get("messages", []), cfg.chat_system_prompt)
+                    if not user_msg:
+                        raise ValueError("No user message provided")
+                    max_tokens, temperature, top_p = _sampling(body, cfg)
+                    items.append(BatchItem(
+                        custom_id,
+                        self.engine.encode_prompt(system_prompt, history, user_msg, max_tokens),
+                        max_tokens,
+                        temperature,
+                        top_p,
+                    ))
+                except (ValueError, TypeError, ContextOverflow, AttributeError) as e:
+                    self._write(out, [self._error_line(custom_id, str(e))])
+                    self.failed += 1
+        out.flush()
+        return items
+
+    def _buckets(self, items: list[BatchItem]) -> list[list[BatchItem]]:
+        """Runs of up to `batch_size` requests with the same sampling settings and similar prompt lengths"""
+        items = sorted(items, key=lambda i: (i.temperature, i.top_p, i.max_new_tokens, len(i.input_ids)))
+        buckets, current = [], []
+        for item in items:
+            if current and (
+                len(current) == self.batch_size
+                or (item.temperature, item.top_p, item.max_new_tokens)
+                != (current[0].temperature, current[0].top_p, current[0].max_new_tokens)
+            ):
+                buckets.append(current)
+                current = []
+            current.append(item)
+        if current:
+            buckets.append(current)
+        return buckets
+
+    def _run_bucket(self, bucket: list[BatchItem], out) -> None:
+        first = bucket[0]
+        t0 = time.perf_counter()
+        results = self.engine.generate_batch(
+            [i.input_ids for i in bucket], first.max_new_tokens, first.temperature, first.top_p
+        )
+        self._generate_s += time.perf_counter() - t0
+        lines = []
+        for item, (ids, finish_reason) in zip(bucket, results):
+            completion_id, created = new_completion_id()
+            usage = {
+                "prompt_tokens": len(item.input_ids),
+                "completion_tokens": len(ids),
+                "total_tokens": len(item.input_ids) + len(ids),
+            }
+            text = self.engine.tokenizer.decode(ids, skip_special_tokens=True)
+            body = completion_payload(completion_id, created, self.engine.cfg.model_id, text, finish_reason, usage)
+            lines.append({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": item.custom_id,
+                "response": {"status_code": 200, "body": body},
+                "error": None,
+            })
+            self.completion_tokens += len(ids)
+        self._write(out, lines)
+        self.completed += len(bucket)
+
+    @staticmethod
+    def _error_line(custom_id: str, message: str) -> dict:
+        return {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": custom_id,
+            "response": None,
+            "error": {"code": "invalid_request", "message": message},
+        }
+
+    @staticmethod
+    def _write(out, lines: list[dict]) -> None:
+        """Append results and make them durable: this is the job's checkpoint"""
+        out.write("".join(json.dumps(line) + "\n" for line in lines))
+        out.flush()
+        os.fsync(out.fileno())
+
+    def _set_state(self, state: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.state = state
+            self.error = error
+            if state in ("completed", "failed", "cancelled"):
+                self.completed_at = int(time.time())
+
+    def status(self) -> dict:
+        """OpenAI-style batch object, plus throughput"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "object": "batch",
+                "endpoint": "/v1/chat/completions",
+                "model": self.engine.cfg.model_id,
+                "input_file": self.input_path,
+                "output_file": self.output_path,
+                "status": self.state,
+                "error": self.error,
+                "created_at": self.created_at,
+                "completed_at": self.completed_at,
+                "request_counts": {
+                    "total": self.total, "completed": self.completed, "failed": self.failed, "resumed": self.resumed,
+                },
+                "completion_tokens": self.completion_tokens,
+                "tokens_per_s": round(self.completion_tokens / self._generate_s, 1) if self._generate_s else 0.0,
+            }
+
+
+class BatchManager:
+    """Batch jobs started through /v1/batches, each run on its own background thread"""
+
+    def __init__(self):
+        self._jobs: dict[str, BatchJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self, engine, input_path: str, output_path: str, batch_size: int = 32,
+              on_done: Optional[Callable[[], None]] = None) -> BatchJob:
+        """Start a job; ValueError if another running job already writes to `output_path`"""
+        output_path = os.path.abspath(output_path)
+        with self._lock:
+            for job in self._jobs.values():
+                if job.output_path == output_path and job.state in ("validating", "in_progress", "cancelling"):
+                    raise ValueError(f"Batch {job.id} is already writing to {output_path}")
+            job = BatchJob(engine, os.path.abspath(input_path), output_path, batch_size, on_done)
+            self._jobs[job.id] = job
+        threading.Thread(target=job.run, name=f"batch-{job.id[-8:]}", daemon=True).start()
+        log.info(f"📦 Batch {job.id}: {input_path} -> {output_path}")
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[dict]:
+        return [job.status() for job in self._jobs.values()]
+
+
+def default_output_path(input_path: str) -> str:
+    root, _ = os.path.splitext(input_path)
+    return f"{root}.output.jsonl"
+
+
+def batch_path(batch_dir: str, path: str) -> str:
+    """
+    `path` (relative to `batch_dir`, or absolute) resolved with symlinks
+    followed; ValueError if it is not inside `batch_dir`. The API only lets
+    batch jobs read and write files there (BATCH_DIR).
+    """
+    if not isinstance(path, str) or not path:
+        raise ValueError("input_file and output_file must be file paths")
+    root = os.path.realpath(batch_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if resolved == root or os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path} is not inside the batch directory")
+    return resolved
@@ -0,0 +1,768 @@
+"""
+Constrained decoding: completions that must match a regular expression, or a
+JSON schema compiled to one ("response_format" on /v1/chat/completions).
+
+A pattern is parsed once into an NFA and run as a character DFA, built
+lazily by subset construction. A TokenAutomaton lifts the DFA to the
+tokenizer's vocabulary: in a given DFA state, the allowed tokens are those
+whose whole text the DFA can consume from there. They are found by walking
+a trie of every token's text alongside the DFA, for every state reachable
+token by token, when the pattern is compiled on the request thread; the
+result is cached with the compiled pattern (GrammarCache), so later
+requests with the same schema reuse it. Per decode step on the scheduler
+thread, a GrammarProcessor does one cache lookup, a walk over the sampled
+token's few characters, and one masked_fill of the logits row.
+"""
+import bisect
+import functools
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+DEAD = -1  # DFA state after a character the pattern cannot accept
+
+_MAX_REPEAT = 1000  # largest {m,n} bound
+_MAX_NFA_STATES = 200_000
+_MAX_TOKEN_STATES = 20_000  # DFA states a pattern may reach token by token
+_WS = "[ ]?"  # whitespace allowed between JSON tokens
+_JSON_DEPTH = 3  # nesting levels for schema-less JSON values (json_object, {})
+
+
+class GrammarError(ValueError):
+    """An invalid or unsupported response_format, JSON schema or regex"""
+
+
+# ===== Regex -> NFA =====
+def _merge(ranges) -> tuple[tuple[int, int], ...]:
+    merged: list[list[int]] = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return tuple((lo, hi) for lo, hi in merged)
+
+
+def _complement(ranges) -> tuple[tuple[int, int], ...]:
+    out, start = [], 0
+    for lo, hi in _merge(ranges):
+        if lo > start:
+            out.append((start, lo - 1))
+        start = hi + 1
+    if start <= 0x10FFFF:
+        out.append((start, 0x10FFFF))
+    return tuple(out)
+
+
+class _CharSet:
+    """A set of code points as sorted, merged ranges"""
+
+    __slots__ = ("ranges", "_starts")
+
+    def __init__(self, ranges):
+        self.ranges = _merge(ranges)
+        self._starts = [lo for lo, _ in self.ranges]
+
+    def __contains__(self, ch: str) -> bool:
+        c = ord(ch)
+        i = bisect.bisect_right(self._starts, c) - 1
+        return i >= 0 and c <= self.ranges[i][1]
+
+
+_DIGIT = ((48, 57),)
+_WORD = ((48, 57), (65, 90), (95, 95), (97, 122))
+_SPACE = ((9, 13), (32, 32))
+_CLASSES = {"d": _DIGIT, "w": _WORD, "s": _SPACE}
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+
+class _Parser:
+    """
+    Recursive-descent parser for the regex subset used by schemas and
+    clients: literals, escapes (\\d \\w \\s and negations, \\n, \\uXXXX, \\xXX),
+    classes, ".", groups, "|", and the quantifiers * + ? {m} {m,} {m,n}.
+    The whole completion must match, so ^ and $ are accepted and ignored.
+    """
+
+    def __init__(self, pattern: str):
+        self.p = pattern
+        self.i = 0
+
+    def parse(self):
+        node = self._alt()
+        if self.i < len(self.p):
+            raise GrammarError(f"Unbalanced ')' at position {self.i} in regex")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.p[self.i] if self.i < len(self.p) else None
+
+    def _alt(self):
+        branches = [self._seq()]
+        while self._peek() == "|":
+            self.i += 1
+            branches.append(self._seq())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _seq(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._quantified())
+        return ("seq", items)
+
+    def _quantified(self):
+        node = self._atom()
+        while True:
+            c = self._peek()
+            if c == "*":
+                lo, hi = 0, None
+            elif c == "+":
+                lo, hi = 1, None
+            elif c == "?":
+                lo, hi = 0, 1
+            elif c == "{" and (m := re.match(r"\{(\d+)(,(\d*))?\}", self.p[self.i:])):
+                lo = int(m[1])
+                hi = lo if m[2] is None else (int(m[3]) if m[3] else None)
+                self.i += len(m[0]) - 1
+            else:
+                return node
+            self.i += 1
+            if self._peek() == "?":
+                self.i += 1  # lazy quantifiers match the same set of strings
+            if max(lo, hi or 0) > _MAX_REPEAT or (hi is not None and hi < lo):
+                raise GrammarError(f"Unsupported repetition {{{lo},{hi}}} in regex")
+            node = ("repeat", node, lo, hi)
+
+    def _atom(self):
+        c = self.p[self.i]
+        self.i += 1
+        if c == "(":
+            if self.p.startswith("?:", self.i):
+                self.i += 2
+            elif m := re.match(r"\?P?<[A-Za-z_]\w*>", self.p[self.i:]):
+                self.i += len(m[0])
+            elif self._peek() == "?":
+                raise GrammarError("Lookarounds, backreferences and inline flags are not supported in regex")
+            node = self._alt()
+            if self._peek() != ")":
+                raise GrammarError("Missing ')' in regex")
+            self.i += 1
+            return node
+        if c == "[":
+            return ("chars", _CharSet(self._class()))
+        if c == ".":
+            return ("chars", _CharSet(_complement([(10, 10)])))
+        if c == "\\":
+            return ("chars", _CharSet(self._escape()))
+        if c in "^$":
+            return ("seq", [])
+        if c in "*+?":
+            raise GrammarError(f"Nothing to repeat at position {self.i - 1} in regex")
+        return ("chars", _CharSet([(ord(c), ord(c))]))
+
+    def _escape(self) -> tuple[tuple[int, int], ...]:
+        if self.i >= len(self.p):
+            raise GrammarError("Regex ends with a backslash")
+        c = self.p[self.i]
+        self.i += 1
+        if c.lower() in _CLASSES:
+            ranges = _CLASSES[c.lower()]
+            return _complement(ranges) if c.isupper() else ranges
+        if c in "ux":
+            width = 4 if c == "u" else 2
+            digits = self.p[self.i:self.i + width]
+            if not re.fullmatch(f"[0-9a-fA-F]{{{width}}}", digits):
+                raise GrammarError(f"Bad \\{c} escape in regex")
+            self.i += width
+            code = int(digits, 16)
+            return ((code, code),)
+        if c in _ESCAPES:
+            code = ord(_ESCAPES[c])
+            return ((code, code),)
+        if c.isalnum():
+            raise GrammarError(f"Unsupported escape \\{c} in regex")
+        return ((ord(c), ord(c)),)
+
+    def _class(self) -> tuple[tuple[int, int], ...]:
+        negated = self._peek() == "^"
+        if negated:
+            self.i += 1
+        ranges: list[tuple[int, int]] = []
+        first = True
+        while True:
+            if self.i >= len(self.p):
+                raise GrammarError("Missing ']' in regex")
+            if self.p[self.i] == "]" and not first:
+                self.i += 1
+                break
+            first = False
+            lo = self._class_item()
+            if len(lo) == 1 and lo[0][0] == lo[0][1] and self.p[self.i:self.i + 1] == "-" \
+                    and self.p[self.i + 1:self.i + 2] not in ("]", ""):
+                self.i += 1
+                hi = self._class_item()
+                if len(hi) != 1 or hi[0][0] != hi[0][1] or hi[0][0] < lo[0][0]:
+                    raise GrammarError("Bad character range in regex")
+                ranges.append((lo[0][0], hi[0][0]))
+            else:
+                ranges.extend(lo)
+        return _complement(ranges) if negated else _merge(ranges)
+
+    def _class_item(self) -> tuple[tuple[int, int], ...]:
+        c = self.p[self.i]
+        self.i += 1
+        if c == "\\":
+            if self._peek() == "b":
+                self.i += 1
+                return ((8, 8),)  # backspace inside a class
+            return self._escape()
+        return ((ord(c), ord(c)),)
+
+
+class _NFA:
+    """Thompson NFA: per state, epsilon moves and (character set, target) edges"""
+
+    def __init__(self, tree):
+        self.eps: list[list[int]] = []
+        self.edges: list[list[tuple[_CharSet, int]]] = []
+        self.start, self.accept = self._build(tree)
+
+    def _state(self) -> int:
+        if len(self.eps) >= _MAX_NFA_STATES:
+            raise GrammarError("Pattern is too large")
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def _build(self, node) -> tuple[int, int]:
+        kind = node[0]
+        if kind == "chars":
+            start, end = self._state(), self._state()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "seq":
+            start = end = self._state()
+            for item in node[1]:
+                a, z = self._build(item)
+                self.eps[end].append(a)
+                end = z
+            return start, end
+        if kind == "alt":
+            start, end = self._state(), self._state()
+            for branch in node[1]:
+                a, z = self._build(branch)
+                self.eps[start].append(a)
+                self.eps[z].append(end)
+            return start, end
+        _, item, lo, hi = node
+        start = end = self._state()
+        for _ in range(lo):
+            a, z = self._build(item)
+            self.eps[end].append(a)
+            end = z
+        if hi is None:  # loop back for any number of further copies
+            a, z = self._build(item)
+            self.eps[end].append(a)
+            self.eps[z].append(end)
+            return start, end
+        optional_end = self._state()
+        for _ in range(hi - lo):
+            a, z = self._build(item)
+            self.eps[end].extend((a, optional_end))
+            end = z
+        self.eps[end].append(optional_end)
+        return start, optional_end
+
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(pattern: str) -> _NFA:
+    """Parse `pattern` (raises GrammarError if it is not supported); cached"""
+    if not isinstance(pattern, str) or not pattern:
+        raise GrammarError("regex must be a non-empty string")
+    return _NFA(_Parser(pattern).parse())
+
+
+class _DFA:
+    """Deterministic view of an NFA, built one transition at a time as characters are seen"""
+
+    def __init__(self, nfa: _NFA):
+        self.nfa = nfa
+        self._sets: list[frozenset] = []
+        self._ids: dict[frozenset, int] = {}
+        self._moves: list[dict[str, int]] = []
+        self.accepting: list[bool] = []
+        self.final: list[bool] = []  # accepting with no way to continue
+        self.start = self._add(self._closure([nfa.start]))
+
+    def _closure(self, states) -> frozenset:
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for t in self.nfa.eps[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+    def _add(self, states: frozenset) -> int:
+        if not states:
+            return DEAD
+        state = self._ids.get(states)
+        if state is None:
+            state = self._ids[states] = len(self._sets)
+            self._sets.append(states)
+            self._moves.append({})
+            accepting = self.nfa.accept in states
+            self.accepting.append(accepting)
+            self.final.append(accepting and not any(self.nfa.edges[s] for s in states))
+        return state
+
+    def step(self, state: int, ch: str) -> int:
+        moves = self._moves[state]
+        target = moves.get(ch)
+        if target is None:
+            edges = self.nfa.edges
+            targets = [t for s in self._sets[state] for chars, t in edges[s] if ch in chars]
+            target = moves[ch] = self._add(self._closure(targets))
+        return target
+
+    def __len__(self) -> int:
+        return len(self._sets)
+
+
+# ===== JSON schema -> regex =====
+_STRING_CHAR = r'(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+_INTEGER = r"-?(?:0|[1-9][0-9]{0,15})"
+_NUMBER = _INTEGER + r"(?:\.[0-9]{1,15})?(?:[eE][+-]?[0-9]{1,3})?"
+_FORMATS = {
+    "date": r"[0-9]{4}-[0-9]{2}-[0-9]{2}",
+    "time": r"[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]{1,6})?(?:Z|[+-][0-9]{2}:[0-9]{2})?",
+    "date-time": r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]{1,6})?(?:Z|[+-][0-9]{2}:[0-9]{2})?",
+    "uuid": r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}",
+}
+
+
+def _literal(value) -> str:
+    return re.escape(json.dumps(value, ensure_ascii=False))
+
+
+_JSON_TEXT = _complement([(0, 0x1F), (ord('"'), ord('"')), (ord("\\"), ord("\\"))])
+
+
+def _code(c: int) -> str:
+    return f"\\u{c:04x}" if c <= 0xFFFF else chr(c)
+
+
+def _unparse(node, within=None) -> str:
+    """
+    A parse tree back to regex text, every character set intersected with
+    the `within` ranges when given
+    """
+    kind = node[0]
+    if kind == "chars":
+        ranges = node[1].ranges
+        if within is not None:
+            ranges = _complement(_complement(ranges) + _complement(within))
+        if not ranges:
+            return f"[^\\u0000-{chr(0x10FFFF)}]"  # matches nothing
+        return "[" + "".join(_code(lo) if lo == hi else f"{_code(lo)}-{_code(hi)}" for lo, hi in ranges) + "]"
+    if kind == "seq":
+        return "(?:" + "".join(_unparse(item, within) for item in node[1]) + ")"
+    if kind == "alt":
+        return "(?:" + "|".join(_unparse(branch, within) for branch in node[1]) + ")"
+    _, item, lo, hi = node
+    return f"(?:{_unparse(item, within)}){{{lo},{'' if hi is None else hi}}}"
+
+
+def _string(schema: dict) -> str:
+    if "format" in schema and schema["format"] in _FORMATS:
+        return f'"{_FORMATS[schema["format"]]}"'
+    if "pattern" in schema:
+        # The pattern must match the whole value, and may only use characters a JSON string holds unescaped
+        compile_regex(schema["pattern"])
+        return f'"{_unparse(_Parser(schema["pattern"]).parse(), _JSON_TEXT)}"'
+    lo = int(schema.get("minLength", 0))
+    hi = schema.get("maxLength")
+    return f'"{_STRING_CHAR}{{{lo},{"" if hi is None else int(hi)}}}"'
+
+
+def _json_value(depth: int) -> str:
+    """Any JSON value nested at most `depth` levels deep"""
+    scalar = f'(?:"{_STRING_CHAR}*"|{_NUMBER}|true|false|null)'
+    if depth <= 0:
+        return scalar
+    inner = _json_value(depth - 1)
+    member = f'"{_STRING_CHAR}*"{_WS}:{_WS}{inner}'
+    obj = rf"\{{{_WS}(?:{member}(?:{_WS},{_WS}{member})*)?{_WS}\}}"
+    arr = rf"\[{_WS}(?:{inner}(?:{_WS},{_WS}{inner})*)?{_WS}\]"
+    return f"(?:{scalar}|{obj}|{arr})"
+
+
+def _json_object(depth: int = _JSON_DEPTH) -> str:
+    inner = _json_value(depth - 1)
+    member = f'"{_STRING_CHAR}*"{_WS}:{_WS}{inner}'
+    return rf"\{{{_WS}(?:{member}(?:{_WS},{_WS}{member})*)?{_WS}\}}"
+
+
+class _SchemaCompiler:
+    """JSON schema subset -> regex; properties are generated in the order the schema lists them"""
+
+    max_ref_depth = 8
+
+    def __init__(self, root: dict):
+        self.root = root
+        self._refs = 0
+
+    def compile(self, schema) -> str:
+        if schema is True or schema == {}:
+            return _json_value(_JSON_DEPTH)
+        if not isinstance(schema, dict):
+            raise GrammarError("A JSON schema must be an object")
+        if "$ref" in schema:
+            return self._ref(schema["$ref"])
+        if "const" in schema:
+            return _literal(schema["const"])
+        if "enum" in schema:
+            return "(?:" + "|".join(_literal(v) for v in schema["enum"]) + ")"
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                return "(?:" + "|".join(self.compile(s) for s in schema[key]) + ")"
+        if "allOf" in schema:
+            if len(schema["allOf"]) != 1:
+                raise GrammarError("allOf is only supported with a single schema")
+            return self.compile(schema["allOf"][0])
+        kind = schema.get("type")
+        if kind is None:
+            kind = "object" if "properties" in schema else "array" if "items" in schema else None
+        if kind is None:
+            return _json_value(_JSON_DEPTH)
+        if isinstance(kind, list):
+            return "(?:" + "|".join(self.compile({**schema, "type": k}) for k in kind) + ")"
+        if kind == "string":
+            return _string(schema)
+        if kind == "integer":
+            return _INTEGER.removeprefix("-?") if schema.get("minimum", -1) >= 0 else _INTEGER
+        if kind == "number":
+            return _NUMBER
+        if kind == "boolean":
+            return "(?:true|false)"
+        if kind == "null":
+            return "null"
+        if kind == "array":
+            return self._array(schema)
+        if kind == "object":
+            return self._object(schema)
+        raise GrammarError(f"Unsupported JSON schema type {kind!r}")
+
+    def _ref(self, ref: str) -> str:
+        if not isinstance(ref, str) or not ref.startswith("#/"):
+            raise GrammarError(f"Only local $refs are supported, not {ref!r}")
+        self._refs += 1
+        if self._refs > self.max_ref_depth:
+            raise GrammarError("Recursive JSON schemas are not supported")
+        target = self.root
+        for part in ref[2:].split("/"):
+            if not isinstance(target, dict) or part not in target:
+                raise GrammarError(f"Unresolvable $ref {ref!r}")
+            target = target[part]
+        try:
+            return self.compile(target)
+        finally:
+            self._refs -= 1
+
+    def _array(self, schema: dict) -> str:
+        item = self.compile(schema.get("items", {}))
+        lo = int(schema.get("minItems", 0))
+        hi = schema.get("maxItems")
+        if hi is not None and int(hi) == 0:
+            return rf"\[{_WS}\]"
+        more = f"(?:{_WS},{_WS}{item}){{{max(lo - 1, 0)},{'' if hi is None else int(hi) - 1}}}"
+        items = f"{item}{more}"
+        return rf"\[{_WS}{items if lo else f'(?:{items})?'}{_WS}\]"
+
+    def _object(self, schema: dict) -> str:
+        properties = schema.get("properties") or {}
+        if not properties:
+            return _json_object()
+        required = set(schema.get("required", []))
+        members = [
+            (f"{_literal(name)}{_WS}:{_WS}{self.compile(sub)}", name in required)
+            for name, sub in properties.items()
+        ]
+        sep = f"{_WS},{_WS}"
+        if any(req for _, req in members):
+            # Optional members before the first required one carry a trailing comma, later ones a leading comma
+            first = next(i for i, (_, req) in enumerate(members) if req)
+            parts = [f"(?:{m}{sep})?" for m, _ in members[:first]] + [members[first][0]]
+            parts += [f"{sep}{m}" if req else f"(?:{sep}{m})?" for m, req in members[first + 1:]]
+            body = "".join(parts)
+        else:
+            # All optional: one alternative per choice of the first member present
+            alternatives = [
+                m + "".join(f"(?:{sep}{rest})?" for rest, _ in members[i + 1:])
+                for i, (m, _) in enumerate(members)
+            ]
+            body = "(?:" + "|".join(alternatives) + ")?"
+        return rf"\{{{_WS}{body}{_WS}\}}"
+
+
+def schema_to_regex(schema) -> str:
+    """A regex matching JSON documents valid under `schema` (a practical subset of JSON Schema)"""
+    return _SchemaCompiler(schema if isinstance(schema, dict) else {}).compile(schema)
+
+
+def response_format_regex(response_format) -> Optional[str]:
+    """
+    The regex an OpenAI "response_format" constrains the completion to, or None
+    for plain text. Supports {"type": "json_object"}, {"type": "json_schema",
+    "json_schema": {"schema": {...}}} and {"type": "regex", "regex": "..."}.
+    Raises GrammarError for anything it cannot compile; whether the pattern
+    is small enough to constrain a model's vocabulary is checked when that
+    model compiles it (LLMEngine.check_grammar), before the request is queued.
+    """
+    if response_format is None:
+        return None
+    if not isinstance(response_format, dict):
+        raise GrammarError("response_format must be an object")
+    kind = response_format.get("type", "text")
+    if kind == "text":
+        return None
+    if kind == "json_object":
+        pattern = _json_object()
+    elif kind == "json_schema":
+        spec = response_format.get("json_schema")
+        if not isinstance(spec, dict) or not isinstance(spec.get("schema"), dict):
+            raise GrammarError("response_format.json_schema.schema must be a JSON schema object")
+        pattern = schema_to_regex(spec["schema"])
+    elif kind == "regex":
+        pattern = response_format.get("regex")
+    else:
+        raise GrammarError(f"Unsupported response_format type {kind!r}")
+    compile_regex(pattern)
+    return pattern
+
+
+# ===== Token level =====
+class Vocabulary:
+    """Every token's text and a trie over those texts, built once per tokenizer"""
+
+    def __init__(self, tokenizer):
+        special = set(tokenizer.all_special_ids)
+        self.texts: dict[int, str] = {}
+        for token, token_id in tokenizer.get_vocab().items():
+            if token_id in special:
+                continue
+            text = tokenizer.convert_tokens_to_string([token])
+            if token.startswith("▁") and not text.startswith(" "):
+                text = " " + text  # SentencePiece drops the leading space of a lone token
+            if text and "�" not in text:  # skip fragments of multi-byte characters
+                self.texts[token_id] = text
+        # Trie node: (children by character, ids of tokens whose text ends here)
+        self.trie: tuple[dict, list] = ({}, [])
+        for token_id, text in self.texts.items():
+            node = self.trie
+            for ch in text:
+                node = node[0].setdefault(ch, ({}, []))
+            node[1].append(token_id)
+
+
+class TokenAutomaton:
+    """
+    A compiled pattern over a vocabulary. The allowed tokens of every DFA
+    state reachable token by token are found when it is built, on the
+    request thread (raises GrammarError past _MAX_TOKEN_STATES states);
+    from the scheduler thread, masks are then only looked up.
+    """
+
+    def __init__(self, pattern: str, vocabulary: "Vocabulary", eos_token_ids):
+        self.pattern = pattern
+        self.dfa = _DFA(compile_regex(pattern))
+        self.vocabulary = vocabulary
+        self.eos_token_ids = sorted(eos_token_ids)
+        self._allowed: dict[int, object] = {}  # state -> long tensor of allowed ids
+        self._masks: dict[int, object] = {}  # state -> bool tensor of disallowed ids
+        self._compile()
+
+    @property
+    def start(self) -> int:
+        return self.dfa.start
+
+    def _walk(self, state: int) -> tuple[list[int], set[int]]:
+        """Ids of tokens that keep the completion matchable from `state`, and the states they lead to"""
+        dfa = self.dfa
+        ids: list[int] = []
+        targets: set[int] = set()
+        if not dfa.final[state]:
+            stack = [(self.vocabulary.trie[0], state)]
+            while stack:
+                children, current = stack.pop()
+                for ch, (grandchildren, ending) in children.items():
+                    target = dfa.step(current, ch)
+                    if target == DEAD:
+                        continue
+                    if ending:
+                        ids.extend(ending)
+                        targets.add(target)
+                    if grandchildren:
+                        stack.append((grandchildren, target))
+        if dfa.accepting[state] or not ids:
+            ids.extend(self.eos_token_ids)  # with nothing valid left, end rather than emit an invalid token
+        return ids, targets
+
+    def _compile(self) -> None:
+        import torch
+
+        pending = [self.dfa.start]
+        seen = set(pending)
+        while pending:
+            state = pending.pop()
+            ids, targets = self._walk(state)
+            self._allowed[state] = torch.tensor(ids, dtype=torch.long)
+            pending.extend(targets - seen)
+            seen |= targets
+            if len(seen) > _MAX_TOKEN_STATES:
+                raise GrammarError("Pattern is too large to constrain decoding")
+
+    def allowed(self, state: int) -> list[int]:
+        """Ids of tokens that keep the completion matchable from `state`; EOS once it fully matches"""
+        ids = self._allowed.get(state)
+        return ids.tolist() if ids is not None else self._walk(state)[0]
+
+    def advance(self, state: int, token_id: int) -> int:
+        text = self.vocabulary.texts.get(token_id)
+        if text is None or state == DEAD:
+            return DEAD
+        for ch in text:
+            state = self.dfa.step(state, ch)
+            if state == DEAD:
+                break
+        return state
+
+    def disallowed(self, state: int, width: int, device):
+        mask = self._masks.get(state)
+        if mask is None:
+            import torch
+
+            ids = self._allowed.get(state)
+            if ids is None:  # not reachable token by token; only walked here if a caller skips the mask
+                ids = torch.tensor(self._walk(state)[0], dtype=torch.long)
+            mask = torch.ones(width, dtype=torch.bool)
+            mask[ids[ids < width]] = False
+            mask = self._masks[state] = mask.to(device)
+        return mask
+
+    @property
+    def token_states(self) -> int:
+        return len(self._allowed)
+
+    @property
+    def cached_masks(self) -> int:
+        return len(self._masks)
+
+
+class GrammarProcessor:
+    """
+    Per-request logits processor: tracks the automaton state along the
+    generated ids and masks every token that would break the pattern. Called
+    with prefixes that may branch (speculative drafts); states are kept per
+    position so only the new tail is walked.
+    """
+
+    def __init__(self, automaton: TokenAutomaton):
+        self.automaton = automaton
+        self._ids: list[int] = []
+        self._states = [automaton.start]
+
+    def state(self, ids: list[int]) -> int:
+        n = len(self._ids)
+        if ids[:n] != self._ids:
+            n = 0
+            while n < min(len(ids), len(self._ids)) and ids[n] == self._ids[n]:
+                n += 1
+            del self._ids[n:], self._states[n + 1:]
+        for token_id in ids[n:]:
+            self._states.append(self.automaton.advance(self._states[-1], token_id))
+            self._ids.append(token_id)
+        return self._states[-1]
+
+    def __call__(self, ids: list[int], logits):
+        """Mask `logits` (one row, modified in place) for the token that follows `ids`"""
+        state = self.state(ids)
+        if state != DEAD:
+            logits.masked_fill_(self.automaton.disallowed(state, logits.shape[-1], logits.device), float("-inf"))
+        return logits
+
+
+class GrammarCache:
+    """
+    Compiled patterns for one tokenizer, least recently used dropped beyond
+    `max_entries`. The vocabulary trie is built on first use; a pattern's
+    masks are worked out by whichever request thread compiles it first.
+    Patterns that fail to compile are remembered too, so sending one again
+    is rejected without redoing the work.
+    """
+
+    def __init__(self, tokenizer, eos_token_ids, max_entries: int = 64):
+        self.tokenizer = tokenizer
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_entries = max_entries
+        self._vocabulary: Optional[Vocabulary] = None
+        self._automata: OrderedDict[str, TokenAutomaton] = OrderedDict()
+        self._rejected: OrderedDict[str, GrammarError] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def vocabulary(self) -> Vocabulary:
+        with self._lock:
+            if self._vocabulary is None:
+                self._vocabulary = Vocabulary(self.tokenizer)
+            return self._vocabulary
+
+    def automaton(self, pattern: str) -> TokenAutomaton:
+        with self._lock:
+            automaton = self._automata.get(pattern)
+            if automaton is not None:
+                self._automata.move_to_end(pattern)
+                self.hits += 1
+                return automaton
+            error = self._rejected.get(pattern)
+            if error is not None:
+                self._rejected.move_to_end(pattern)
+                raise GrammarError(str(error))
+        try:
+            automaton = TokenAutomaton(pattern, self.vocabulary, self.eos_token_ids)
+        except GrammarError as e:
+            with self._lock:
+                self._rejected[pattern] = e
+                while len(self._rejected) > self.max_entries:
+                    self._rejected.popitem(last=False)
+            raise
+        with self._lock:
+            self.misses += 1
+            automaton = self._automata.setdefault(pattern, automaton)
+            while len(self._automata) > self.max_entries:
+                self._automata.popitem(last=False)
+        return automaton
+
+    def processor(self, pattern: str) -> GrammarProcessor:
+        return GrammarProcessor(self.automaton(pattern))
+
+    def stats(self) -> dict:
+        with self._lock:
+            automata = list(self._automata.values())
+        return {
+            "compiled": len(automata),
+            "rejected": len(self._rejected),
+            "hits": self.hits,
+            "misses": self.misses,
+            "dfa_states": sum(len(a.dfa) for a in automata),
+            "token_states": sum(a.token_states for a in automata),
+            "cached_masks": sum(a.cached_masks for a in automata),
+        }
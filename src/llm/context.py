@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from src.llm import metrics
+
+log = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "last_n", "summarize")
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+
+class ContextOverflow(ValueError):
+    """The system prompt and the latest user message alone do not fit the context budget."""
+
+
+class TokenCounter:
+    """Token counts per text, cached (LRU) so each message is tokenized once however many turns it is sent in."""
+
+    def __init__(self, tokenizer, max_entries: int = 8192):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            n = self._counts.get(text)
+            if n is not None:
+                self._counts.move_to_end(text)
+                self.hits += 1
+                return n
+        n = len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+        with self._lock:
+            self.misses += 1
+            self._counts[text] = n
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return n
+
+
+class ContextManager:
+    """
+    Fits a conversation into the model's context, leaving room for the reply.
+
+    The budget is `context_tokens - max_new_tokens`. Message sizes come from a
+    TokenCounter plus the chat template's per-turn overhead (measured once),
+    so fitting a long history costs dictionary lookups, not tokenization.
+    Policies, applied to the (user, assistant) history:
+
+    - "drop_oldest": drop the oldest turns until the prompt fits
+    - "last_n": keep only the last `keep_turns` turns, then drop as above
+    - "summarize": fold the dropped turns into a short summary, generated by
+      `summarize(turns)` and appended to the system prompt; summaries are
+      cached by the turns they cover
+
+    The system prompt and the latest user message are always kept.
+    """
+
+    def __init__(
+        self,
+        count: TokenCounter,
+        build_prompt: Callable[[str, list, str], str],
+        context_tokens: int,
+        policy: str = "drop_oldest",
+        keep_turns: int = 8,
+        summary_tokens: int = 128,
+        summarize: Optional[Callable[[list[tuple[str, str]]], str]] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown context policy '{policy}' (expected one of {', '.join(POLICIES)})")
+        self.count = count
+        self.context_tokens = context_tokens
+        self.policy = policy
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self._summarize = summarize
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+        self.truncated = 0
+        self.summaries_generated = 0
+        # Template cost of an empty prompt, and of each extra (user, assistant) turn
+        self.base_tokens = count(build_prompt("", [], ""))
+        self.turn_tokens = count(build_prompt("", [("", "")], "")) - self.base_tokens
+
+    def budget(self, max_new_tokens: int) -> int:
+        return self.context_tokens - max_new_tokens
+
+    def max_turns(self, max_new_tokens: int) -> Optional[int]:
+        """
+        The most history turns `fit` can keep, so callers need only read that
+        many; None when it needs them all (summaries cover the dropped turns)
+        """
+        if self.policy == "summarize" and self._summarize is not None:
+            return None
+        limit = max(self.budget(max_new_tokens), 0) // max(self.turn_tokens, 1)  # every turn costs its template
+        return min(limit, max(self.keep_turns, 0)) if self.policy == "last_n" else limit
+
+    def fit(
+        self, system_prompt: str, history: list[tuple[str, str]], user_msg: str, max_new_tokens: int
+    ) -> tuple[str, list[tuple[str, str]]]:
+        """Return (system_prompt, history) trimmed by the policy so the prompt fits the budget"""
+        budget = self.budget(max_new_tokens)
+        fixed = self.base_tokens + self.count(system_prompt) + self.count(user_msg)
+        if fixed > budget:
+            raise ContextOverflow(
+                f"Prompt needs at least {fixed} tokens but only {budget} fit in the {self.context_tokens}-token "
+                f"context with max_tokens={max_new_tokens}"
+            )
+
+        turns = list(history)
+        if self.policy == "last_n":
+            turns = turns[-self.keep_turns:] if self.keep_turns > 0 else []
+        costs = [self.turn_tokens + self.count(u) + self.count(a) for u, a in turns]
+        total = fixed + sum(costs)
+        if total <= budget:
+            if len(turns) < len(history):
+                self._record_truncation()
+            return system_prompt, turns
+
+        summarizing = self.policy == "summarize" and self._summarize is not None
+        reserve = self.summary_tokens + self.count(SUMMARY_HEADER) + 2 if summarizing else 0
+        drop = 0
+        while drop < len(turns) and total + reserve > budget:
+            total -= costs[drop]
+            drop += 1
+        self._record_truncation()
+        if summarizing and total + reserve <= budget:
+            system_prompt = f"{system_prompt}\n\n{SUMMARY_HEADER}\n{self.summary(turns[:drop])}"
+        return system_prompt, turns[drop:]
+
+    def summary(self, turns: list[tuple[str, str]]) -> str:
+        key = hashlib.sha256(json.dumps(turns).encode()).hexdigest()
+        cached = self._summaries.get(key)
+        if cached is not None:
+            self._summaries.move_to_end(key)
+            return cached
+        text = self._summarize(turns)
+        self.summaries_generated += 1
+        self._summaries[key] = text
+        if len(self._summaries) > 256:
+            self._summaries.popitem(last=False)
+        return text
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "context_tokens": self.context_tokens,
+            "truncated_prompts": self.truncated,
+            "summaries_generated": self.summaries_generated,
+            "token_count_hits": self.count.hits,
+            "token_count_misses": self.count.misses,
+        }
+
+    def _record_truncation(self) -> None:
+        self.truncated += 1
+        metrics.CONTEXT_TRUNCATIONS.inc()
@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+POOLINGS = ("mean", "last")
+
+
+class EmbeddingCache:
+    """
+    LRU of embedding vectors (float32 bytes) and their token counts, keyed by
+    a hash of the pooling mode and text, bounded by `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[bytes, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, pooling: str) -> str:
+        return hashlib.sha256(f"{pooling}\0{text}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[bytes, int]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, vector: bytes, n_tokens: int) -> None:
+        if len(vector) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (vector, n_tokens)
+            self._bytes += len(vector)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def embed_padded(model, sequences: list[list[int]], pooling: str, batch_size: int,
+                 pad_token_id: int = 0) -> list[bytes]:
+    """
+    Pooled, L2-normalized final hidden states for each token sequence, as
+    float32 bytes. Sequences are sorted by length and run `batch_size` at a
+    time (right-padded), one forward pass of the base model per bucket.
+    Call on the thread that owns the model.
+    """
+    import torch
+
+    base = model.base_model  # hidden states only: skips the vocabulary projection
+    order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+    vectors: list[Optional[bytes]] = [None] * len(sequences)
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        width = max(len(sequences[i]) for i in bucket)
+        input_ids = torch.tensor(
+            [sequences[i] + [pad_token_id] * (width - len(sequences[i])) for i in bucket], device=model.device
+        )
+        lengths = torch.tensor([len(sequences[i]) for i in bucket], device=model.device)
+        mask = (torch.arange(width, device=model.device).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        hidden = base(input_ids=input_ids, attention_mask=mask).last_hidden_state.float()
+        if pooling == "last":
+            pooled = hidden[torch.arange(len(bucket), device=hidden.device), lengths - 1]
+        else:
+            pooled = (hidden * mask.unsqueeze(-1)).sum(dim=1) / lengths.unsqueeze(1)
+        pooled = torch.nn.functional.normalize(pooled, dim=-1).cpu()
+        for i, row in zip(bucket, pooled):
+            vectors[i] = row.numpy().astype("<f4").tobytes()
+    return vectors
+
+
+def decode_vector(vector: bytes, encoding_format: str = "float"):
+    """An embedding in the response's encoding: a list of floats, or base64 of the little-endian float32 bytes"""
+    if encoding_format == "base64":
+        return base64.b64encode(vector).decode()
+    import numpy as np
+
+    return np.frombuffer(vector, dtype="<f4").tolist()
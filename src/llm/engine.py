@@ -1,10 +1,30 @@
+import asyncio
+import contextlib
+import functools
+import gc
 import logging
-from typing import Iterator, Optional
-
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+import os
+import re
+import shutil
+import threading
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Optional
 
 from src.config import Config
+from src.llm import metrics
+from src.llm.constrained import GrammarCache
+from src.llm.context import ContextManager, ContextOverflow, TokenCounter
+from src.llm.embeddings import POOLINGS, EmbeddingCache
+from src.llm.kv_cache import ConversationCache
+from src.llm.prefix_cache import PrefixCache
+from src.llm.response_cache import ResponseCache, response_key
+from src.llm.tracing import SamplingProfiler, Trace, span
+
+# torch, transformers and the schedulers are imported by load(): importing this
+# module (GUI startup, the servers answering /health while loading) stays fast.
+if TYPE_CHECKING:
+    from src.llm.scheduler import BatchScheduler, GenerationRequest
+    from src.llm.streamer import IncrementalDetokenizer
 
 log = logging.getLogger(__name__)
 
@@ -13,16 +33,52 @@ class LLMEngine:
         self.cfg = cfg
         self.tokenizer = None
         self.model = None
+        self.draft_model = None
+        self.scheduler: Optional["BatchScheduler"] = None
+        self.context: Optional[ContextManager] = None
+        self.grammars: Optional[GrammarCache] = None
+        self.progress = LoadProgress()
+        self.conversation_cache = ConversationCache(max_bytes=cfg.kv_cache_mb * 1024 * 1024)
+        self.prefix_cache = PrefixCache(max_bytes=cfg.prefix_cache_mb * 1024 * 1024, block_size=cfg.prefix_block_size)
+        self.response_cache = ResponseCache(
+            max_bytes=cfg.response_cache_mb * 1024 * 1024,
+            # One subdirectory per model and precision, so each engine's disk budget covers only its own files
+            disk_dir=cfg.response_cache_dir and os.path.join(cfg.response_cache_dir, self._cache_name(cfg.model_id)),
+            disk_max_bytes=cfg.response_cache_disk_mb * 1024 * 1024,
+        )
+        self.embedding_cache = EmbeddingCache(max_bytes=cfg.embedding_cache_mb * 1024 * 1024)
 
     def load(self) -> None:
+        self.progress = LoadProgress()
+        try:
+            self._load()
+        except BaseException as e:
+            self.progress.fail(e)
+            raise
+        self.progress.finish()
+        log.info(f"Model loaded in {self.progress.elapsed_s:.1f}s {self.progress.timings}")
+
+    def _load(self) -> None:
+        with self.progress.stage("imports"):
+            import torch
+            from transformers import AutoTokenizer
+            from src.llm.scheduler import BatchScheduler
+            from src.llm.speculative import SpeculativeScheduler
+
         log.info(f"Loading model: {self.cfg.model_id} (precision={self.cfg.precision})")
         torch_dtype = None
         load_kwargs = {"device_map": self.cfg.device_map}
+        self._set_cpu_threads()
 
         if self.cfg.precision.lower() == "fp16":
             torch_dtype = torch.float16
         elif self.cfg.precision.lower() == "auto":
             torch_dtype = "auto"
+        elif self.cfg.precision.lower() in ("fp32", "cpu-int8"):
+            # cpu-int8: fp32 weights, Linear layers quantized after loading (see _from_pretrained)
+            torch_dtype = torch.float32
+            if self.cfg.precision.lower() == "cpu-int8":
+                load_kwargs["device_map"] = "cpu"
 
         # 4-bit quant (Linux + bitsandbytes)
         if self.cfg.precision.lower() == "int4":
@@ -35,13 +91,140 @@ class LLMEngine:
                 )
             )
 
-        self.tokenizer = AutoTokenizer.from_pretrained(self.cfg.model_id, use_fast=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.cfg.model_id,
-            torch_dtype=torch_dtype,
-            **load_kwargs,
+        with self.progress.stage("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(self.cfg.model_id, use_fast=True)
+        with self.progress.stage("weights"):
+            self.model = self._from_pretrained(self.cfg.model_id, torch_dtype, load_kwargs)
+        self.context = self._context_manager(self.model.config)
+        scheduler_kwargs = dict(
+            max_batch_size=self.cfg.max_batch_size,
+            conversation_cache=self.conversation_cache,
+            prefix_cache=self.prefix_cache,
         )
-        log.info("Model loaded.")
+        if self.cfg.draft_model_id:
+            with self.progress.stage("draft"):
+                self._load_draft(torch_dtype, load_kwargs)
+            self.scheduler = SpeculativeScheduler(
+                self.model,
+                self.tokenizer,
+                self.draft_model,
+                num_speculative_tokens=self.cfg.num_speculative_tokens,
+                **scheduler_kwargs,
+            )
+        else:
+            self.scheduler = BatchScheduler(self.model, self.tokenizer, **scheduler_kwargs)
+        self.grammars = GrammarCache(self.tokenizer, self.scheduler.eos_token_ids, max_entries=self.cfg.grammar_cache_size)
+        with self.progress.stage("scheduler"):
+            self.scheduler.start()
+
+    def _context_manager(self, model_config) -> ContextManager:
+        return ContextManager(
+            TokenCounter(self.tokenizer),
+            self._build_prompt,
+            self.cfg.context_tokens or getattr(model_config, "max_position_embeddings", None) or 4096,
+            policy=self.cfg.context_policy,
+            keep_turns=self.cfg.context_keep_turns,
+            summary_tokens=self.cfg.context_summary_tokens,
+            summarize=self._summarize,
+        )
+
+    def unload(self) -> None:
+        """Stop the scheduler and free weights and KV caches now rather than whenever GC gets to them."""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+        self.conversation_cache.clear()
+        self.prefix_cache.clear()
+        self.embedding_cache.clear()
+        self.grammars = None
+        self.model = self.draft_model = None
+        gc.collect()
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        log.info(f"Model unloaded: {self.cfg.model_id}")
+
+    @property
+    def model_bytes(self) -> int:
+        """Memory held by the loaded weights (main and draft model)."""
+        return sum(_footprint(m) for m in (self.model, self.draft_model) if m is not None)
+
+    def _load_draft(self, torch_dtype, load_kwargs: dict) -> None:
+        from transformers import AutoTokenizer
+
+        log.info(f"Loading draft model: {self.cfg.draft_model_id}")
+        draft_tokenizer = AutoTokenizer.from_pretrained(self.cfg.draft_model_id, use_fast=True)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(
+                f"Draft model {self.cfg.draft_model_id} does not share the tokenizer of {self.cfg.model_id}"
+            )
+        self.draft_model = self._from_pretrained(self.cfg.draft_model_id, torch_dtype, load_kwargs)
+
+    def _from_pretrained(self, model_id: str, torch_dtype, load_kwargs: dict):
+        """
+        Load weights for `model_id`. With WEIGHT_CACHE_DIR set, the first load
+        also saves the converted (or quantized) model there as safetensors;
+        later loads map that copy instead of converting again.
+        """
+        from transformers import AutoModelForCausalLM
+
+        path = self._weight_cache_path(model_id)
+        if path and os.path.isdir(path):
+            log.info(f"Mapping cached weights from {path}")
+            self.progress.weight_cache = "hit"
+            # dtype and quantization settings are recorded in the saved config
+            model = AutoModelForCausalLM.from_pretrained(
+                path, torch_dtype="auto", device_map=load_kwargs["device_map"]
+            )
+        else:
+            model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch_dtype, **load_kwargs)
+            if path:
+                self.progress.weight_cache = "miss"
+                self._save_weight_cache(model, path)
+        model.eval()
+        if self.cfg.precision.lower() == "cpu-int8":
+            with self.progress.stage("quantize"):
+                model = _quantize_int8(model)
+        if self.cfg.torch_compile:
+            import torch
+
+            # Shapes change every step (batch size, KV length); compile once for all of them
+            model.forward = torch.compile(model.forward, dynamic=True)
+        return model
+
+    def _set_cpu_threads(self) -> None:
+        """Pin torch's intra-op (CPU_THREADS) and inter-op (CPU_INTEROP_THREADS) thread pools, when set"""
+        import torch
+
+        if self.cfg.cpu_threads > 0:
+            torch.set_num_threads(self.cfg.cpu_threads)
+        if self.cfg.cpu_interop_threads > 0 and torch.get_num_interop_threads() != self.cfg.cpu_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.cfg.cpu_interop_threads)
+            except RuntimeError as e:  # only settable before the first parallel op in the process
+                log.warning(f"Could not set inter-op threads to {self.cfg.cpu_interop_threads}: {e}")
+
+    def _cache_name(self, model_id: str) -> str:
+        """Directory name for files derived from `model_id` at this precision"""
+        name = re.sub(r"[^\w.-]+", "--", model_id.strip("/"))
+        return f"{name}-{self.cfg.precision.lower()}"
+
+    def _weight_cache_path(self, model_id: str) -> Optional[str]:
+        if not self.cfg.weight_cache_dir:
+            return None
+        return os.path.join(self.cfg.weight_cache_dir, self._cache_name(model_id))
+
+    def _save_weight_cache(self, model, path: str) -> None:
+        tmp = f"{path}.tmp-{os.getpid()}"
+        try:
+            with self.progress.stage("weight_cache_write"):
+                model.save_pretrained(tmp, safe_serialization=True)
+                os.replace(tmp, path)  # readers never see a half-written copy
+            log.info(f"Saved weight cache to {path}")
+        except Exception as e:
+            log.warning(f"Could not write weight cache {path}: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
 
     def _build_prompt(self, system: str, history: list[tuple[str, str]], user_msg: str) -> str:
         """
@@ -64,7 +247,38 @@ class LLMEngine:
         prompt += f"<user>\n{user_msg}\n</user>\n<assistant>\n"
         return prompt
 
-    def generate_stream(
+    def response_cache_key(
+        self,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        user_msg: str,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        ignore_eos: bool = False,
+        grammar: Optional[str] = None,
+    ) -> Optional[str]:
+        """Response-cache key for this request, or None if it is not deterministic (or caching is off)."""
+        temperature = self.cfg.temperature if temperature is None else temperature
+        if temperature > 0 or not self.response_cache.enabled:
+            return None
+        constraint = {"grammar": grammar} if grammar else {}
+        return response_key(
+            self.cfg.model_id, system_prompt, history, user_msg,
+            settings=self._response_settings(),
+            max_new_tokens=max_new_tokens or self.cfg.max_new_tokens, ignore_eos=ignore_eos, **constraint,
+        )
+
+    def _response_settings(self) -> dict:
+        """Server settings that change what a prompt generates: the precision and how the context is fitted"""
+        return {
+            "precision": self.cfg.precision.lower(),
+            "context_tokens": self.context.context_tokens if self.context else self.cfg.context_tokens,
+            "context_policy": self.cfg.context_policy,
+            "context_keep_turns": self.cfg.context_keep_turns,
+            "context_summary_tokens": self.cfg.context_summary_tokens,
+        }
+
+    def _submit(
         self,
         system_prompt: str,
         history: list[tuple[str, str]],
@@ -72,33 +286,642 @@ class LLMEngine:
         max_new_tokens: Optional[int] = None,
         temperature: Optional[float] = None,
         top_p: Optional[float] = None,
-    ) -> Iterator[str]:
-        """
-        Token-by-token streaming generation using TextIteratorStreamer.
-        """
+        conversation_id: Optional[str] = None,
+        ignore_eos: bool = False,
+        output=None,
+        cancel_token: Optional[threading.Event] = None,
+        trace: Optional[Trace] = None,
+        grammar: Optional[str] = None,
+        n: int = 1,
+    ) -> "GenerationRequest":
+        """Queue one request; with n > 1, `output` is a ChoiceQueue and the other n - 1 samples are its forks"""
+        from src.llm.scheduler import GenerationRequest
+
         max_new_tokens = max_new_tokens or self.cfg.max_new_tokens
         temperature = self.cfg.temperature if temperature is None else temperature
         top_p = self.cfg.top_p if top_p is None else top_p
 
-        prompt = self._build_prompt(system_prompt, history, user_msg)
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-
-        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-
-        gen_kwargs = dict(
-            **inputs,
-            streamer=streamer,
+        input_ids = self.encode_prompt(system_prompt, history, user_msg, max_new_tokens, trace=trace)
+        request = GenerationRequest(
+            input_ids=input_ids,
             max_new_tokens=max_new_tokens,
-            do_sample=True,
             temperature=temperature,
             top_p=top_p,
+            cache_key=conversation_id,
+            ignore_eos=ignore_eos,
+            trace=trace,
+            grammar=grammar,
+            logits_processor=self._logits_processor(grammar),
+        )
+        if cancel_token is not None:
+            request.cancel_token = cancel_token
+        if n > 1:
+            request.forks = [
+                GenerationRequest(
+                    input_ids=input_ids,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    ignore_eos=ignore_eos,
+                    grammar=grammar,
+                    logits_processor=self._logits_processor(grammar),
+                    cancel_token=request.cancel_token,
+                    output=output.view(i),
+                )
+                for i in range(1, n)
+            ]
+            request.output = output.view(0)
+        elif output is not None:
+            request.output = output
+        return self.scheduler.submit(request)
+
+    def check_grammar(self, grammar: str) -> None:
+        """
+        Compile `grammar` for this model's vocabulary (cached for the requests
+        that use it); raises GrammarError if it cannot constrain decoding
+        """
+        self.grammars.automaton(grammar)
+
+    def _logits_processor(self, grammar: Optional[str]):
+        """Masks logits so the completion keeps matching `grammar` (see src/llm/constrained.py)"""
+        return self.grammars.processor(grammar) if grammar else None
+
+    def encode_prompt(
+        self, system_prompt: str, history: list[tuple[str, str]], user_msg: str, max_new_tokens: int,
+        trace: Optional[Trace] = None,
+    ) -> list[int]:
+        """Token ids of the prompt, with history trimmed by the context policy to leave room for the reply"""
+        t0 = time.perf_counter()
+        with span(trace, "context_fit", turns=len(history)):
+            system_prompt, history = self.context.fit(system_prompt, history, user_msg, max_new_tokens)
+        with span(trace, "template"):
+            prompt = self._build_prompt(system_prompt, history, user_msg)
+        with span(trace, "tokenize"):
+            input_ids = self.tokenizer(prompt)["input_ids"]
+        # fit() works from per-message estimates; the tokenized prompt has the final say
+        budget = self.context.budget(max_new_tokens)
+        while len(input_ids) > budget and history:
+            history = history[1:]
+            with span(trace, "retokenize"):
+                input_ids = self.tokenizer(self._build_prompt(system_prompt, history, user_msg))["input_ids"]
+        if len(input_ids) > budget:
+            raise ContextOverflow(f"Prompt is {len(input_ids)} tokens; only {budget} fit with max_tokens={max_new_tokens}")
+        metrics.TOKENIZE.observe(time.perf_counter() - t0)
+        return input_ids
+
+    def generate_batch(
+        self, prompts: list[list[int]], max_new_tokens: int, temperature: float, top_p: float
+    ) -> list[tuple[list[int], str]]:
+        """
+        Generate for several encoded prompts (offline jobs, see src/llm/batch.py);
+        returns (generated ids, finish reason) per prompt. They are queued on the
+        batch scheduler like any other request, at most a full batch at a time,
+        so live streams keep decoding alongside them and new requests still find
+        room as soon as a row retires.
+        """
+        from src.llm.scheduler import ChoiceQueue, GenerationRequest
+
+        results = ChoiceQueue(len(prompts))
+        requests = [
+            GenerationRequest(
+                input_ids=prompt, max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+                output=results.view(i),
+            )
+            for i, prompt in enumerate(prompts)
+        ]
+        window = self.cfg.max_batch_size * max(1, self.cfg.replicas)
+        for request in requests[:window]:
+            self.scheduler.submit(request)
+        queued = min(window, len(requests))
+        try:
+            for _, token in results:
+                if token is None and queued < len(requests):  # one finished: queue the next
+                    self.scheduler.submit(requests[queued])
+                    queued += 1
+        except BaseException:
+            for request in requests:
+                request.cancel()
+            raise
+        return [(r.generated_ids, r.finish_reason) for r in requests]
+
+    def embed(self, texts: list[str], pooling: Optional[str] = None) -> tuple[list[bytes], int]:
+        """
+        Embedding vectors (normalized float32 bytes, see src/llm/embeddings.py)
+        for `texts`, and the number of input tokens. Texts in the embedding
+        cache are not recomputed; the rest are tokenized in one call and
+        embedded in length-sorted buckets on the scheduler thread.
+        """
+        pooling = pooling or self.cfg.embedding_pooling
+        if pooling not in POOLINGS:
+            raise ValueError(f"Unknown pooling '{pooling}' (expected one of {', '.join(POOLINGS)})")
+        if any(not isinstance(t, str) or not t for t in texts):
+            raise ValueError("Every input must be a non-empty string")
+
+        vectors: list[Optional[bytes]] = [None] * len(texts)
+        tokens = [0] * len(texts)
+        missing: dict[str, list[int]] = {}  # text -> positions, so repeats are embedded once
+        for i, text in enumerate(texts):
+            cached = self.embedding_cache.get(EmbeddingCache.key(text, pooling))
+            if cached is not None:
+                vectors[i], tokens[i] = cached
+            else:
+                missing.setdefault(text, []).append(i)
+
+        if missing:
+            pending = list(missing)
+            encoded = self.tokenizer(pending, truncation=True, max_length=self.context.context_tokens)["input_ids"]
+            computed = self._embed_encoded(encoded, pooling)
+            for text, ids, vector in zip(pending, encoded, computed):
+                self.embedding_cache.put(EmbeddingCache.key(text, pooling), vector, len(ids))
+                for i in missing[text]:
+                    vectors[i], tokens[i] = vector, len(ids)
+        return vectors, sum(tokens)
+
+    def _embed_encoded(self, encoded: list[list[int]], pooling: str) -> list[bytes]:
+        from src.llm.embeddings import embed_padded
+
+        return self.scheduler.run_exclusive(functools.partial(
+            embed_padded, self.model, encoded, pooling, self.cfg.embedding_batch_size,
+            pad_token_id=self.tokenizer.pad_token_id or 0,
+        ))
+
+    def _summarize(self, turns: list[tuple[str, str]]) -> str:
+        """Summarize turns dropped from the context (CONTEXT_POLICY=summarize), most recent ones first to fit"""
+        instructions = "Summarize this conversation in a few sentences. Keep names, facts and decisions."
+        room = self.context.budget(self.cfg.context_summary_tokens) - self.context.base_tokens - self.context.count(instructions)
+        lines = []
+        for u, a in reversed(turns):
+            line = f"User: {u}\nAssistant: {a}"
+            room -= self.context.count(line) + 1
+            if room < 0:
+                break
+            lines.insert(0, line)
+        if not lines:
+            return ""
+        stream = self.generate_stream(
+            instructions, [], "\n".join(lines), max_new_tokens=self.cfg.context_summary_tokens, temperature=0
+        )
+        return "".join(stream).strip()
+
+    def generate_stream(
+        self,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        user_msg: str,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        conversation_id: Optional[str] = None,
+        ignore_eos: bool = False,
+        trace: Optional[Trace] = None,
+        grammar: Optional[str] = None,
+    ) -> "TextStream":
+        """
+        Token-by-token streaming generation. The request is queued on the batch
+        scheduler; sampled ids are decoded here, on the caller's thread.
+
+        Passing the same `conversation_id` on every turn lets the scheduler reuse
+        the previous turn's KV cache and prefill only the new tokens.
+        `ignore_eos` keeps generating to `max_new_tokens` (used for benchmarking).
+        Call `cancel()` (from any thread), or close the stream, to stop generation
+        within one decode step. With a `trace`, every stage of the request is
+        recorded into it (see src/llm/tracing.py). A `grammar` (regex, see
+        src/llm/constrained.py) restricts sampling so the completion matches it.
+        """
+        stream = TextStream()
+        stream._chunks = self._stream_chunks(stream, dict(
+            system_prompt=system_prompt, history=history, user_msg=user_msg,
+            max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+            conversation_id=conversation_id, ignore_eos=ignore_eos, trace=trace, grammar=grammar,
+        ))
+        return stream
+
+    def _stream_chunks(self, stream: "TextStream", options: dict) -> Iterator[str]:
+
+        clock = metrics.RequestClock()
+        trace = options["trace"]
+        profiler = self._start_profiler(trace)
+        try:
+            stream.request = self._submit(**options, cancel_token=stream.cancel_token)
+            yield  # start() runs up to here
+            streamer = self._detokenizer()
+            for n, token_id in enumerate(stream.request):
+                clock.tick()
+                if trace is not None:
+                    trace.complete("handoff", stream.request.emitted_at[n], time.perf_counter())
+                with span(trace, "detokenize"):
+                    streamer.put_token(token_id)
+                    chunks = streamer.drain()
+                yield from chunks
+            streamer.end()
+            yield from streamer.drain()
+        finally:
+            stream.cancel()  # no-op if finished; frees the batch slot if the consumer went away
+            clock.finish(stream.request)
+            self._finish_trace(trace, stream, clock, profiler)
+
+    def agenerate_stream(
+        self,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        user_msg: str,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        conversation_id: Optional[str] = None,
+        ignore_eos: bool = False,
+        trace: Optional[Trace] = None,
+        grammar: Optional[str] = None,
+    ) -> "AsyncTextStream":
+        """
+        Async variant of generate_stream: tokens arrive over an asyncio channel,
+        so awaiting them never blocks the event loop or ties up a thread.
+        """
+        stream = AsyncTextStream()
+        stream._chunks = self._astream_chunks(stream, dict(
+            system_prompt=system_prompt, history=history, user_msg=user_msg,
+            max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+            conversation_id=conversation_id, ignore_eos=ignore_eos, trace=trace, grammar=grammar,
+        ))
+        return stream
+
+    async def _astream_chunks(self, stream: "AsyncTextStream", options: dict) -> AsyncIterator[str]:
+        from src.llm.scheduler import AsyncTokenQueue
+
+        clock = metrics.RequestClock()
+        trace = options["trace"]
+        profiler = self._start_profiler(trace)
+        try:
+            submit = functools.partial(self._submit, **options, output=AsyncTokenQueue(), cancel_token=stream.cancel_token)
+            # Summarizing dropped turns runs a generation, and compiling a new grammar walks the
+            # vocabulary once per state; keep both off the event loop
+            blocking = options["grammar"] or (self.context is not None and self.context.policy == "summarize")
+            stream.request = await asyncio.to_thread(submit) if blocking else submit()
+            yield  # start() runs up to here
+            streamer = self._detokenizer()
+            n = 0
+            async for token_id in stream.request:
+                clock.tick()
+                if trace is not None:
+                    trace.complete("handoff", stream.request.emitted_at[n], time.perf_counter())
+                n += 1
+                with span(trace, "detokenize"):
+                    streamer.put_token(token_id)
+                    chunks = streamer.drain()
+                for chunk in chunks:
+                    yield chunk
+            streamer.end()
+            for chunk in streamer.drain():
+                yield chunk
+        finally:
+            stream.cancel()  # no-op if finished; frees the batch slot if the consumer went away
+            clock.finish(stream.request)
+            self._finish_trace(trace, stream, clock, profiler)
+
+    def generate_choices(
+        self,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        user_msg: str,
+        n: int,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        conversation_id: Optional[str] = None,
+        ignore_eos: bool = False,
+        trace: Optional[Trace] = None,
+        grammar: Optional[str] = None,
+    ) -> "ChoiceStream":
+        """
+        `n` samples of one prompt (OpenAI's "n"): the prompt is prefilled once
+        and its KV forked into n rows decoded in the same batch. Iterating
+        yields (choice index, text chunk) as each choice produces text.
+        """
+        stream = ChoiceStream(n)
+        stream._chunks = self._choice_chunks(stream, dict(
+            system_prompt=system_prompt, history=history, user_msg=user_msg,
+            max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+            conversation_id=conversation_id, ignore_eos=ignore_eos, trace=trace, grammar=grammar, n=n,
+        ))
+        return stream
+
+    def _choice_chunks(self, stream: "ChoiceStream", options: dict) -> Iterator[tuple[int, str]]:
+        from src.llm.scheduler import ChoiceQueue
+
+        clock = metrics.RequestClock()
+        trace = options["trace"]
+        profiler = self._start_profiler(trace)
+        try:
+            choices = ChoiceQueue(options["n"])
+            stream.request = self._submit(**options, output=choices, cancel_token=stream.cancel_token)
+            yield  # start() runs up to here
+            streamers = [self._detokenizer() for _ in range(choices.n)]
+            for index, token_id in choices:
+                with span(trace, "detokenize", choice=index):
+                    chunks = self._put_choice(clock, streamers[index], token_id)
+                for chunk in chunks:
+                    yield index, chunk
+        finally:
+            stream.cancel()
+            self._finish_choices(stream, clock)
+            self._finish_trace(trace, stream, clock, profiler)
+
+    def agenerate_choices(
+        self,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        user_msg: str,
+        n: int,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        conversation_id: Optional[str] = None,
+        ignore_eos: bool = False,
+        trace: Optional[Trace] = None,
+        grammar: Optional[str] = None,
+    ) -> "AsyncChoiceStream":
+        """Async variant of generate_choices"""
+        stream = AsyncChoiceStream(n)
+        stream._chunks = self._achoice_chunks(stream, dict(
+            system_prompt=system_prompt, history=history, user_msg=user_msg,
+            max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p,
+            conversation_id=conversation_id, ignore_eos=ignore_eos, trace=trace, grammar=grammar, n=n,
+        ))
+        return stream
+
+    async def _achoice_chunks(self, stream: "AsyncChoiceStream", options: dict) -> AsyncIterator[tuple[int, str]]:
+        from src.llm.scheduler import AsyncTokenQueue, ChoiceQueue
+
+        clock = metrics.RequestClock()
+        trace = options["trace"]
+        profiler = self._start_profiler(trace)
+        try:
+            choices = ChoiceQueue(options["n"], AsyncTokenQueue())
+            submit = functools.partial(self._submit, **options, output=choices, cancel_token=stream.cancel_token)
+            blocking = options["grammar"] or (self.context is not None and self.context.policy == "summarize")
+            stream.request = await asyncio.to_thread(submit) if blocking else submit()
+            yield  # start() runs up to here
+            streamers = [self._detokenizer() for _ in range(choices.n)]
+            async for index, token_id in choices:
+                with span(trace, "detokenize", choice=index):
+                    chunks = self._put_choice(clock, streamers[index], token_id)
+                for chunk in chunks:
+                    yield index, chunk
+        finally:
+            stream.cancel()
+            self._finish_choices(stream, clock)
+            self._finish_trace(trace, stream, clock, profiler)
+
+    @staticmethod
+    def _put_choice(clock: metrics.RequestClock, streamer, token_id: Optional[int]) -> list[str]:
+        """Feed one choice's next token (None: the choice ended) to its streamer; returns the text now ready"""
+        if token_id is None:
+            streamer.end()
+        else:
+            clock.tick()
+            streamer.put_token(token_id)
+        return streamer.drain()
+
+    @staticmethod
+    def _finish_choices(stream: "ChoiceStream", clock: metrics.RequestClock) -> None:
+        clock.finish(stream.request)
+        if stream.request is not None:
+            metrics.COMPLETION_TOKENS.inc(sum(f.completion_tokens for f in stream.request.forks))
+
+    def _detokenizer(self) -> "IncrementalDetokenizer":
+        """Per-stream token -> text decoder, flushing every STREAM_CHUNK_TOKENS tokens or STREAM_CHUNK_MS"""
+        from src.llm.streamer import IncrementalDetokenizer
+
+        return IncrementalDetokenizer(
+            self.tokenizer, skip_special_tokens=True,
+            every_tokens=self.cfg.stream_chunk_tokens, every_ms=self.cfg.stream_chunk_ms,
         )
 
-        # Kick off generation in background (we'll iterate streamer)
-        import threading
-        thread = threading.Thread(target=self.model.generate, kwargs=gen_kwargs)
-        thread.start()
+    def _start_profiler(self, trace: Optional[Trace]) -> Optional[SamplingProfiler]:
+        """Sample the decode loop's stack into `trace` while the request runs, if it asked for profiling"""
+        if trace is None or trace.profile_interval_s <= 0 or self.scheduler is None or self.scheduler.thread is None:
+            return None
+        return SamplingProfiler(trace, self.scheduler.thread, trace.profile_interval_s).start()
+
+    @staticmethod
+    def _finish_trace(trace: Optional[Trace], stream: "_Stream", clock: metrics.RequestClock,
+                      profiler: Optional[SamplingProfiler]) -> None:
+        if trace is None:
+            return
+        if profiler is not None:
+            profiler.stop()
+        trace.complete("generate", clock.started, time.perf_counter(), finish_reason=stream.finish_reason, **stream.usage)
+
+    def stats(self) -> dict:
+        """Cache and speculative-decoding statistics for /health."""
+        return {
+            "prefix_cache": self.prefix_cache.stats(),
+            "conversation_cache": self.conversation_cache.stats(),
+            "response_cache": self.response_cache.stats(),
+            "embedding_cache": self.embedding_cache.stats(),
+            "context": self.context.stats() if self.context else None,
+            "grammars": self.grammars.stats() if self.grammars else None,
+            "speculative": self.scheduler.stats() if self._speculative else None,
+        }
+
+    @property
+    def _speculative(self) -> bool:
+        return self.scheduler is not None and self.draft_model is not None
+
+    def metrics_gauges(self) -> dict[str, float]:
+        """Scrape-time gauges for /metrics: scheduler occupancy and cache effectiveness."""
+        prefix = self.prefix_cache.stats()
+        conversation = self.conversation_cache.stats()
+        return {
+            "llm_scheduler_batch_size": self.scheduler.active if self.scheduler else 0,
+            "llm_scheduler_pending": self.scheduler.pending if self.scheduler else 0,
+            "llm_prefix_cache_hit_ratio": prefix["hit_ratio"],
+            "llm_prefix_cache_bytes": prefix["bytes"],
+            "llm_conversation_cache_hit_ratio": conversation["hit_ratio"],
+            "llm_conversation_cache_bytes": conversation["bytes"],
+            "llm_response_cache_hit_ratio": self.response_cache.stats()["hit_ratio"],
+            "llm_embedding_cache_hit_ratio": self.embedding_cache.stats()["hit_ratio"],
+            "llm_speculative_acceptance_rate": (
+                self.scheduler.acceptance_rate if self._speculative else 0
+            ),
+        }
+
+
+def create_engine(cfg: Config) -> LLMEngine:
+    """The engine for `cfg`: in-process, or with REPLICAS > 1 spread over worker processes (src/llm/replicas.py)"""
+    if cfg.replicas > 1:
+        from src.llm.replicas import ReplicaEngine
+
+        return ReplicaEngine(cfg)
+    return LLMEngine(cfg)
+
+
+def _quantize_int8(model):
+    """Dynamic int8 quantization of every Linear layer, in place: int8 weights, activations quantized per batch"""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _footprint(model) -> int:
+    import torch
+
+    size = model.get_memory_footprint()
+    # Dynamically quantized Linear layers keep their packed int8 weights outside parameters()
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            size += sum(t.nelement() * t.element_size() for t in module._weight_bias() if t is not None)
+    return size
+
+
+class _Stream:
+    """Common state for TextStream/AsyncTextStream: the underlying request, once submitted."""
+
+    def __init__(self):
+        from src.llm.scheduler import CancelToken
+
+        self.request: Optional["GenerationRequest"] = None
+        self.cancel_token = CancelToken()
+        self._chunks = None
+        self._started = False
+
+    def cancel(self) -> None:
+        """Stop generation; safe to call from any thread, before or during iteration."""
+        self.cancel_token.set()
+
+    @property
+    def finish_reason(self) -> Optional[str]:
+        return self.request.finish_reason if self.request else None
+
+    @property
+    def usage(self) -> dict:
+        prompt = len(self.request.input_ids) if self.request else 0
+        completion = self.request.completion_tokens if self.request else 0
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+class TextStream(_Stream):
+    """Iterator of text chunks; `usage` and `finish_reason` are final once iteration ends."""
+
+    def __iter__(self):
+        return self
+
+    def start(self) -> "TextStream":
+        """
+        Queue the request now rather than on first iteration, so prompt errors
+        (e.g. ContextOverflow) are raised here, before any response is sent.
+        """
+        if not self._started:
+            self._started = True
+            next(self._chunks)
+        return self
+
+    def __next__(self) -> str:
+        self.start()
+        return next(self._chunks)
+
+    def close(self) -> None:
+        self.cancel()
+        self._chunks.close()
+
+
+class AsyncTextStream(_Stream):
+    """Async iterator of text chunks; `usage` and `finish_reason` are final once iteration ends."""
+
+    def __aiter__(self):
+        return self
+
+    async def start(self) -> "AsyncTextStream":
+        """Queue the request now rather than on first iteration (see TextStream.start)"""
+        if not self._started:
+            self._started = True
+            await self._chunks.__anext__()
+        return self
+
+    async def __anext__(self) -> str:
+        await self.start()
+        return await self._chunks.__anext__()
+
+    async def aclose(self) -> None:
+        self.cancel()
+        await self._chunks.aclose()
+
+
+class _Choices:
+    """State of n > 1 samples: the first request and its forks, in choice order"""
+
+    def __init__(self, n: int):
+        super().__init__()
+        self.n = n
+
+    @property
+    def requests(self) -> list["GenerationRequest"]:
+        return [self.request, *self.request.forks] if self.request else []
+
+    @property
+    def finish_reasons(self) -> list[Optional[str]]:
+        return [r.finish_reason for r in self.requests]
+
+    @property
+    def finish_reason(self) -> Optional[str]:
+        """"cancelled" if any choice was, otherwise the first choice's"""
+        reasons = self.finish_reasons
+        return "cancelled" if "cancelled" in reasons else (reasons[0] if reasons else None)
+
+    @property
+    def usage(self) -> dict:
+        """The prompt counts once; completion tokens are summed over the choices"""
+        prompt = len(self.request.input_ids) if self.request else 0
+        completion = sum(r.completion_tokens for r in self.requests)
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+class ChoiceStream(_Choices, TextStream):
+    """Iterator of (choice index, text chunk); `usage` and `finish_reasons` are final once iteration ends."""
+
+
+class AsyncChoiceStream(_Choices, AsyncTextStream):
+    """Async iterator of (choice index, text chunk)"""
+
+
+class LoadProgress:
+    """Which stage of load() is running and how long finished stages took, for /health."""
+
+    def __init__(self):
+        self.phase = "not started"
+        self.timings: dict[str, float] = {}
+        self.weight_cache: Optional[str] = None  # "hit" or "miss" when WEIGHT_CACHE_DIR is set
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+        self._finished: Optional[float] = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self.phase = name
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - t0, 3)
+
+    def finish(self) -> None:
+        self.phase = "ready"
+        self._finished = time.perf_counter()
+
+    def fail(self, error: BaseException) -> None:
+        self.phase = "failed"
+        self.error = str(error)
+        self._finished = time.perf_counter()
+
+    @property
+    def elapsed_s(self) -> float:
+        return (self._finished or time.perf_counter()) - self._started
 
-        for text in streamer:
-            yield text
\ No newline at end of file
+    def stats(self) -> dict:
+        return {
+            "phase": self.phase,
+            "elapsed_s": round(self.elapsed_s, 3),
+            "timings": dict(self.timings),
+            "weight_cache": self.weight_cache,
+            "error": self.error,
+        }
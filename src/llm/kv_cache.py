@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:  # torch is imported by whoever creates the tensors; keep this module light
+    import torch
+
+# Per-layer (key, value) tensors for a single sequence, each [1, heads, seq_len, head_dim]
+KVLayers = list[tuple["torch.Tensor", "torch.Tensor"]]
+
+
+def kv_nbytes(layers: KVLayers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+def kv_slice(layers: KVLayers, start: int, end: Optional[int] = None) -> KVLayers:
+    return [(k[:, :, start:end], v[:, :, start:end]) for k, v in layers]
+
+
+def common_prefix_len(a: list[int], b: list[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+@dataclass
+class _Entry:
+    token_ids: list[int]
+    layers: KVLayers
+    nbytes: int
+
+
+class ConversationCache:
+    """
+    Keeps the KV cache left behind by the previous turn of each conversation.
+
+    On the next turn the new prompt is compared token-by-token with what was
+    cached, and only the part after the longest shared prefix needs prefill.
+    Entries are evicted least-recently-used first once their total size
+    exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str, token_ids: list[int]) -> tuple[int, KVLayers]:
+        """Return (n, kv) where kv covers the first n tokens of `token_ids`; n is 0 on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        n = common_prefix_len(entry.token_ids, token_ids) if entry is not None else 0
+        if n:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return n, (kv_slice(entry.layers, 0, n) if n else [])
+
+    def store(self, key: str, token_ids: list[int], layers: KVLayers) -> None:
+        nbytes = kv_nbytes(layers)
+        with self._lock:
+            self._pop(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = _Entry(list(token_ids), layers, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
@@ -0,0 +1,164 @@
+"""
+Minimal Prometheus-style metrics (text exposition format 0.0.4).
+
+Metrics are process-wide module globals, like prometheus_client's default
+registry; the engine records into them and /metrics renders them.
+"""
+import bisect
+import math
+import threading
+import time
+from typing import Optional
+
+# Latency buckets in seconds, from sub-millisecond decode steps up to long prefills
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name} {_fmt(self.value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name} {_fmt(self.value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            counts, total, n = list(self.counts), self.sum, self.count
+        lines, cumulative = [], 0
+        for bound, c in zip(self.buckets + (math.inf,), counts):
+            cumulative += c
+            le = "+Inf" if bound == math.inf else _fmt(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_fmt(total)}")
+        lines.append(f"{self.name}_count {n}")
+        return lines
+
+
+def _fmt(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+_REGISTRY: list[_Metric] = []
+
+QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Time from submission until the scheduler starts prefill")
+TOKENIZE = Histogram("llm_tokenize_seconds", "Prompt templating and tokenization time")
+PREFILL = Histogram("llm_prefill_seconds", "Prefill compute time, up to the first sampled token")
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Time from request start to the first token")
+INTER_TOKEN = Histogram("llm_inter_token_seconds", "Time between consecutive decoded tokens")
+TOKENS_PER_SECOND = Histogram("llm_request_tokens_per_second", "Per-request decode throughput", RATE_BUCKETS)
+REQUESTS = Counter("llm_requests_total", "Completed generation requests")
+PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens submitted")
+CACHED_PROMPT_TOKENS = Counter("llm_cached_prompt_tokens_total", "Prompt tokens served from KV/prefix caches")
+COMPLETION_TOKENS = Counter("llm_completion_tokens_total", "Completion tokens generated")
+SPEC_PROPOSED = Counter("llm_speculative_draft_tokens_total", "Draft tokens proposed by the speculative decoder")
+SPEC_ACCEPTED = Counter("llm_speculative_accepted_tokens_total", "Draft tokens accepted by the main model")
+CONTEXT_TRUNCATIONS = Counter("llm_context_truncations_total", "Prompts whose history was cut to fit the context")
+IN_FLIGHT = Gauge("llm_requests_in_flight", "Generation requests currently streaming")
+
+
+class RequestClock:
+    """Per-request timer: call tick() as each token arrives and finish() at the end."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last: Optional[float] = None
+        IN_FLIGHT.inc()
+
+    def tick(self) -> None:
+        now = time.perf_counter()
+        if self._last is None:
+            TIME_TO_FIRST_TOKEN.observe(now - self.started)
+        else:
+            INTER_TOKEN.observe(now - self._last)
+        self._last = now
+
+    def finish(self, request) -> None:
+        IN_FLIGHT.dec()
+        if request is None:
+            return
+        end = time.perf_counter()
+        REQUESTS.inc()
+        PROMPT_TOKENS.inc(len(request.input_ids))
+        CACHED_PROMPT_TOKENS.inc(request.cached_tokens)
+        COMPLETION_TOKENS.inc(request.completion_tokens)
+        if request.prefill_started_at is not None:
+            QUEUE_WAIT.observe(request.prefill_started_at - request.submitted_at)
+        if request.prefill_finished_at is not None:
+            PREFILL.observe(request.prefill_finished_at - request.prefill_started_at)
+            decode_time = end - request.prefill_finished_at
+            if request.completion_tokens > 1 and decode_time > 0:
+                TOKENS_PER_SECOND.observe((request.completion_tokens - 1) / decode_time)
+
+
+def render(extra: Optional[dict[str, float]] = None) -> str:
+    """Render every registered metric, plus `extra` name -> value gauges computed by the caller."""
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    for name, value in (extra or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import threading
+from typing import Optional
+
+from src.llm.kv_cache import KVLayers, kv_nbytes
+
+
+class _Node:
+    __slots__ = ("key", "parent", "children", "layers", "nbytes", "last_used")
+
+    def __init__(self, key: tuple, parent: Optional["_Node"], layers: KVLayers, nbytes: int):
+        self.key = key
+        self.parent = parent
+        self.children: dict[tuple, _Node] = {}
+        self.layers = layers
+        self.nbytes = nbytes
+        self.last_used = 0
+
+
+class PrefixCache:
+    """
+    Radix tree of KV blocks shared by every request on an engine.
+
+    Each edge is a block of `block_size` token ids and each node holds the KV
+    for just that block, so a path from the root spells out a cached prompt
+    prefix. Requests that start with the same system prompt walk the same path
+    and skip prefill for every matching block. Leaves are evicted
+    least-recently-used first when the tree grows past `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = max(1, block_size)
+        self._root = _Node((), None, [], 0)
+        self._bytes = 0
+        self._blocks = 0
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lookup_tokens = 0
+
+    def match(self, token_ids: list[int]) -> tuple[int, KVLayers]:
+        """Return (n, kv) for the longest cached block-aligned prefix of `token_ids`."""
+        with self._lock:
+            path = []
+            node = self._root
+            for key in self._blocks_of(token_ids):
+                node = node.children.get(key)
+                if node is None:
+                    break
+                node.last_used = next(self._clock)
+                path.append(node)
+
+            n = len(path) * self.block_size
+            self.lookup_tokens += len(token_ids)
+            if n:
+                self.hits += 1
+                self.hit_tokens += n
+            else:
+                self.misses += 1
+        if not path:
+            return 0, []
+        import torch  # deferred: the engine constructs this cache before torch is loaded
+
+        layers = [
+            (
+                torch.cat([p.layers[i][0] for p in path], dim=2),
+                torch.cat([p.layers[i][1] for p in path], dim=2),
+            )
+            for i in range(len(path[0].layers))
+        ]
+        return n, layers
+
+    def insert(self, token_ids: list[int], layers: KVLayers) -> None:
+        """Add every full block of `token_ids` not already cached; `layers` must cover those tokens."""
+        with self._lock:
+            node = self._root
+            for b, key in enumerate(self._blocks_of(token_ids)):
+                child = node.children.get(key)
+                if child is None:
+                    start, end = b * self.block_size, (b + 1) * self.block_size
+                    block = [(k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in layers]
+                    child = _Node(key, node, block, kv_nbytes(block))
+                    node.children[key] = child
+                    self._bytes += child.nbytes
+                    self._blocks += 1
+                child.last_used = next(self._clock)
+                node = child
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "hit_tokens": self.hit_tokens,
+                "lookup_tokens": self.lookup_tokens,
+                "blocks": self._blocks,
+                "bytes": self._bytes,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._root.children.clear()
+            self._bytes = 0
+            self._blocks = 0
+
+    def _blocks_of(self, token_ids: list[int]):
+        bs = self.block_size
+        for start in range(0, len(token_ids) - bs + 1, bs):
+            yield tuple(token_ids[start:start + bs])
+
+    def _evict(self) -> None:
+        # Only leaves can go: every deeper block's KV was computed on top of its parent's.
+        # The leaves are gathered once into a heap; a parent left childless joins it.
+        if self._bytes <= self.max_bytes:
+            return
+        heap = [(leaf.last_used, leaf) for leaf in self._leaves()]  # clock values are unique: no ties
+        heapq.heapify(heap)
+        while self._bytes > self.max_bytes and heap:
+            _, leaf = heapq.heappop(heap)
+            parent = leaf.parent
+            del parent.children[leaf.key]
+            self._bytes -= leaf.nbytes
+            self._blocks -= 1
+            if not parent.children and parent is not self._root:
+                heapq.heappush(heap, (parent.last_used, parent))
+
+    def _leaves(self):
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                yield node
@@ -0,0 +1,240 @@
+import dataclasses
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from src.config import Config
+from src.llm.engine import LLMEngine, create_engine
+
+log = logging.getLogger(__name__)
+
+
+class UnknownModel(Exception):
+    """Raised for a model id the registry is not configured to serve."""
+
+
+class Lease:
+    """A model held for one request; release() is idempotent so every exit path can call it."""
+
+    def __init__(self, registry: "ModelRegistry", engine: LLMEngine):
+        self.engine = engine
+        self._registry = registry
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._registry._release(self.engine)
+
+
+@dataclasses.dataclass
+class _Entry:
+    engine: LLMEngine
+    nbytes: int
+    pinned: bool = False   # owned elsewhere (e.g. the GUI's engine); never evicted
+    leases: int = 0
+    last_used: float = 0.0
+    drained: Optional[threading.Event] = None  # set once a swapped-out engine has been unloaded
+
+
+class ModelRegistry:
+    """
+    Keeps several models resident and loads others on demand.
+
+    Requests name a model id; if it is not loaded, the registry loads it with
+    the base config's settings. Once the combined weight size exceeds
+    `max_bytes` (0 = no limit), least-recently-used models that no request
+    holds a lease on are unloaded (scheduler stopped, weights freed) until the
+    set fits again. `allowed` limits which ids may be loaded; the base model is
+    always allowed.
+    """
+
+    def __init__(self, cfg: Config, max_bytes: int = 0, allowed: Optional[set[str]] = None):
+        self.cfg = cfg
+        self.max_bytes = max_bytes
+        self.allowed = set(allowed or ())
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._loading: dict[str, threading.Lock] = {}
+        self._known_sizes: dict[str, int] = {}  # sizes of models loaded before, to make room up front
+        self._draining: list[_Entry] = []  # swapped out; unloaded when their last lease is released
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Config) -> "ModelRegistry":
+        allowed = {m.strip() for m in cfg.served_models.split(",") if m.strip()}
+        return cls(cfg, max_bytes=cfg.model_memory_mb * 1024 * 1024, allowed=allowed)
+
+    def is_allowed(self, model_id: str) -> bool:
+        return model_id == self.cfg.model_id or model_id in self.allowed or "*" in self.allowed
+
+    def add(self, engine: LLMEngine, pinned: bool = False) -> None:
+        """Register an already loaded engine under its model id."""
+        nbytes = engine.model_bytes
+        with self._lock:
+            self._entries[engine.cfg.model_id] = _Entry(engine, nbytes, pinned, last_used=time.monotonic())
+            self._known_sizes[engine.cfg.model_id] = nbytes
+        self._evict()
+
+    def swap(self, old: Optional[LLMEngine], new: LLMEngine, unload_old: bool = False) -> threading.Event:
+        """
+        Atomically make `new` (already loaded) the default model in place of `old`.
+
+        Requests acquired after this get `new`; those already holding a lease
+        on `old` finish on it. Without `unload_old` the old engine is just
+        forgotten (its owner, e.g. the GUI, unloads it). With it, the old engine
+        is unloaded once its last lease is released; the returned event is set then.
+        """
+        if old is new:
+            old = None
+        drained = threading.Event()
+        with self._lock:
+            retired = [e for e in self._entries.values() if e.engine is old]
+            displaced = self._entries.get(new.cfg.model_id)  # e.g. loaded on demand earlier
+            if displaced is not None and displaced.engine is not old and displaced.engine is not new:
+                retired.append(displaced)
+            for entry in retired:
+                del self._entries[entry.engine.cfg.model_id]
+            current = self._entries.get(new.cfg.model_id)
+            if current is not None and current.engine is new:
+                current.pinned = True
+            else:
+                nbytes = new.model_bytes
+                self._entries[new.cfg.model_id] = _Entry(new, nbytes, pinned=True, last_used=time.monotonic())
+                self._known_sizes[new.cfg.model_id] = nbytes
+            self.cfg = new.cfg
+            victims = []
+            for entry in retired:
+                if entry.engine is old and not unload_old:
+                    continue
+                entry.drained = drained if entry.engine is old else None
+                if entry.leases:
+                    self._draining.append(entry)
+                else:
+                    victims.append(entry)
+            if not any(e.drained is drained for e in self._draining + victims):
+                drained.set()  # nothing to unload
+        for entry in victims:
+            self._unload(entry)
+        self._evict()
+        return drained
+
+    def acquire(self, model_id: Optional[str] = None) -> Lease:
+        """Return a lease on `model_id` (default: the base model), loading it first if needed."""
+        model_id = model_id or self.cfg.model_id
+        if not self.is_allowed(model_id):
+            raise UnknownModel(f"Model '{model_id}' is not served here")
+
+        with self._lock:
+            entry = self._lease(model_id)
+            if entry is not None:
+                return Lease(self, entry.engine)
+            loading = self._loading.setdefault(model_id, threading.Lock())
+
+        with loading:  # one load per model; concurrent requests for it wait here
+            with self._lock:
+                entry = self._lease(model_id)
+                if entry is not None:
+                    return Lease(self, entry.engine)
+            self._evict(incoming=self._known_sizes.get(model_id, 0))
+            engine = create_engine(dataclasses.replace(self.cfg, model_id=model_id))
+            log.info(f"Loading {model_id} on demand")
+            engine.load()
+            with self._lock:
+                entry = _Entry(engine, engine.model_bytes, leases=1, last_used=time.monotonic())
+                self._entries[model_id] = entry
+                self._known_sizes[model_id] = entry.nbytes
+                self._loading.pop(model_id, None)
+        self._evict()
+        return Lease(self, engine)
+
+    def unload_all(self) -> None:
+        with self._lock:
+            entries = [e for e in self._entries.values() if not e.pinned]
+            for entry in entries:
+                del self._entries[entry.engine.cfg.model_id]
+        for entry in entries:
+            entry.engine.unload()
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = [
+                {
+                    "model": model_id,
+                    "bytes": e.nbytes,
+                    "pinned": e.pinned,
+                    "in_use": e.leases,
+                    "idle_s": round(time.monotonic() - e.last_used, 3),
+                }
+                for model_id, e in self._entries.items()
+            ]
+            draining = [{"model": e.engine.cfg.model_id, "in_use": e.leases} for e in self._draining]
+        return {
+            "models": models,
+            "draining": draining,
+            "bytes": sum(m["bytes"] for m in models),
+            "max_bytes": self.max_bytes,
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self._entries
+
+    # ===== Internals =====
+    def _lease(self, model_id: str) -> Optional[_Entry]:
+        """Caller holds the lock."""
+        entry = self._entries.get(model_id)
+        if entry is not None:
+            entry.leases += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(model_id)
+        return entry
+
+    def _release(self, engine: LLMEngine) -> None:
+        drained = None
+        with self._lock:
+            entry = self._entries.get(engine.cfg.model_id)
+            if entry is not None and entry.engine is engine:
+                entry.leases -= 1
+                entry.last_used = time.monotonic()
+            else:
+                for entry in self._draining:
+                    if entry.engine is engine:
+                        entry.leases -= 1
+                        if not entry.leases:
+                            self._draining.remove(entry)
+                            drained = entry
+                        break
+        if drained is not None:
+            self._unload(drained)
+        self._evict()  # models skipped while busy may be evictable now
+
+    def _unload(self, entry: _Entry) -> None:
+        log.info(f"Unloading {entry.engine.cfg.model_id} ({entry.nbytes / 2**20:.0f} MiB)")
+        entry.engine.unload()
+        if entry.drained is not None:
+            entry.drained.set()
+
+    def _evict(self, incoming: int = 0) -> None:
+        """Unload idle LRU models until the resident set (plus `incoming` bytes) fits the budget."""
+        if not self.max_bytes:
+            return
+        victims = []
+        with self._lock:
+            total = self.nbytes + incoming
+            for model_id, entry in list(self._entries.items()):
+                if total <= self.max_bytes:
+                    break
+                if entry.pinned or entry.leases:
+                    continue
+                del self._entries[model_id]
+                victims.append(entry)
+                total -= entry.nbytes
+            if total > self.max_bytes:
+                log.warning(f"Models in use exceed the memory budget ({total} > {self.max_bytes} bytes)")
+        for entry in victims:
+            self._unload(entry)
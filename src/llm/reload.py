@@ -0,0 +1,80 @@
+import hmac
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from src.config import Config
+from src.llm.engine import LLMEngine, create_engine
+
+log = logging.getLogger(__name__)
+
+
+class EngineReloader:
+    """
+    Replaces a server's default engine without downtime.
+
+    The new engine loads in a background thread while the old one keeps
+    serving. `swap(new)` then switches new requests over (see
+    ModelRegistry.swap) and returns an event that is set once the old engine
+    has drained its in-flight requests and been unloaded. One reload runs at a
+    time; `status()` reports its progress.
+    """
+
+    def __init__(self, swap: Callable[[LLMEngine], threading.Event]):
+        self._swap = swap
+        self._lock = threading.Lock()
+        self._status: dict = {"state": "idle"}
+        self._loading: Optional[LLMEngine] = None  # the latest reload's engine, for its load progress
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, cfg: Config) -> bool:
+        """Begin loading `cfg` in the background; False if a reload is already in progress."""
+        with self._lock:
+            if self.running:
+                return False
+            self._status = {"state": "loading", "model": cfg.model_id, "precision": cfg.precision}
+            self.thread = threading.Thread(target=self._run, args=(cfg,), name="engine-reload", daemon=True)
+            self.thread.start()
+        return True
+
+    def status(self) -> dict:
+        with self._lock:
+            status = dict(self._status)
+            if self._loading is not None:
+                status["load"] = self._loading.progress.stats()
+            return status
+
+    def _run(self, cfg: Config) -> None:
+        started = time.monotonic()
+        new = create_engine(cfg)
+        with self._lock:
+            self._loading = new
+        try:
+            new.load()
+        except Exception as e:
+            log.error(f"❌ Reload of {cfg.model_id} failed; still serving the old model: {e}", exc_info=True)
+            new.unload()
+            self._update(state="failed", error=str(e))
+            return
+        loaded = time.monotonic()
+        self._update(state="draining", load_s=round(loaded - started, 3))
+        log.info(f"🔁 Now serving {cfg.model_id} (precision={cfg.precision}); draining the old model")
+        self._swap(new).wait()
+        self._update(state="done", drain_s=round(time.monotonic() - loaded, 3))
+        log.info("✅ Reload complete")
+
+    def _update(self, **fields) -> None:
+        with self._lock:
+            self._status.update(fields)
+
+
+def admin_authorized(authorization: Optional[str], token: str) -> bool:
+    """Check an Authorization header against ADMIN_TOKEN (no token configured = admin endpoints are closed)"""
+    if not token:
+        return False
+    return hmac.compare_digest(authorization or "", f"Bearer {token}")
@@ -0,0 +1,531 @@
+"""
+Replica mode (REPLICAS > 1): the model runs in several engine worker
+processes so one host's cores are not limited by a single Python process's
+GIL and decode loop.
+
+Every replica is an ordinary LLMEngine with its own batch scheduler and
+REPLICA_THREADS torch threads. All of them load the same read-only
+safetensors copy of the weights from WEIGHT_CACHE_DIR; weights that need no
+conversion are memory-mapped from that file, so the page cache holds them
+once however many replicas map them.
+
+The front process (the API server) keeps the tokenizer and no weights: it
+fits, templates and tokenizes prompts, sends token ids to the least-loaded
+replica, and detokenizes the token ids the replica relays back. Streaming,
+tracing, metrics and the response cache therefore behave as with one
+in-process engine.
+"""
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+from src.config import Config
+from src.llm.constrained import GrammarCache
+from src.llm.engine import LLMEngine
+
+log = logging.getLogger(__name__)
+
+# Methods the front process may run on a replica's engine
+_CALLS = {"_embed_encoded"}
+
+
+class ReplicaEngine(LLMEngine):
+    """LLMEngine whose scheduler is a ReplicaPool of worker processes"""
+
+    def _load(self) -> None:
+        with self.progress.stage("imports"):
+            from transformers import AutoConfig, AutoTokenizer
+
+        worker_cfg = self._worker_config()
+        log.info(f"Starting {self.cfg.replicas} replicas of {self.cfg.model_id} "
+                 f"({worker_cfg.cpu_threads} threads each, weights in {worker_cfg.weight_cache_dir})")
+        with self.progress.stage("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(self.cfg.model_id, use_fast=True)
+            self.context = self._context_manager(AutoConfig.from_pretrained(self.cfg.model_id))
+        # Grammars are compiled here too, only to reject those the replicas could not use
+        eos_token_ids = {self.tokenizer.eos_token_id} - {None}
+        self.grammars = GrammarCache(self.tokenizer, eos_token_ids, max_entries=self.cfg.grammar_cache_size)
+        pool = ReplicaPool(worker_cfg, self.cfg.replicas)
+        with self.progress.stage("weights"):
+            pool.prepare_weights()
+        with self.progress.stage("replicas"):
+            pool.start()
+        self.scheduler = pool
+
+    def _worker_config(self) -> Config:
+        threads = self.cfg.replica_threads or max(1, (os.cpu_count() or 1) // self.cfg.replicas)
+        return dataclasses.replace(
+            self.cfg,
+            replicas=0,
+            cpu_threads=threads,
+            weight_cache_dir=self.cfg.weight_cache_dir or os.path.join(tempfile.gettempdir(), "llm-weight-cache"),
+        )
+
+    def _logits_processor(self, grammar: Optional[str]):
+        if grammar:
+            self.check_grammar(grammar)  # raises GrammarError before anything reaches a replica
+        return None  # the replica builds its own from request.grammar
+
+    @property
+    def model_bytes(self) -> int:
+        """Size of one replica's weights: the mapped copy is shared, so this is what the host holds"""
+        return self.scheduler.model_bytes if self.scheduler else 0
+
+    def _embed_encoded(self, encoded: list[list[int]], pooling: str) -> list[bytes]:
+        return self.scheduler.call("_embed_encoded", encoded, pooling)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "replicas": self.scheduler.stats() if self.scheduler else None}
+
+
+class ReplicaPool:
+    """
+    Front-side dispatcher over the worker processes. It stands in for the
+    engine's BatchScheduler: submit() sends a GenerationRequest to the replica
+    with the fewest requests in flight (preferring the one that served the
+    same conversation, whose KV cache it may reuse) and a reader thread per
+    replica feeds the relayed token ids into the request's output queue.
+    """
+
+    max_affinity = 4096  # conversation ids remembered for KV-cache affinity
+
+    def __init__(self, cfg: Config, replicas: int):
+        self.cfg = cfg
+        self.num_replicas = replicas
+        self.replicas: list[_Replica] = []
+        self._ids = itertools.count()
+        self._affinity: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = False
+        # Fork is unsafe once torch has started its thread pools; spawned workers start clean
+        self._mp = multiprocessing.get_context("spawn")
+
+    def prepare_weights(self) -> None:
+        """Write the shared weight copy (WEIGHT_CACHE_DIR) once, in a throwaway process, if it is missing"""
+        probe = LLMEngine(self.cfg)
+        paths = [probe._weight_cache_path(m) for m in (self.cfg.model_id, self.cfg.draft_model_id) if m]
+        if all(os.path.isdir(p) for p in paths):
+            return
+        process = self._mp.Process(
+            target=_prepare_weights, args=(dataclasses.asdict(self.cfg),), name="llm-replica-weights"
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Preparing the shared weights failed (exit code {process.exitcode})")
+        if not all(os.path.isdir(p) for p in paths):
+            log.warning("No shared weight copy could be written; every replica loads its own copy")
+
+    def start(self) -> None:
+        for index in range(self.num_replicas):
+            conn, child = self._mp.Pipe()
+            process = self._mp.Process(
+                target=_replica_main, args=(index, dataclasses.asdict(self.cfg), child),
+                name=f"llm-replica-{index}", daemon=True,
+            )
+            process.start()
+            child.close()  # so a dead worker shows up as EOF on our end
+            self.replicas.append(_Replica(index, process, conn))
+        try:
+            for replica in self.replicas:
+                replica.wait_ready()
+        except BaseException:
+            self.stop()
+            raise
+        for replica in self.replicas:
+            replica.start_reader(self)
+        log.info(f"{len(self.replicas)} replicas ready: pids {[r.process.pid for r in self.replicas]}")
+
+    def stop(self) -> None:
+        self._stopping = True
+        for replica in self.replicas:
+            replica.stop()
+        self.replicas = []
+
+    # ===== Scheduler interface (see BatchScheduler) =====
+    def submit(self, request):
+        from src.llm.scheduler import CancelToken
+
+        if self._stopping:
+            raise RuntimeError("Scheduler is stopped")
+        request.submitted_at = time.perf_counter()
+        rid = next(self._ids)
+        replica = self._pick(request.cache_key)
+        # Forks run on the same replica so it prefills the prompt once for all of them
+        fork_ids = [next(self._ids) for _ in request.forks]
+        for fork in request.forks:
+            fork.submitted_at = request.submitted_at
+        replica.track(zip((rid, *fork_ids), (request, *request.forks)))
+        replica.send("generate", rid, dict(
+            input_ids=request.input_ids,
+            max_new_tokens=request.max_new_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            cache_key=request.cache_key,
+            ignore_eos=request.ignore_eos,
+            grammar=request.grammar,
+        ), request.trace is not None, fork_ids)
+        # Forks share the token, and the replica cancels them along with the request
+        if isinstance(request.cancel_token, CancelToken):
+            request.cancel_token.on_cancel(lambda: replica.cancel(rid))
+        return request
+
+    def call(self, method: str, *args):
+        """Run engine.<method>(*args) on the least-loaded replica and wait for the result"""
+        future: Future = Future()
+        rid = next(self._ids)
+        replica = self._pick(None)
+        with replica.lock:
+            replica.calls[rid] = future
+        replica.send("call", rid, method, args)
+        return future.result()
+
+    @property
+    def thread(self) -> None:
+        return None  # decode loops run in other processes; nothing here to profile
+
+    @property
+    def active(self) -> int:
+        return sum(len(r.requests) for r in self.replicas)
+
+    @property
+    def pending(self) -> int:
+        return 0  # queued requests wait inside the replicas' schedulers
+
+    @property
+    def model_bytes(self) -> int:
+        return max((r.info.get("model_bytes", 0) for r in self.replicas), default=0)
+
+    def stats(self) -> list[dict]:
+        return [r.stats() for r in self.replicas]
+
+    def _pick(self, cache_key: Optional[str]) -> "_Replica":
+        with self._lock:
+            live = [r for r in self.replicas if r.alive]
+            if not live:
+                raise RuntimeError("No engine replicas are running")
+            preferred = self._affinity.get(cache_key) if cache_key else None
+            replica = min(live, key=lambda r: (r.load, r.index != preferred, r.served))
+            replica.served += 1
+            if cache_key:
+                self._affinity[cache_key] = replica.index
+                self._affinity.move_to_end(cache_key)
+                while len(self._affinity) > self.max_affinity:
+                    self._affinity.popitem(last=False)
+            return replica
+
+
+class _Replica:
+    """One worker process as seen from the front: its pipe, and the requests and calls in flight on it"""
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.info: dict = {}
+        self.alive = False
+        self.served = 0
+        # Added to and removed from by request threads as well as the reader thread; guarded by `lock`
+        self.requests: dict = {}  # rid -> GenerationRequest
+        self.calls: dict[int, Future] = {}
+        self._cancelled: set[int] = set()
+        self.lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader: Optional[threading.Thread] = None
+
+    @property
+    def load(self) -> int:
+        return len(self.requests) + len(self.calls)
+
+    def wait_ready(self) -> None:
+        try:
+            kind, payload = self.conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Replica {self.index} exited while loading (exit code {self.process.exitcode})")
+        if kind != "ready":
+            raise RuntimeError(f"Replica {self.index} failed to load: {payload}")
+        self.info, self.alive = payload, True
+
+    def start_reader(self, pool: ReplicaPool) -> None:
+        self._reader = threading.Thread(target=self._read, args=(pool,), name=f"llm-replica-{self.index}-reader",
+                                        daemon=True)
+        self._reader.start()
+
+    def send(self, *message) -> None:
+        with self._send_lock:
+            self.conn.send(message)
+
+    def track(self, requests) -> None:
+        """Register (rid, request) pairs about to be sent"""
+        with self.lock:
+            self.requests.update(requests)
+
+    def cancel(self, rid: int) -> None:
+        """Tell the worker to drop a request (and its forks), whether it is queued, prefilling or decoding"""
+        with self.lock:
+            if rid not in self.requests or rid in self._cancelled:
+                return
+            self._cancelled.add(rid)
+        try:
+            self.send("cancel", rid)
+        except OSError:
+            pass  # the worker is gone; the reader thread finishes its requests
+
+    def stop(self) -> None:
+        if self.alive:
+            try:
+                self.send("stop", None)
+            except OSError:
+                pass
+        self.process.join(timeout=30)
+        if self.process.is_alive():
+            log.warning(f"Replica {self.index} did not stop; terminating it")
+            self.process.terminate()
+            self.process.join()
+        if self._reader is not None:
+            self._reader.join()
+        self.conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "replica": self.index,
+            "pid": self.process.pid,
+            "alive": self.alive,
+            "in_flight": self.load,
+            "served": self.served,
+            "model_bytes": self.info.get("model_bytes"),
+            "mapped_weight_bytes": self.info.get("mapped_weight_bytes"),
+        }
+
+    def _read(self, pool: ReplicaPool) -> None:
+        while True:
+            try:
+                kind, rid, *payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "token":
+                self._token(rid, payload[0])
+            elif kind == "done":
+                self._done(rid, *payload)
+            elif kind in ("result", "error"):
+                with self.lock:
+                    future = self.calls.pop(rid)
+                if kind == "result":
+                    future.set_result(payload[0])
+                else:
+                    future.set_exception(payload[0])
+        self.alive = False
+        if not pool._stopping:
+            log.error(f"❌ Replica {self.index} (pid {self.process.pid}) exited unexpectedly")
+        error = RuntimeError(f"Replica {self.index} exited")
+        with self.lock:
+            requests, self.requests = list(self.requests.values()), {}
+            calls, self.calls = list(self.calls.values()), {}
+        for request in requests:
+            request.finish(error=error)
+        for future in calls:
+            future.set_exception(error)
+
+    def _token(self, rid: int, token: int) -> None:
+        with self.lock:
+            request = self.requests.get(rid)
+        if request is None:
+            return
+        request.generated_ids.append(token)
+        if request.trace is not None:
+            request.emitted_at.append(time.perf_counter())
+        if request.cancelled:
+            self.cancel(rid)  # a plain Event for a cancel token is only seen here
+        request.output.put(token)
+
+    def _done(self, rid: int, result: dict) -> None:
+        with self.lock:
+            request = self.requests.pop(rid, None)
+            self._cancelled.discard(rid)
+        if request is None:
+            return
+        request.cached_tokens = result["cached_tokens"]
+        if result["queue_wait_s"] is not None:
+            request.prefill_started_at = request.submitted_at + result["queue_wait_s"]
+        if result["prefill_s"] is not None:
+            request.prefill_finished_at = request.prefill_started_at + result["prefill_s"]
+        if request.trace is not None and result["trace"] is not None:
+            request.trace.merge(*result["trace"])
+        request.finish(result["finish_reason"], result["error"])
+
+
+# ===== Worker process =====
+# Workers get the config as a dict of fields: plain data pickles across interpreters
+def _prepare_weights(fields: dict) -> None:
+    """Load once with WEIGHT_CACHE_DIR set, which writes the converted weights there, then exit"""
+    from src.utils.logging import setup_logging
+
+    setup_logging()
+    engine = LLMEngine(Config(**fields))
+    engine.load()
+    engine.unload()
+
+
+def _replica_main(index: int, fields: dict, conn) -> None:
+    from src.utils.logging import setup_logging
+
+    setup_logging()
+    cfg = Config(**fields)
+    engine = LLMEngine(cfg)
+    try:
+        engine.load()
+    except BaseException as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", {
+        "pid": os.getpid(),
+        "model_bytes": engine.model_bytes,
+        "mapped_weight_bytes": mapped_bytes(engine.model, cfg.weight_cache_dir),
+    }))
+    log.info(f"Replica {index} ready (pid {os.getpid()}, {cfg.cpu_threads} threads)")
+    _Worker(engine, conn).serve()
+
+
+class _Worker:
+    """Serves one replica's pipe: generation requests go to the engine's scheduler, calls run on threads"""
+
+    def __init__(self, engine: LLMEngine, conn):
+        self.engine = engine
+        self.conn = conn
+        self.requests: dict = {}  # rid -> GenerationRequest
+        self._send_lock = threading.Lock()
+
+    def send(self, *message) -> None:
+        with self._send_lock:
+            self.conn.send(message)
+
+    def serve(self) -> None:
+        while True:
+            try:
+                kind, rid, *payload = self.conn.recv()
+            except EOFError:
+                break  # the front process went away
+            if kind == "stop":
+                break
+            if kind == "generate":
+                self._generate(rid, *payload)
+            elif kind == "cancel":
+                request = self.requests.get(rid)
+                if request is not None:
+                    request.cancel()
+            elif kind == "call":
+                threading.Thread(target=self._call, args=(rid, *payload), daemon=True).start()
+        self.engine.unload()
+
+    def _generate(self, rid: int, options: dict, traced: bool, fork_ids: list[int]) -> None:
+        from src.llm.scheduler import GenerationRequest
+        from src.llm.tracing import Trace
+
+        request = GenerationRequest(**options, trace=Trace() if traced else None)
+        request.forks = [
+            GenerationRequest(**{**options, "cache_key": None}, cancel_token=request.cancel_token)
+            for _ in fork_ids
+        ]
+        for r, r_id in zip((request, *request.forks), (rid, *fork_ids)):
+            r.output = _Relay(self, r_id, r)
+            self.requests[r_id] = r  # registered here, so a cancel that follows finds it
+        if request.grammar:
+            # Compiling a new grammar takes seconds; keep reading the pipe meanwhile
+            threading.Thread(target=self._submit, args=(request,), daemon=True).start()
+        else:
+            self._submit(request)
+
+    def _submit(self, request) -> None:
+        """Build the logits processors and queue the request; a failure ends only this request"""
+        try:
+            for r in (request, *request.forks):
+                r.logits_processor = self.engine._logits_processor(r.grammar)
+            self.engine.scheduler.submit(request)
+        except Exception as e:
+            for r in (request, *request.forks):
+                r.finish(error=e)
+
+    def _call(self, rid: int, method: str, args: tuple) -> None:
+        try:
+            if method not in _CALLS:
+                raise ValueError(f"Unknown replica call {method!r}")
+            result = getattr(self.engine, method)(*args)
+        except Exception as e:
+            self._send_error(rid, e)
+            return
+        self.send("result", rid, result)
+
+    def _send_error(self, rid: int, error: BaseException) -> None:
+        try:
+            self.send("error", rid, error)
+        except Exception:  # not picklable
+            self.send("error", rid, RuntimeError(f"{type(error).__name__}: {error}"))
+
+
+class _Relay:
+    """A request's output queue in a replica: tokens are sent to the front process as the scheduler emits them"""
+
+    def __init__(self, worker: _Worker, rid: int, request):
+        self.worker = worker
+        self.rid = rid
+        self.request = request
+        self.error: Optional[BaseException] = None
+
+    def put(self, item) -> None:
+        if isinstance(item, int):
+            self.worker.send("token", self.rid, item)
+        elif isinstance(item, BaseException):
+            self.error = item  # the end marker follows
+        else:
+            self.worker.requests.pop(self.rid, None)
+            self.worker.send("done", self.rid, self._result())
+
+    def _result(self) -> dict:
+        request = self.request
+        started, finished = request.prefill_started_at, request.prefill_finished_at
+        error = self.error
+        if error is not None:
+            error = RuntimeError(f"{type(error).__name__}: {error}")  # exceptions may not pickle
+        trace = request.trace
+        return {
+            "finish_reason": request.finish_reason,
+            "error": error,
+            "cached_tokens": request.cached_tokens,
+            "queue_wait_s": started - request.submitted_at if started is not None else None,
+            "prefill_s": finished - started if finished is not None and started is not None else None,
+            "trace": (trace.to_chrome()["traceEvents"], trace.started) if trace is not None else None,
+        }
+
+
+def mapped_bytes(model, directory: str) -> Optional[int]:
+    """
+    Bytes of `model`'s parameters backed by file mappings under `directory`,
+    i.e. shared with every other process mapping the same files (Linux only;
+    None elsewhere).
+    """
+    try:
+        with open("/proc/self/maps", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    prefix = os.path.join(os.path.realpath(directory), "")
+    ranges = []
+    for line in lines:
+        fields = line.split(maxsplit=5)
+        if len(fields) == 6 and fields[5].startswith(prefix):
+            start, end = (int(x, 16) for x in fields[0].split("-"))
+            ranges.append((start, end))
+    total = 0
+    for param in model.parameters():
+        ptr = param.data_ptr()
+        if any(start <= ptr < end for start, end in ranges):
+            total += param.nelement() * param.element_size()
+    return total
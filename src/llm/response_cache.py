@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResponse:
+    """
+    A finished completion. Iterates like TextStream/AsyncTextStream (the whole
+    text as one chunk), so cache hits go through the same response code.
+    """
+    text: str
+    finish_reason: Optional[str] = "stop"
+    usage: dict = field(default_factory=dict)
+
+    def __iter__(self):
+        return iter([self.text] if self.text else [])
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+def response_key(
+    model_id: str, system_prompt: str, history: list, user_msg: str, settings: Optional[dict] = None, **params
+) -> str:
+    """
+    Stable hash of everything that determines a deterministic completion:
+    the messages, the request's params and the server `settings` (precision,
+    context budget and policy) that shape how they are generated
+    """
+    payload = {
+        "model": model_id,
+        "settings": settings or {},
+        "system": system_prompt,
+        "history": [list(turn) for turn in history],
+        "user": user_msg,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Memoizes complete responses to deterministic (temperature 0) requests.
+
+    Entries live in an in-memory LRU bounded by `max_bytes`. With `disk_dir`
+    set they are also written there as one JSON file per key, so they survive
+    restarts; the directory is bounded by `disk_max_bytes`, evicting the least
+    recently used file first. Disk hits are promoted back into memory.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, tuple[CachedResponse, int]] = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        response = self._disk_get(key)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(key, response, _size(response))
+        return response
+
+    def put(self, key: str, response: CachedResponse) -> None:
+        if response.finish_reason not in ("stop", "length"):
+            return  # cancelled or failed: not the full deterministic answer
+        nbytes = _size(response)
+        with self._lock:
+            self._memory_put(key, response, nbytes)
+        if self.disk_dir:
+            self._disk_put(key, response)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self.disk_dir:
+                for path, _, _ in self._disk_files():
+                    _unlink(path)
+                self._disk_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_bytes": self._disk_bytes,
+        }
+
+    # ===== Memory tier (caller holds the lock) =====
+    def _memory_put(self, key: str, response: CachedResponse, nbytes: int) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (response, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+
+    # ===== Disk tier =====
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key: str) -> Optional[CachedResponse]:
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response = CachedResponse(**json.load(f))
+            os.utime(path)  # mtime doubles as the LRU timestamp
+            return response
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            log.warning(f"Dropping unreadable response cache file {path}: {e}")
+            _unlink(path)
+            return None
+
+    def _disk_put(self, key: str, response: CachedResponse) -> None:
+        data = json.dumps(asdict(response)).encode("utf-8")
+        if len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                old = os.path.getsize(path) if os.path.exists(path) else 0
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError as e:
+                log.warning(f"Could not write response cache file {path}: {e}")
+                _unlink(tmp)
+                return
+            self._disk_bytes += len(data) - old
+            if self._disk_bytes > self.disk_max_bytes:
+                self._disk_evict()
+
+    def _disk_evict(self) -> None:
+        for path, size, _ in sorted(self._disk_files(), key=lambda f: f[2]):
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            _unlink(path)
+            self._disk_bytes -= size
+
+    def _disk_files(self) -> list[tuple[str, int, float]]:
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                files.append((entry.path, st.st_size, st.st_mtime))
+        return files
+
+
+def _size(response: CachedResponse) -> int:
+    return len(response.text.encode("utf-8")) + 256  # text plus rough per-entry overhead
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
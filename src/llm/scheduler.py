@@ -0,0 +1,564 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterator, Optional
+
+import torch
+from transformers import DynamicCache
+
+from src.llm.kv_cache import ConversationCache, kv_slice
+from src.llm.prefix_cache import PrefixCache
+from src.llm.tracing import span
+
+if TYPE_CHECKING:
+    from src.llm.tracing import Trace
+
+log = logging.getLogger(__name__)
+
+_END = object()  # end-of-stream marker put on a request's output queue
+
+
+class AsyncTokenQueue:
+    """
+    Output channel for asyncio callers: the scheduler thread put()s as with a
+    queue.Queue, and items are handed to the owning event loop thread-safely.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, item) -> None:
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    async def get(self):
+        return await self._queue.get()
+
+
+class ChoiceQueue:
+    """
+    Output shared by a request and its forks (n > 1 samples of one prompt).
+    Each request puts into its own view(index); iterating yields
+    (choice index, token id) in arrival order, with None as the token when
+    that choice has ended, until all n have. `channel` is a queue.Queue or an
+    AsyncTokenQueue (then use `async for`).
+    """
+
+    def __init__(self, n: int, channel=None):
+        self.n = n
+        self.channel = channel if channel is not None else queue.Queue()
+
+    def view(self, index: int) -> "_ChoiceView":
+        return _ChoiceView(self.channel, index)
+
+    def __iter__(self) -> Iterator[tuple[int, Optional[int]]]:
+        remaining = self.n
+        while remaining:
+            index, item = self.channel.get()
+            if isinstance(item, BaseException):
+                raise item
+            if item is _END:
+                remaining -= 1
+                item = None
+            yield index, item
+
+    async def __aiter__(self) -> AsyncIterator[tuple[int, Optional[int]]]:
+        remaining = self.n
+        while remaining:
+            index, item = await self.channel.get()
+            if isinstance(item, BaseException):
+                raise item
+            if item is _END:
+                remaining -= 1
+                item = None
+            yield index, item
+
+
+class _ChoiceView:
+    def __init__(self, channel, index: int):
+        self.channel = channel
+        self.index = index
+
+    def put(self, item) -> None:
+        self.channel.put((self.index, item))
+
+
+class CancelToken(threading.Event):
+    """
+    A request's cancellation flag. The decode loop polls it; callbacks added
+    with on_cancel() run on the cancelling thread as soon as it is set, so a
+    cancel can be passed on (to a replica process) without waiting for the
+    next token.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks: list[Callable[[], None]] = []
+        self._callbacks_lock = threading.Lock()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Run `callback` once the token is set (right away if it already is)"""
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def set(self) -> None:
+        super().set()
+        with self._callbacks_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+@dataclass
+class GenerationRequest:
+    """
+    One queued generation. The scheduler thread pushes sampled token ids onto
+    `output`; the caller iterates the request to receive them (`async for`
+    when `output` is an AsyncTokenQueue).
+    """
+    input_ids: list[int]
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    # Conversation key for KV reuse across turns (None disables reuse)
+    cache_key: Optional[str] = None
+    ignore_eos: bool = False  # always run to max_new_tokens (benchmarks)
+    # Cancellation token: set from any thread and the request is dropped before the next decode step
+    cancel_token: threading.Event = field(default_factory=CancelToken, repr=False)
+    output: queue.Queue = field(default_factory=queue.Queue, repr=False)
+    generated_ids: list[int] = field(default_factory=list, repr=False)
+    cached_tokens: int = 0  # prompt tokens served from cache instead of prefill
+    finish_reason: Optional[str] = None
+    # perf_counter() timestamps, filled in by the scheduler
+    submitted_at: float = 0.0
+    prefill_started_at: Optional[float] = None
+    prefill_finished_at: Optional[float] = None
+    # Set to record prefill/decode spans; `emitted_at` then holds when each token was handed off
+    trace: Optional["Trace"] = field(default=None, repr=False)
+    emitted_at: list[float] = field(default_factory=list, repr=False)
+    # Constrained decoding: the pattern the completion must match, and the
+    # processor that masks logits(generated_ids, logits_row) to keep it matchable
+    grammar: Optional[str] = None
+    logits_processor: Optional[Callable[[list[int], torch.Tensor], torch.Tensor]] = field(default=None, repr=False)
+    # Further samples of the same prompt (n > 1): prefilled once together with this
+    # request, then each decoded as its own row from a copy of the prompt's KV
+    forks: list["GenerationRequest"] = field(default_factory=list, repr=False)
+
+    @property
+    def completion_tokens(self) -> int:
+        return len(self.generated_ids)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.is_set()
+
+    def cancel(self) -> None:
+        self.cancel_token.set()
+
+    def finish(self, reason: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+        """End the stream: iteration raises `error` if given, then stops"""
+        self.finish_reason = reason
+        if error is not None:
+            self.output.put(error)
+        self.output.put(_END)
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            item = self.output.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def __aiter__(self) -> AsyncIterator[int]:
+        while True:
+            item = await self.output.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class _Exclusive:
+    """A callable queued by run_exclusive(), run on the scheduler thread between decode steps."""
+
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            self.result = self.fn()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        self.done.set()
+
+
+@dataclass
+class _Row:
+    request: GenerationRequest
+    last_token: int
+
+
+class BatchScheduler:
+    """
+    Continuous-batching decode loop.
+
+    A single background thread owns the model. Incoming requests are prefilled
+    one at a time and merged into the running batch at token boundaries; every
+    step then decodes one token for all active sequences in a single forward
+    pass. Finished sequences are retired between steps so new ones can join.
+
+    The batch KV cache is kept left-padded: every row ends at the same column,
+    and `_mask` marks which columns hold real tokens for each row.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        conversation_cache: Optional[ConversationCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.device = model.device
+        self.conversation_cache = conversation_cache
+        self.prefix_cache = prefix_cache
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos]) - {None}
+
+        self._pending: queue.Queue = queue.Queue()
+        self._held: Optional[GenerationRequest] = None  # next request, waiting for room for all its forks
+        self._rows: list[_Row] = []
+        self._layers: list[tuple[torch.Tensor, torch.Tensor]] = []
+        self._mask: Optional[torch.Tensor] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Start time and batch size of the decode step in progress, and the traced requests it has recorded
+        self._step_started: Optional[tuple[float, int]] = None
+        self._step_traced: set[int] = set()
+
+    # ===== Public API =====
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._pending.put(None)  # wake the loop if idle
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        if self._stopped.is_set():
+            raise RuntimeError("Scheduler is stopped")
+        request.submitted_at = time.perf_counter()
+        self._pending.put(request)
+        return request
+
+    def run_exclusive(self, fn: Callable):
+        """
+        Run `fn()` on the scheduler thread, between decode steps, and return its
+        result. While it runs the model is all its own (e.g. one padded batch of
+        an offline job); active streams resume on the next step.
+        """
+        if self._stopped.is_set():
+            raise RuntimeError("Scheduler is stopped")
+        job = _Exclusive(fn)
+        self._pending.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    @property
+    def thread(self) -> Optional[threading.Thread]:
+        """The thread running the decode loop (for profilers)"""
+        return self._thread
+
+    @property
+    def active(self) -> int:
+        return len(self._rows)
+
+    @property
+    def pending(self) -> int:
+        return self._pending.qsize() + (self._held is not None)
+
+    # ===== Loop =====
+    def _run(self) -> None:
+        with torch.inference_mode():
+            while not self._stopped.is_set():
+                self._admit(block=not self._rows)
+                self._drop_cancelled()
+                if not self._rows:
+                    continue
+                self._step_started, self._step_traced = (time.perf_counter(), len(self._rows)), set()
+                try:
+                    self._step()
+                except Exception as e:
+                    log.error(f"Decode step failed: {e}", exc_info=True)
+                    self._fail_all(e)
+                finally:
+                    self._step_started = None
+        self._fail_all(RuntimeError("Scheduler stopped"))
+
+    def _admit(self, block: bool) -> None:
+        while len(self._rows) < self.max_batch_size:
+            if self._held is not None:
+                request, self._held = self._held, None
+            else:
+                try:
+                    request = self._pending.get(block=block)
+                except queue.Empty:
+                    return
+            block = False
+            if request is None:  # stop() wake-up
+                return
+            if isinstance(request, _Exclusive):
+                request.run()
+                continue
+            if request.cancelled:
+                for r in (request, *request.forks):
+                    self._finish(r, "cancelled")
+                continue
+            if self._rows and len(self._rows) + 1 + len(request.forks) > self.max_batch_size:
+                self._held = request  # keeps its place until enough rows retire
+                return
+            try:
+                self._prefill(request)
+            except Exception as e:
+                log.error(f"Prefill failed: {e}", exc_info=True)
+                for r in (request, *request.forks):
+                    if r.finish_reason is None:
+                        self._finish(r, error=e)
+
+    def _prefill(self, request: GenerationRequest) -> None:
+        request.prefill_started_at = time.perf_counter()
+        prompt_len = len(request.input_ids)
+        cached, past = 0, []
+        if self.conversation_cache is not None and request.cache_key is not None:
+            cached, past = self.conversation_cache.lookup(request.cache_key, request.input_ids)
+        if self.prefix_cache is not None and cached < prompt_len - 1:
+            shared, shared_past = self.prefix_cache.match(request.input_ids)
+            if shared > cached:
+                cached, past = shared, shared_past
+        # Always prefill at least one token so there are logits to sample from
+        if cached >= prompt_len:
+            cached, past = prompt_len - 1, kv_slice(past, 0, prompt_len - 1)
+        request.cached_tokens = cached
+        if request.trace is not None:
+            request.trace.complete("queue_wait", request.submitted_at, request.prefill_started_at)
+
+        with span(request.trace, "to_device"):
+            input_ids = torch.tensor([request.input_ids[cached:]], device=self.device)
+            position_ids = torch.arange(cached, prompt_len, device=self.device).unsqueeze(0)
+        with span(request.trace, "prefill", tokens=prompt_len - cached, cached_tokens=cached):
+            out = self.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                past_key_values=DynamicCache(past) if past else None,
+                use_cache=True,
+            )
+            layers = [(k, v) for k, v, *_ in out.past_key_values]
+            group = [request, *request.forks]
+            logits = out.logits[:, -1, :]
+            tokens = self._sample(logits.repeat(len(group), 1) if request.forks else logits, group)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.input_ids, layers)
+        for r, token in zip(group, tokens):
+            r.cached_tokens = cached
+            r.prefill_started_at, r.prefill_finished_at = request.prefill_started_at, time.perf_counter()
+            if self._emit(r, token):
+                self._save_conversation(r, layers)
+            else:
+                self._add_row(r, token, layers)
+
+    def _add_row(self, request: GenerationRequest, token: int, layers) -> None:
+        """Join a freshly prefilled sequence (KV for its whole prompt in `layers`) to the batch."""
+        mask = torch.ones((1, len(request.input_ids)), dtype=torch.long, device=self.device)
+        self._merge(layers, mask)
+        self._rows.append(_Row(request, token))
+
+    def _step(self) -> None:
+        rows = self._rows
+        input_ids = torch.tensor([[r.last_token] for r in rows], device=self.device)
+        mask = torch.cat([self._mask, self._mask.new_ones((len(rows), 1))], dim=1)
+        position_ids = mask.sum(dim=1, keepdim=True) - 1
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache(self._layers),
+            use_cache=True,
+        )
+        self._layers = [(k, v) for k, v, *_ in out.past_key_values]
+        self._mask = mask
+
+        tokens = self._sample(out.logits[:, -1, :], [r.request for r in rows])
+        keep = []
+        for i, (row, token) in enumerate(zip(rows, tokens)):
+            if not self._emit(row.request, token):
+                row.last_token = token
+                keep.append(i)
+            elif self.conversation_cache is not None and row.request.cache_key is not None:
+                start = mask.shape[1] - int(mask[i].sum())
+                row_layers = [(k[i:i + 1, :, start:].clone(), v[i:i + 1, :, start:].clone()) for k, v in self._layers]
+                self._save_conversation(row.request, row_layers)
+        if len(keep) < len(rows):
+            self._retain(keep)
+
+    # ===== Batch bookkeeping =====
+    def _drop_cancelled(self) -> None:
+        """Retire rows whose caller cancelled them (client gone, Stop pressed); runs before every step."""
+        keep = []
+        for i, row in enumerate(self._rows):
+            if row.request.cancelled:
+                self._finish(row.request, "cancelled")
+            else:
+                keep.append(i)
+        if len(keep) < len(self._rows):
+            self._retain(keep)
+
+    def _merge(self, layers, mask: torch.Tensor) -> None:
+        """Left-pad the new sequence or the batch so both end on the same column, then stack."""
+        if not self._rows:
+            self._layers, self._mask = layers, mask
+            return
+        new_len, cur_len = mask.shape[1], self._mask.shape[1]
+        width = max(new_len, cur_len)
+        self._layers = [
+            (
+                torch.cat([_left_pad(bk, width), _left_pad(k, width)], dim=0),
+                torch.cat([_left_pad(bv, width), _left_pad(v, width)], dim=0),
+            )
+            for (bk, bv), (k, v) in zip(self._layers, layers)
+        ]
+        self._mask = torch.cat([_left_pad(self._mask, width), _left_pad(mask, width)], dim=0)
+
+    def _retain(self, keep: list[int]) -> None:
+        self._rows = [self._rows[i] for i in keep]
+        if not keep:
+            self._layers, self._mask = [], None
+            return
+        index = torch.tensor(keep, device=self.device)
+        mask = self._mask.index_select(0, index)
+        # Drop leading columns that are now padding for every remaining row
+        start = int(mask.any(dim=0).nonzero()[0])
+        self._mask = mask[:, start:]
+        self._layers = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self._layers
+        ]
+
+    def _save_conversation(self, request: GenerationRequest, layers) -> None:
+        """Cache the KV of every token fed through the model: the prompt plus all but the last sampled token."""
+        if self.conversation_cache is None or request.cache_key is None:
+            return
+        seq_len = layers[0][0].shape[2]
+        token_ids = request.input_ids + request.generated_ids[:seq_len - len(request.input_ids)]
+        self.conversation_cache.store(request.cache_key, token_ids, layers)
+
+    def _emit(self, request: GenerationRequest, token: int) -> bool:
+        """Deliver one sampled token; returns True when the request is finished."""
+        if request.trace is not None:
+            self._trace_step(request)
+        if token in self.eos_token_ids and not request.ignore_eos:
+            self._finish(request, "stop")
+            return True
+        request.generated_ids.append(token)
+        if request.trace is not None:
+            request.emitted_at.append(time.perf_counter())
+        request.output.put(token)
+        if request.completion_tokens >= request.max_new_tokens:
+            self._finish(request, "length")
+            return True
+        return False
+
+    def _trace_step(self, request: GenerationRequest) -> None:
+        """Record the current decode step for a traced request, before its token is handed off (which may end the trace)"""
+        if self._step_started is None or id(request) in self._step_traced:
+            return  # a prefill token, or a second token from one (speculative) step
+        self._step_traced.add(id(request))
+        start, batch_size = self._step_started
+        request.trace.complete("decode_step", start, time.perf_counter(), batch_size=batch_size)
+
+    def _finish(self, request: GenerationRequest, reason: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+        request.finish(reason, error)
+
+    def _fail_all(self, error: BaseException) -> None:
+        for row in self._rows:
+            self._finish(row.request, error=error)
+        self._rows, self._layers, self._mask = [], [], None
+        if self._held is not None:
+            self._pending.put(self._held)
+            self._held = None
+        while True:
+            try:
+                request = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(request, _Exclusive):
+                request.fail(error)
+            elif request is not None:
+                for r in (request, *request.forks):
+                    self._finish(r, error=error)
+
+    # ===== Sampling =====
+    def _sample(self, logits: torch.Tensor, requests: list[GenerationRequest]) -> list[int]:
+        logits = logits.float()
+        for i, request in enumerate(requests):
+            if request.logits_processor is not None:
+                request.logits_processor(request.generated_ids, logits[i])
+        greedy = logits.argmax(dim=-1)
+        temps = torch.tensor([r.temperature for r in requests], device=logits.device)
+        if bool((temps <= 0).all()):
+            return greedy.tolist()
+
+        top_p = torch.tensor([r.top_p for r in requests], device=logits.device)
+        sampled = torch.multinomial(sampling_probs(logits, temps, top_p), num_samples=1).squeeze(1)
+        return torch.where(temps <= 0, greedy, sampled).tolist()
+
+
+def sampling_probs(logits: torch.Tensor, temperature: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    """Per-row sampling distribution after temperature scaling and nucleus (top-p) filtering."""
+    probs = torch.softmax(logits.float() / temperature.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    # Nucleus filter: drop tokens once the mass before them already exceeds top_p
+    sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p.unsqueeze(1)] = 0.0
+    filtered = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+    return filtered / filtered.sum(dim=-1, keepdim=True)
+
+
+def _left_pad(t: torch.Tensor, width: int) -> torch.Tensor:
+    """Pad the sequence axis (dim 2 for KV, dim 1 for masks) on the left with zeros up to `width`."""
+    dim = 2 if t.dim() == 4 else 1
+    missing = width - t.shape[dim]
+    if missing <= 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = missing
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
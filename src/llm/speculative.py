@@ -0,0 +1,185 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from transformers import DynamicCache
+
+from src.llm import metrics
+from src.llm.kv_cache import KVLayers, kv_slice
+from src.llm.scheduler import BatchScheduler, GenerationRequest, sampling_probs
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class _Draft:
+    """The draft model's KV for the sequence being speculated on; it may lag behind the sequence"""
+    request: GenerationRequest
+    layers: KVLayers = field(default_factory=list)
+    length: int = 0                 # tokens covered by layers
+
+
+class SpeculativeScheduler(BatchScheduler):
+    """
+    Scheduler that decodes with speculative sampling while one sequence is active.
+
+    Each step, a small draft model proposes up to `num_speculative_tokens`
+    tokens autoregressively and the main model scores all of them in a single
+    forward pass. Greedy requests accept drafts while they match the main
+    model's argmax. Sampled requests use the rejection rule of Leviathan et
+    al. (2023): accept with probability min(1, p/q), otherwise resample from
+    max(0, p - q), which leaves the output distribution identical to sampling
+    from the main model alone.
+
+    Acceptance lengths differ per sequence, so verifying several sequences
+    would take one pass each and give up cross-sequence batching. With more
+    than one sequence active the step is therefore BatchScheduler's batched
+    decode; speculation resumes once a single sequence remains. A lone
+    sequence's batch KV has no padding, so both step kinds share it as is;
+    only the draft model's cache is extra, and it catches up on tokens
+    decoded without it.
+    """
+
+    def __init__(self, model, tokenizer, draft_model, num_speculative_tokens: int = 4, **kwargs):
+        super().__init__(model, tokenizer, **kwargs)
+        self.draft_model = draft_model
+        self.num_speculative_tokens = max(1, num_speculative_tokens)
+        # Models in one family may pad their embedding matrices differently
+        self.vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+        self._draft: Optional[_Draft] = None
+        self.proposed = 0
+        self.accepted = 0
+        self.batched_steps = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "draft_tokens_proposed": self.proposed,
+            "draft_tokens_accepted": self.accepted,
+            "acceptance_rate": self.acceptance_rate,
+            "num_speculative_tokens": self.num_speculative_tokens,
+            "batched_steps": self.batched_steps,
+        }
+
+    # ===== Scheduler hooks =====
+    def _step(self) -> None:
+        if len(self._rows) > 1:
+            self.batched_steps += 1
+            super()._step()
+        elif self._speculate(self._rows[0]):
+            self._retain([])
+
+    def _retain(self, keep: list[int]) -> None:
+        super()._retain(keep)
+        if self._draft is not None and all(row.request is not self._draft.request for row in self._rows):
+            self._draft = None
+
+    # ===== Speculation =====
+    def _speculate(self, row) -> bool:
+        """Run one draft/verify round for the only active row; returns True when its request is finished."""
+        request = row.request
+        tokens = request.input_ids + request.generated_ids
+        greedy = request.temperature <= 0
+        k = min(self.num_speculative_tokens, request.max_new_tokens - request.completion_tokens)
+        if self._draft is None or self._draft.request is not request:
+            self._draft = _Draft(request)
+        draft = self._draft
+
+        # Draft k tokens (the draft model may lag by the tokens accepted last round, or decoded in a batch)
+        drafts, draft_probs = [], []
+        feed = tokens[draft.length:]
+        for _ in range(k):
+            logits = self._draft_forward(draft, feed)
+            self._constrain(request, drafts, logits.unsqueeze(0), first=len(drafts))
+            if greedy:
+                token = int(logits.argmax())
+            else:
+                q = self._probs(logits.unsqueeze(0), request)[0]
+                token = int(torch.multinomial(q, 1))
+                draft_probs.append(q)
+            drafts.append(token)
+            feed = [token]
+
+        # Verify: one main-model pass over the pending token plus all drafts
+        cached = len(tokens) - 1
+        out = self.model(
+            input_ids=torch.tensor([[tokens[-1]] + drafts], device=self.device),
+            position_ids=torch.arange(cached, cached + k + 1, device=self.device).unsqueeze(0),
+            past_key_values=DynamicCache(self._layers),
+            use_cache=True,
+        )
+        logits = out.logits[0, :, :self.vocab_size].float()
+        self._constrain(request, drafts, logits)
+
+        if greedy:
+            best = logits.argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < k and best[accepted] == drafts[accepted]:
+                accepted += 1
+            next_token = best[accepted]
+        else:
+            p = self._probs(logits, request)
+            accepted, next_token = 0, None
+            while accepted < k:
+                d = drafts[accepted]
+                if float(torch.rand(())) * float(draft_probs[accepted][d]) <= float(p[accepted, d]):
+                    accepted += 1
+                    continue
+                residual = (p[accepted] - draft_probs[accepted]).clamp(min=0)
+                next_token = int(torch.multinomial(residual if residual.sum() > 0 else p[accepted], 1))
+                break
+            if next_token is None:
+                next_token = int(torch.multinomial(p[k], 1))
+
+        self.proposed += k
+        self.accepted += accepted
+        metrics.SPEC_PROPOSED.inc(k)
+        metrics.SPEC_ACCEPTED.inc(accepted)
+
+        # Keep KV only for tokens that are now part of the sequence
+        length = cached + 1 + accepted
+        self._layers = kv_slice([(kk, v) for kk, v, *_ in out.past_key_values], 0, length)
+        self._mask = self._mask.new_ones((1, length))
+        if draft.length > length:
+            draft.length = length
+            draft.layers = kv_slice(draft.layers, 0, length)
+
+        for token in drafts[:accepted] + [next_token]:
+            if self._emit(request, token):
+                seen = len(request.input_ids) + request.completion_tokens - 1
+                self._save_conversation(request, kv_slice(self._layers, 0, seen))
+                return True
+        row.last_token = next_token
+        return False
+
+    @staticmethod
+    def _constrain(request: GenerationRequest, drafts: list[int], logits: torch.Tensor, first: int = 0) -> None:
+        """Apply the request's logits processor to each row; row j follows the first `first + j` drafts."""
+        if request.logits_processor is None:
+            return
+        for j in range(logits.shape[0]):
+            request.logits_processor(request.generated_ids + drafts[:first + j], logits[j])
+
+    def _draft_forward(self, draft: _Draft, feed: list[int]) -> torch.Tensor:
+        """Feed `feed` to the draft model on top of its cache; returns the last position's logits."""
+        out = self.draft_model(
+            input_ids=torch.tensor([feed], device=self.draft_model.device),
+            position_ids=torch.arange(draft.length, draft.length + len(feed), device=self.draft_model.device).unsqueeze(0),
+            past_key_values=DynamicCache(draft.layers) if draft.layers else None,
+            use_cache=True,
+        )
+        draft.layers = [(k, v) for k, v, *_ in out.past_key_values]
+        draft.length += len(feed)
+        return out.logits[0, -1, :self.vocab_size].float().to(self.device)
+
+    def _probs(self, logits: torch.Tensor, request: GenerationRequest) -> torch.Tensor:
+        n = logits.shape[0]
+        return sampling_probs(
+            logits,
+            torch.full((n,), request.temperature, device=logits.device),
+            torch.full((n,), request.top_p, device=logits.device),
+        )
@@ -0,0 +1,90 @@
+import re
+import time
+import weakref
+
+_BYTE_TOKEN = re.compile(r"<0x[0-9A-Fa-f]{2}>")
+_byte_tokens: "weakref.WeakKeyDictionary[object, frozenset[int]]" = weakref.WeakKeyDictionary()
+
+
+def byte_fallback_ids(tokenizer) -> frozenset[int]:
+    """Ids of SentencePiece byte-fallback tokens ("<0xE2>"), computed once per tokenizer"""
+    ids = _byte_tokens.get(tokenizer)
+    if ids is None:
+        ids = _byte_tokens[tokenizer] = frozenset(
+            i for token, i in tokenizer.get_vocab().items() if _BYTE_TOKEN.fullmatch(token)
+        )
+    return ids
+
+
+class IncrementalDetokenizer:
+    """
+    Token ids in, text chunks out, decoding only a small window per token.
+
+    The window is the tokens whose text was emitted last time plus the new
+    ones: decoding that context again and keeping only the text past it
+    gets leading-space and merge rules right (SentencePiece "▁", byte-level
+    BPE). If the window ends in an incomplete UTF-8 sequence ("�") or in a
+    byte-fallback token (a run of them decodes as a whole), its text is held
+    back until the next token settles it.
+    TextStreamer instead re-decodes everything since the last line break
+    on every token.
+
+    Text is flushed by drain() once `every_tokens` tokens have arrived since
+    the last flush, or `every_ms` milliseconds have passed (checked as
+    tokens arrive; 0 disables the time limit). end() flushes the rest.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True, every_tokens: int = 1, every_ms: float = 0.0):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.every_tokens = max(1, every_tokens)
+        self.every_s = max(0.0, every_ms) / 1000
+        # Tokens that never settle the window: byte-fallback runs, and skipped special tokens (no text of their own)
+        self._held_ids = byte_fallback_ids(tokenizer) | (set(tokenizer.all_special_ids) if skip_special_tokens else set())
+        self.ids: list[int] = []
+        self._prefix = 0  # window start: context for the tokens after _read
+        self._read = 0  # tokens whose text has been produced
+        self._prefix_text = ""  # decode(ids[_prefix:_read])
+        self._text: list[str] = []  # produced, not yet drained
+        self._tokens = 0  # tokens since the last flush
+        self._flushed_at = time.perf_counter()
+        self._ended = False
+
+    def _decode(self, ids: list[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def put_token(self, token_id: int) -> None:
+        self.ids.append(token_id)
+        self._tokens += 1
+        if token_id in self._held_ids:
+            return
+        text = self._decode(self.ids[self._prefix:])
+        if len(text) > len(self._prefix_text) and not text.endswith("�"):
+            self._text.append(text[len(self._prefix_text):])
+            self._prefix, self._read = self._read, len(self.ids)
+            self._prefix_text = self._decode(self.ids[self._prefix:self._read])
+
+    def end(self) -> None:
+        """Produce whatever is still held back (an incomplete character decodes as "�") and flush on drain()"""
+        if self._read < len(self.ids):
+            text = self._decode(self.ids[self._prefix:])
+            if len(text) > len(self._prefix_text):
+                self._text.append(text[len(self._prefix_text):])
+            self._read = len(self.ids)
+        self._ended = True
+
+    def drain(self) -> list[str]:
+        """The text produced since the last flush, as one chunk, once a flush is due; otherwise []"""
+        if not self._text:
+            return []
+        now = time.perf_counter()
+        due = (
+            self._ended
+            or self._tokens >= self.every_tokens
+            or (self.every_s > 0 and now - self._flushed_at >= self.every_s)
+        )
+        if not due:
+            return []
+        chunk = "".join(self._text)
+        self._text, self._tokens, self._flushed_at = [], 0, now
+        return [chunk]
@@ -0,0 +1,184 @@
+"""
+Opt-in per-request tracing, exported as Chrome trace-event JSON
+(open in https://ui.perfetto.dev or chrome://tracing).
+
+A Trace collects timed spans from every thread that works on a request:
+templating and tokenization on the caller's thread, prefill and decode
+steps on the scheduler thread, token handoff and detokenization back on the
+caller's. Code paths take an optional trace and call `span(trace, ...)`,
+which is a no-op when tracing is off.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Trace:
+    def __init__(self, name: str = "request", profile_interval_s: float = 0.0):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        # Sample the scheduler thread's stack every interval while the request runs (0 = off)
+        self.profile_interval_s = profile_interval_s
+        self.started = time.perf_counter()
+        self._events: list[dict] = []
+        self._threads: dict[tuple[int, int], str] = {}  # (pid, tid) -> thread name
+        self._lock = threading.Lock()
+
+    def complete(self, name: str, start: float, end: float, tid: Optional[int] = None,
+                 thread_name: Optional[str] = None, **args) -> None:
+        """Record a span from perf_counter() timestamps `start` to `end`"""
+        if tid is None:
+            tid, thread_name = threading.get_ident(), threading.current_thread().name
+        event = {
+            "name": name, "ph": "X", "pid": os.getpid(), "tid": tid,
+            "ts": (start - self.started) * 1e6, "dur": max(end - start, 0.0) * 1e6,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault((event["pid"], tid), thread_name or str(tid))
+
+    def merge(self, events: list[dict], started: float) -> None:
+        """
+        Add the trace events of a trace recorded in another process (see
+        src/llm/replicas.py) that started at perf_counter() `started`; the
+        clocks agree where perf_counter() is system-wide (CLOCK_MONOTONIC).
+        """
+        shift = (started - self.started) * 1e6
+        with self._lock:
+            for event in events:
+                if event["ph"] == "M":
+                    self._threads.setdefault((event["pid"], event["tid"]), event["args"]["name"])
+                else:
+                    self._events.append({**event, "ts": event["ts"] + shift})
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.perf_counter(), **args)
+
+    def to_chrome(self) -> dict:
+        with self._lock:
+            names = [
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                for (pid, tid), name in self._threads.items()
+            ]
+            return {
+                "traceEvents": names + sorted(self._events, key=lambda e: e["ts"]),
+                "displayTimeUnit": "ms",
+                "otherData": {"trace_id": self.id, "name": self.name},
+            }
+
+
+def span(trace: Optional[Trace], name: str, **args):
+    """`trace.span(name)`, or a shared no-op context when the request is not traced"""
+    return trace.span(name, **args) if trace is not None else _NO_SPAN
+
+
+def trace_requested(header: Optional[str], setting: str, profile_interval_ms: float) -> Optional[Trace]:
+    """
+    A new Trace if the request asked for one (X-Trace header) or TRACE is on.
+    "1"/"true" traces; "profile" also samples the decode loop's stack.
+    """
+    mode = (header or setting or "").strip().lower()
+    if mode in ("", "0", "false", "off", "no"):
+        return None
+    return Trace(profile_interval_s=profile_interval_ms / 1000 if mode == "profile" else 0.0)
+
+
+class SamplingProfiler:
+    """
+    Samples one thread's Python stack (normally the scheduler's decode loop)
+    every `interval_s` and records it into a trace as nested spans, one per
+    frame, on a separate "profiler" track: a flame chart over time.
+    """
+
+    def __init__(self, trace: Trace, thread: threading.Thread, interval_s: float):
+        self.trace = trace
+        self.target = thread
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._open: list[tuple[str, float]] = []  # frames (root first) of the last sample, with start times
+        self.samples = 0
+
+    def start(self) -> "SamplingProfiler":
+        self._sampler = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.target.ident)
+            if frame is not None:
+                self._sample(_stack(frame), time.perf_counter())
+        self._sample([], time.perf_counter())  # close every open frame
+
+    def _sample(self, stack: list[str], now: float) -> None:
+        self.samples += 1
+        same = 0
+        while same < min(len(stack), len(self._open)) and stack[same] == self._open[same][0]:
+            same += 1
+        # Own track next to the sampled thread's: thread idents are aligned addresses, so +1 is never a real one
+        tid = self.target.ident + 1
+        for name, start in reversed(self._open[same:]):
+            self.trace.complete(name, start, now, tid=tid, thread_name=f"profiler: {self.target.name}")
+        self._open = self._open[:same] + [(name, now) for name in stack[same:]]
+
+
+def _stack(frame) -> list[str]:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return names[::-1]
+
+
+class TraceStore:
+    """The most recent finished traces, for GET /debug/traces/<id>; also written to `directory` when set"""
+
+    def __init__(self, max_traces: int = 64):
+        self.max_traces = max_traces
+        self._traces: OrderedDict[str, Trace] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace, directory: str = "") -> Optional[str]:
+        """Keep a finished trace; returns the file it was written to, if any"""
+        with self._lock:
+            self._traces[trace.id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"trace-{trace.id}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace.to_chrome(), f)
+        return path
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        with self._lock:
+            return self._traces.get(trace_id)
+
+    def ids(self) -> list[str]:
+        with self._lock:
+            return list(self._traces)
@@ -1,5 +1,5 @@
 from PyQt6.QtCore import QObject, QThread, pyqtSignal
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from .engine import LLMEngine
 
 class GenerateWorker(QObject):
@@ -7,17 +7,29 @@ class GenerateWorker(QObject):
     done_signal = pyqtSignal()         # signals completion
     error_signal = pyqtSignal(str)     # emits error string
 
-    def __init__(self, engine: LLMEngine, system_prompt: str, history: List[Tuple[str, str]], user_msg: str):
+    def __init__(self, engine: LLMEngine, system_prompt: str, history: List[Tuple[str, str]], user_msg: str,
+                 conversation_id: Optional[str] = None):
         super().__init__()
         self.engine = engine
         self.system_prompt = system_prompt
         self.history = history
         self.user_msg = user_msg
+        self.conversation_id = conversation_id
+        # Nothing is queued until run() starts iterating, so stop() works at any point
+        self.stream = engine.generate_stream(system_prompt, history, user_msg, conversation_id=conversation_id)
 
     def run(self):
         try:
-            for chunk in self.engine.generate_stream(self.system_prompt, self.history, self.user_msg):
+            for chunk in self.stream:
                 self.token_signal.emit(chunk)
             self.done_signal.emit()
         except Exception as e:
-            self.error_signal.emit(str(e))
\ No newline at end of file
+            self.error_signal.emit(str(e))
+
+    def stop(self):
+        """Cancel the reply; call directly from the GUI thread (run() keeps this worker's thread busy)"""
+        self.stream.cancel()
+
+    @property
+    def stopped(self) -> bool:
+        return self.stream.finish_reason == "cancelled"
\ No newline at end of file
@@ -0,0 +1,95 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class StoredMessage:
+    id: int
+    role: str      # "user", "assistant" or "info" (status lines such as "Model ready.")
+    content: str
+
+
+class ConversationStore:
+    """
+    SQLite-backed chat transcript.
+
+    Every message is written here as it is added, so the GUI only needs to
+    keep the messages on screen in memory and can page older ones back in
+    with `page()`. `path` may be ":memory:" for a throwaway store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " conversation TEXT NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id)")
+        self._db.commit()
+
+    def append(self, conversation: str, role: str, content: str) -> int:
+        cur = self._db.execute(
+            "INSERT INTO messages (conversation, role, content, created) VALUES (?, ?, ?, ?)",
+            (conversation, role, content, time.time()),
+        )
+        self._db.commit()
+        return cur.lastrowid
+
+    def update(self, message_id: int, content: str) -> None:
+        self._db.execute("UPDATE messages SET content = ? WHERE id = ?", (content, message_id))
+        self._db.commit()
+
+    def count(self, conversation: str) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM messages WHERE conversation = ?", (conversation,)).fetchone()[0]
+
+    def page(
+        self, conversation: str, before_id: Optional[int] = None, limit: int = 50, after_id: Optional[int] = None,
+    ) -> list[StoredMessage]:
+        """
+        Up to `limit` messages preceding `before_id` (default: the latest ones),
+        or following `after_id` when that is given, oldest first
+        """
+        if after_id is not None:
+            rows = self._db.execute(
+                "SELECT id, role, content FROM messages WHERE conversation = ? AND id > ? ORDER BY id LIMIT ?",
+                (conversation, after_id, limit),
+            ).fetchall()
+            return [StoredMessage(*row) for row in rows]
+        rows = self._db.execute(
+            "SELECT id, role, content FROM messages WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (conversation, before_id if before_id is not None else 2**63 - 1, limit),
+        ).fetchall()
+        return [StoredMessage(*row) for row in reversed(rows)]
+
+    def turns(self, conversation: str, limit: Optional[int] = None) -> list[tuple[str, str]]:
+        """
+        Completed (user, assistant) exchanges, in order, for building the next
+        prompt; only the last `limit` when given, read newest first so older
+        rows are never fetched
+        """
+        rows = self._db.execute(
+            "SELECT role, content FROM messages WHERE conversation = ? AND role IN ('user', 'assistant')"
+            " ORDER BY id DESC",
+            (conversation,),
+        )
+        turns, reply = [], None
+        for role, content in rows:
+            if limit is not None and len(turns) >= limit:
+                break
+            if role == "assistant":
+                reply = content  # the reply right after a user message is the one that answers it
+            elif reply is not None:
+                turns.append((content, reply))
+                reply = None
+        turns.reverse()
+        return turns
+
+    def close(self) -> None:
+        self._db.close()
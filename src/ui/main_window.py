@@ -1,12 +1,20 @@
+import dataclasses
+import threading
+import uuid
+from typing import Callable
+
 from PyQt6.QtWidgets import (
-    QWidget, QVBoxLayout, QTextEdit, QPushButton, QHBoxLayout,
-    QMessageBox, QLabel, QComboBox, QDialog, QDialogButtonBox, QMenuBar
+    QWidget, QVBoxLayout, QTextEdit, QPushButton, QHBoxLayout, QListView,
+    QMessageBox, QLabel, QComboBox, QDialog, QDialogButtonBox, QMenuBar, QAbstractItemView
 )
 from PyQt6.QtCore import QThread, pyqtSignal, QObject, QTimer, Qt
 from PyQt6.QtGui import QAction
 from src.config import Config, save_env
 from src.llm.engine import LLMEngine
 from src.llm.worker import GenerateWorker
+from src.ui.conversation_store import ConversationStore
+from src.ui.stream_renderer import StreamRenderer
+from src.ui.transcript import MessageDelegate, TranscriptModel
 
 
 class SettingsDialog(QDialog):
@@ -59,7 +67,7 @@ class SettingsDialog(QDialog):
 
 
 class LoadWorker(QObject):
-    success_signal = pyqtSignal()
+    success_signal = pyqtSignal(object)  # the loaded engine
     error_signal = pyqtSignal(str)
 
     def __init__(self, engine: LLMEngine):
@@ -69,15 +77,26 @@ class LoadWorker(QObject):
     def run(self):
         try:
             self.engine.load()
-            self.success_signal.emit()
+            self.success_signal.emit(self.engine)
         except Exception as e:
             self.error_signal.emit(str(e))
 
 
 class MainWindow(QWidget):
-    def __init__(self, cfg: Config):
+    # Emitted with the new engine whenever a model finishes loading
+    engine_changed = pyqtSignal(object)
+
+    def __init__(self, cfg: Config, engine: LLMEngine | None = None,
+                 swap: Callable[[LLMEngine], threading.Event] | None = None):
+        """
+        `swap`, given when the engine is shared (start_both.py), hands a reloaded
+        engine to the other front-end, which switches to it and unloads the old
+        one once its in-flight requests finish (see ModelRegistry.swap).
+        """
         super().__init__()
         self.cfg = cfg
+        self._swap = swap
+        self._serving_cfg: Config | None = None  # settings of the engine still in use while a reload loads
 
         # Menu Bar
         self.menu_bar = QMenuBar(self)
@@ -86,19 +105,26 @@ class MainWindow(QWidget):
         settings_action.triggered.connect(self.open_settings)
         file_menu.addAction(settings_action)
 
-        # UI
-        self.chat = QTextEdit(self)
-        self.chat.setReadOnly(True)
+        # UI: the transcript is a list view, so only visible messages are laid out and painted
+        self.chat = QListView(self)
+        self.chat.setItemDelegate(MessageDelegate(self.chat))
+        self.chat.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.chat.setResizeMode(QListView.ResizeMode.Adjust)
+        self.chat.setSelectionMode(QListView.SelectionMode.NoSelection)
+        self.chat.setWordWrap(True)
         self.input = QTextEdit(self)
         self.input.setAcceptRichText(False)
         self.input.setFixedHeight(30)  # Approximate single-line height
         self.input.setLineWrapMode(QTextEdit.LineWrapMode.WidgetWidth)  # Enable wrapping
         self.input.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)  # Show scrollbar if needed
         self.send_btn = QPushButton("Send", self)
+        self.stop_btn = QPushButton("Stop", self)
+        self.stop_btn.setEnabled(False)
 
         btn_row = QHBoxLayout()
         btn_row.addWidget(self.input)
         btn_row.addWidget(self.send_btn)
+        btn_row.addWidget(self.stop_btn)
 
         root = QVBoxLayout()
         root.addWidget(self.menu_bar)
@@ -109,25 +135,32 @@ class MainWindow(QWidget):
         # Window title reflects current cfg
         self.update_title()
 
-        # LLM
-        self.engine = LLMEngine(cfg)
-        self.history: list[tuple[str, str]] = []  # [(user, assistant)]
-        self._last_user_msg: str | None = None
-        self._current_reply: str = ""
-        self._reply_cursor = None     # QTextCursor for in-place updates
-        self._reply_block_pos = None  # int: starting position of this reply block
+        # LLM (may be shared with the API server, see start_both.py)
+        self.engine = engine if engine is not None else LLMEngine(cfg)
+        self.conversation_id = uuid.uuid4().hex  # lets the engine reuse KV cache between turns
+        # Every message is persisted; the view keeps only the latest ones and pages older ones in on scroll
+        self.store = ConversationStore(cfg.chat_db)
+        self.transcript = TranscriptModel(self.store, self.conversation_id, parent=self)
+        self.chat.setModel(self.transcript)
+        self.chat.verticalScrollBar().valueChanged.connect(self.on_scroll)
+        self._reply_id: int | None = None  # transcript message being streamed into
+        self._renderer = StreamRenderer(self.append_reply_text, parent=self)  # at most one append per frame
         self._thinking_timer = QTimer(self)  # Timer for thinking animation
         self._thinking_dots = 0  # Counter for dots in animation
 
         # Wire up events
         self.send_btn.clicked.connect(self.on_send)
+        self.stop_btn.clicked.connect(self.on_stop)
         self.input.textChanged.connect(self.check_input)  # Enable send on valid input
         self._thinking_timer.timeout.connect(self.update_thinking_animation)
 
         # Show initial messages and start background model load
-        self.append_sys(f"Loading model: {self.cfg.model_id} ...")
         self.send_btn.setEnabled(False)
-        self.start_loader_thread()
+        if self.engine.model is not None:
+            self.on_model_ready()
+        else:
+            self.append_sys(f"Loading model: {self.cfg.model_id} ...")
+            self.start_loader_thread()
 
         # Final window tweaks
         self.update_title()
@@ -137,39 +170,53 @@ class MainWindow(QWidget):
         self.setWindowTitle(f"HF Local Chat (PyQt6) — {self.cfg.model_id} [{self.cfg.precision}]")
 
     def append_sys(self, text: str):
-        self.chat.append(f"<i>{text}</i>")
-        self.chat.ensureCursorVisible()
+        self.transcript.add_message("info", text)
+        self.chat.scrollToBottom()
 
     def append_user(self, text: str):
-        self.chat.append(f"<b>You:</b> {text}")
-        self.chat.ensureCursorVisible()
-
-    def append_assistant_line(self, text: str):
-        cursor = self.chat.textCursor()
-        if self._reply_block_pos is None:
-            # Start a new block
-            self.chat.append("")
-            self._reply_block_pos = cursor.position()
-            self._reply_cursor = cursor
-        else:
-            # Move to the reply block
-            cursor.setPosition(self._reply_block_pos)
-            cursor.movePosition(cursor.MoveOperation.EndOfBlock, cursor.MoveMode.KeepAnchor)
-            cursor.removeSelectedText()
-        # Insert new text
-        cursor.insertHtml(f"<b>Assistant:</b> {text}")
-        self.chat.setTextCursor(cursor)
-        self.chat.ensureCursorVisible()
+        self.transcript.add_message("user", text)
+        self.chat.scrollToBottom()
+
+    def begin_reply(self):
+        """Start the assistant's message; streamed text is then appended to it in place"""
+        self._thinking_dots = 0
+        self._reply_id = self.transcript.add_message("assistant", status="Thinking")
+        self.chat.scrollToBottom()
+        self._thinking_timer.start(500)  # Update every 500ms
+
+    def append_reply_text(self, text: str):
+        """Append newly streamed text to the reply; earlier text is never laid out again"""
+        self._thinking_timer.stop()
+        scrollbar = self.chat.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        self.transcript.append_text(self._reply_id, text)
+        if at_bottom:  # follow the reply unless the user scrolled up to read
+            self.chat.scrollToBottom()
 
     def update_thinking_animation(self):
         self._thinking_dots = (self._thinking_dots + 1) % 4
-        dots = "." * self._thinking_dots
-        self.append_assistant_line(f"Thinking{dots}")
+        self.transcript.set_status(self._reply_id, f"Thinking{'.' * self._thinking_dots}")
+
+    def on_scroll(self, value: int):
+        # Reaching either end pages messages in from the store (dropping rows at the other end),
+        # keeping the row that was at that end in view
+        scrollbar = self.chat.verticalScrollBar()
+        hint = QAbstractItemView.ScrollHint
+        if value == scrollbar.minimum() and self.transcript.has_older:
+            added = self.transcript.load_older()
+            if added:
+                self.chat.doItemsLayout()
+                self.chat.scrollTo(self.transcript.index(added), hint.PositionAtTop)
+        elif value == scrollbar.maximum() and self.transcript.has_newer:
+            added = self.transcript.load_newer()
+            if added:
+                self.chat.doItemsLayout()
+                self.chat.scrollTo(self.transcript.index(self.transcript.rowCount() - added - 1), hint.PositionAtBottom)
 
     # ===== Threaded model loading =====
-    def start_loader_thread(self):
+    def start_loader_thread(self, engine: LLMEngine | None = None):
         self.loader_thread = QThread(self)
-        self.loader = LoadWorker(self.engine)
+        self.loader = LoadWorker(engine or self.engine)
         self.loader.moveToThread(self.loader_thread)
 
         self.loader_thread.started.connect(self.loader.run)
@@ -183,9 +230,15 @@ class MainWindow(QWidget):
 
         QTimer.singleShot(0, lambda: self.loader_thread.start())
 
-    def on_model_ready(self):
+    def on_model_ready(self, engine: LLMEngine | None = None):
+        if engine is not None and engine is not self.engine:
+            # Loaded next to the shared engine, which kept serving: switch over and let the API drain it
+            self.engine = engine
+            self._serving_cfg = None
+            self._swap(engine)
         self.append_sys("Model ready.")
         self.send_btn.setEnabled(True)
+        self.engine_changed.emit(self.engine)
 
     # ===== Sending & streaming =====
     def check_input(self):
@@ -197,20 +250,25 @@ class MainWindow(QWidget):
         if not msg:
             return
         self.send_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
         self.input.setReadOnly(True)  # Lock input during generation
 
         self.input.clear()
+        # Earlier exchanges, read back from the store: only as many as the context policy could keep
+        context = self.engine.context
+        limit = context.max_turns(self.engine.cfg.max_new_tokens) if context is not None else None
+        history = self.store.turns(self.conversation_id, limit=limit)
         self.append_user(msg)
-        self._last_user_msg = msg
 
-        # Start thinking animation
-        self._reply_block_pos = None
-        self._current_reply = ""
-        self._thinking_timer.start(500)  # Update every 500ms
+        # Show the reply block with a thinking animation until the first tokens arrive
+        self.begin_reply()
 
         # Start generation worker
         self.worker_thread = QThread(self)
-        self.worker = GenerateWorker(self.engine, self.cfg.chat_system_prompt, self.history, msg)
+        self.worker = GenerateWorker(
+            self.engine, self.cfg.chat_system_prompt, history, msg,
+            conversation_id=self.conversation_id,
+        )
         self.worker.moveToThread(self.worker_thread)
 
         self.worker_thread.started.connect(self.worker.run)
@@ -226,38 +284,62 @@ class MainWindow(QWidget):
         self.worker_thread.start()
 
     def on_token(self, text: str):
-        # Accumulate tokens internally, don't update UI yet
-        self._current_reply += text
+        # Rendered by the next frame, together with anything else that arrives before it
+        self._renderer.push(text)
+
+    def on_stop(self):
+        # The engine drops the request before its next decode step; on_done follows
+        self.stop_btn.setEnabled(False)
+        self.worker.stop()
 
     def on_done(self):
-        # Stop thinking animation and show final reply
+        # Render the tail of the reply and persist it (it becomes history for the next turn)
+        self._renderer.flush()
         self._thinking_timer.stop()
-        self.append_assistant_line(self._current_reply)
-        if self._last_user_msg is not None:
-            self.history.append((self._last_user_msg, self._current_reply))
+        self.transcript.finish(self._reply_id)
+        if self.worker.stopped:
+            self.append_sys("Stopped.")
         self.send_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.input.setReadOnly(False)
 
     # ===== Settings & reload =====
     def open_settings(self):
         dlg = SettingsDialog(self, self.cfg)
         if dlg.exec():
+            if self.stop_btn.isEnabled():
+                QMessageBox.information(self, "Settings", "Wait for the reply to finish (or stop it) before switching models.")
+                return
             model_id, precision = dlg.values()
             save_env(model_id, precision)
-            self.cfg.model_id = model_id
-            self.cfg.precision = precision
+            # A new Config: the current one stays with the engine that is still loaded (and may be serving the API)
+            previous, self.cfg = self.cfg, dataclasses.replace(self.cfg, model_id=model_id, precision=precision)
             self.update_title()
 
             # Reload model in background
             self.append_sys(f"Reloading model: {self.cfg.model_id} ({self.cfg.precision}) ...")
             self.send_btn.setEnabled(False)
 
-            self.engine = LLMEngine(self.cfg)
-            self.start_loader_thread()
+            if self._swap is None:
+                # Nobody else uses the engine: free the current weights first, so both never sit in memory together
+                self.engine.unload()
+                self.engine = LLMEngine(self.cfg)
+                self.start_loader_thread()
+            else:
+                # The API keeps serving the current engine until the new one is ready (on_model_ready swaps them)
+                self._serving_cfg = previous
+                self.start_loader_thread(LLMEngine(self.cfg))
 
     # ===== Error handling =====
     def on_error(self, err: str):
         self._thinking_timer.stop()
+        if self._serving_cfg is not None:  # the reload failed; the engine it was to replace is still in use
+            self.cfg, self._serving_cfg = self._serving_cfg, None
+            self.update_title()
+        if self._reply_id is not None:
+            self._renderer.flush()
+            self.transcript.finish(self._reply_id)
         self.send_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.input.setReadOnly(False)
         QMessageBox.critical(self, "Error", err)
\ No newline at end of file
@@ -0,0 +1,37 @@
+from typing import Callable
+
+from PyQt6.QtCore import QObject, QTimer
+
+
+class StreamRenderer(QObject):
+    """
+    Coalesces streamed text into at most one UI update per frame.
+
+    push() only buffers the chunk; a single-shot timer hands everything
+    buffered since the last frame to `sink` in one call. The sink is expected
+    to append just that text, so the cost of a frame depends on how much text
+    arrived, not on how long the reply already is.
+    """
+
+    def __init__(self, sink: Callable[[str], None], interval_ms: int = 33, parent=None):
+        super().__init__(parent)
+        self._sink = sink
+        self._pending: list[str] = []
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self.flush)
+
+    def push(self, text: str) -> None:
+        if not text:
+            return
+        self._pending.append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self) -> None:
+        """Render whatever is buffered now (called by the frame timer, and once more when the reply ends)."""
+        self._timer.stop()
+        if self._pending:
+            text, self._pending = "".join(self._pending), []
+            self._sink(text)
@@ -0,0 +1,224 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from PyQt6.QtCore import QAbstractListModel, QModelIndex, QSize, Qt
+from PyQt6.QtGui import QTextCharFormat, QTextCursor, QTextDocument
+from PyQt6.QtWidgets import QStyledItemDelegate
+
+from src.ui.conversation_store import ConversationStore
+
+DocumentRole = Qt.ItemDataRole.UserRole + 1
+
+PREFIXES = {"user": "You: ", "assistant": "Assistant: ", "info": ""}
+
+
+@dataclass
+class _Message:
+    id: int
+    role: str
+    content: str
+    status: str = ""                          # e.g. "Thinking..." while a reply has no text yet
+    doc: Optional[QTextDocument] = None       # laid-out text, built when the row is first painted
+
+
+class TranscriptModel(QAbstractListModel):
+    """
+    The visible window of a conversation stored in a ConversationStore.
+
+    At most `max_rows` messages are kept in memory, a window that starts at the
+    newest ones; the rest stay in the store. Scrolling to the top pages older
+    messages in with `load_older()` and scrolling back down pages newer ones in
+    with `load_newer()`, each dropping rows from the other end. Text streamed
+    into a reply is appended to that message's document in place, so earlier
+    text is not laid out again; a reply keeps streaming while it is paged out.
+    """
+
+    def __init__(self, store: ConversationStore, conversation: str, page_size: int = 50, max_rows: int = 200,
+                 parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.conversation = conversation
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self._replies: dict[int, _Message] = {}  # assistant messages until finish(), loaded or not
+        self._messages: list[_Message] = []
+        self._has_older = self._has_newer = False
+        self._load_latest()
+
+    # ===== Qt model interface =====
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._messages)
+
+    def data(self, index: QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self._messages[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return PREFIXES.get(message.role, "") + (message.content or message.status)
+        if role == DocumentRole:
+            if message.doc is None:
+                message.doc = _build_document(message)
+            return message.doc
+        return None
+
+    # ===== Editing =====
+    def add_message(self, role: str, content: str = "", status: str = "") -> int:
+        """Append (and persist) a message; returns its id"""
+        if self._has_newer:  # paged away from the end: show the latest messages again first
+            self.beginResetModel()
+            self._load_latest()
+            self.endResetModel()
+        message_id = self.store.append(self.conversation, role, content)
+        message = _Message(message_id, role, content, status)
+        if role == "assistant":
+            self._replies[message_id] = message
+        row = len(self._messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._messages.append(message)
+        self.endInsertRows()
+        self._trim()
+        return message_id
+
+    def append_text(self, message_id: int, text: str) -> None:
+        """Append streamed text to a message; only the new text is inserted into its document"""
+        row, message = self._find(message_id)
+        if message is None:
+            return
+        if message.status:
+            self.set_status(message_id, "")
+        message.content += text
+        if message.doc is not None:
+            cursor = QTextCursor(message.doc)
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+            cursor.insertText(text, QTextCharFormat())
+        if row >= 0:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def set_status(self, message_id: int, status: str) -> None:
+        row, message = self._find(message_id)
+        if message is None or message.status == status:
+            return
+        message.status = status
+        message.doc = None  # rebuilt on next paint; cheap, as statuses only show while there is no text
+        if row >= 0:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def finish(self, message_id: int) -> str:
+        """Persist a streamed message's final text and return it"""
+        row, message = self._find(message_id)
+        if message is None:
+            return ""
+        self.set_status(message_id, "")
+        self.store.update(message_id, message.content)
+        self._replies.pop(message_id, None)
+        return message.content
+
+    # ===== Paging =====
+    @property
+    def has_older(self) -> bool:
+        return self._has_older
+
+    @property
+    def has_newer(self) -> bool:
+        return self._has_newer
+
+    def load_older(self) -> int:
+        """Page in the messages before the first loaded one; returns how many were added"""
+        if not self._has_older:
+            return 0
+        before = self._messages[0].id if self._messages else None
+        older = self.store.page(self.conversation, before_id=before, limit=self.page_size)
+        self._has_older = len(older) == self.page_size
+        if older:
+            self.beginInsertRows(QModelIndex(), 0, len(older) - 1)
+            self._messages[:0] = [self._loaded(m) for m in older]
+            self.endInsertRows()
+            self._trim(newest=True)
+        return len(older)
+
+    def load_newer(self) -> int:
+        """Page in the messages after the last loaded one; returns how many were added"""
+        if not self._has_newer:
+            return 0
+        after = self._messages[-1].id if self._messages else 0
+        newer = self.store.page(self.conversation, after_id=after, limit=self.page_size)
+        self._has_newer = len(newer) == self.page_size
+        if newer:
+            row = len(self._messages)
+            self.beginInsertRows(QModelIndex(), row, row + len(newer) - 1)
+            self._messages.extend(self._loaded(m) for m in newer)
+            self.endInsertRows()
+            self._trim()
+        return len(newer)
+
+    def _load_latest(self) -> None:
+        self._messages = [self._loaded(m) for m in self.store.page(self.conversation, limit=self.page_size)]
+        self._has_older = self.store.count(self.conversation) > len(self._messages)
+        self._has_newer = False
+
+    def _loaded(self, stored) -> _Message:
+        # A reply still streaming has newer text than the store
+        return self._replies.get(stored.id) or _Message(stored.id, stored.role, stored.content)
+
+    def _trim(self, newest: bool = False) -> None:
+        """
+        Drop loaded rows beyond `max_rows` (they remain in the store): the
+        oldest, or the newest after paging older ones in
+        """
+        excess = len(self._messages) - self.max_rows
+        if excess <= 0:
+            return
+        first = len(self._messages) - excess if newest else 0
+        self.beginRemoveRows(QModelIndex(), first, first + excess - 1)
+        del self._messages[first:first + excess]
+        self.endRemoveRows()
+        if newest:
+            self._has_newer = True
+        else:
+            self._has_older = True
+
+    def _find(self, message_id: int) -> tuple[int, Optional[_Message]]:
+        # Messages being edited are the newest ones; scan from the end
+        for row in range(len(self._messages) - 1, -1, -1):
+            if self._messages[row].id == message_id:
+                return row, self._messages[row]
+        return -1, self._replies.get(message_id)  # paged out while streaming
+
+
+def _build_document(message: _Message) -> QTextDocument:
+    doc = QTextDocument()
+    doc.setDocumentMargin(4)
+    cursor = QTextCursor(doc)
+    prefix = PREFIXES.get(message.role, "")
+    if prefix:
+        bold = QTextCharFormat()
+        bold.setFontWeight(700)
+        cursor.insertText(prefix, bold)
+    fmt = QTextCharFormat()
+    fmt.setFontItalic(message.role == "info" or not message.content)  # status lines and placeholders
+    cursor.insertText(message.content or message.status, fmt)
+    return doc
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """Paints each message from its cached QTextDocument, wrapped to the view's width."""
+
+    def _document(self, index: QModelIndex, width: int) -> QTextDocument:
+        doc = index.data(DocumentRole)
+        if doc.textWidth() != width:
+            doc.setTextWidth(width)
+        return doc
+
+    def paint(self, painter, option, index):
+        doc = self._document(index, option.rect.width())
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        doc.drawContents(painter)
+        painter.restore()
+
+    def sizeHint(self, option, index) -> QSize:
+        width = max(self.parent().viewport().width() if self.parent() is not None else option.rect.width(), 50)
+        doc = self._document(index, width)
+        return QSize(width, int(doc.size().height()))
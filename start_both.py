@@ -9,15 +9,16 @@ from dotenv import load_dotenv
 
 # Import from your existing code
 from src.config import Config
+from src.llm.engine import LLMEngine
 from src.utils.logging import setup_logging
 from src.ui.main_window import MainWindow
 
 # Import API server
 import api_server
 
-def run_api_server():
+def run_api_server(engine: LLMEngine):
     """Run Flask server in background thread"""
-    api_server.main()
+    api_server.main(shared_engine=engine)
 
 def main():
     """Launch both API and GUI"""
@@ -28,20 +29,26 @@ def main():
     print("🚀 Starting Local LLM (API + GUI)")
     print("="*60 + "\n")
     
-    # Start API server in daemon thread
+    # One engine (and one request queue) serves both the API and the GUI
+    cfg = Config()
+    engine = LLMEngine(cfg)
+    
+    # Start API server in daemon thread; it loads the shared engine
     print("📡 Starting Flask API server...")
-    api_thread = threading.Thread(target=run_api_server, daemon=True)
+    api_thread = threading.Thread(target=run_api_server, args=(engine,), daemon=True)
     api_thread.start()
     
-    # Give API time to initialize
-    import time
-    time.sleep(3)
+    # Wait until the model is loaded and the server is listening
+    api_server.ready.wait()
+    if api_server.startup_error is not None:
+        print(f"❌ API server failed to start: {api_server.startup_error}")
+        sys.exit(1)
     
     # Start GUI in main thread
     print("🖥️  Starting GUI...")
     app = QApplication(sys.argv)
-    cfg = Config()
-    win = MainWindow(cfg)
+    # After a reload in Settings the API switches to the new engine and unloads the old one once it has drained
+    win = MainWindow(cfg, engine=engine, swap=lambda new: api_server.set_engine(new, unload_old=True))
     win.resize(900, 700)
     win.setWindowTitle("Local LLM - API Server Running on :5000")
     win.show()
@@ -1,5 +1,6 @@
 import os
 import sys
+import pytest
 from pathlib import Path
 
 # Ensure repo root on path so `src` is importable when running pytest from root
@@ -12,6 +13,36 @@ def pytest_runtest_setup(item):
     for k in list(os.environ.keys()):
         if k in {
             "MODEL_ID","PRECISION","MAX_NEW_TOKENS","TEMPERATURE",
-            "TOP_P","DEVICE_MAP","SYSTEM_PROMPT"
+            "TOP_P","DEVICE_MAP","SYSTEM_PROMPT","MAX_BATCH_SIZE",
+            "KV_CACHE_MB","PREFIX_CACHE_MB","PREFIX_BLOCK_SIZE",
+            "MAX_CONCURRENT_GENERATIONS","MAX_QUEUE_DEPTH","REQUEST_TIMEOUT","RETRY_AFTER",
+            "DRAFT_MODEL_ID","NUM_SPECULATIVE_TOKENS",
+            "RESPONSE_CACHE_MB","RESPONSE_CACHE_DIR","RESPONSE_CACHE_DISK_MB",
+            "SERVED_MODELS","MODEL_MEMORY_MB","ADMIN_TOKEN","WEIGHT_CACHE_DIR","CHAT_DB",
+            "CONTEXT_TOKENS","CONTEXT_POLICY","CONTEXT_KEEP_TURNS","CONTEXT_SUMMARY_TOKENS","BATCH_JOB_SIZE","BATCH_DIR",
+            "CPU_THREADS","CPU_INTEROP_THREADS","TORCH_COMPILE",
+            "EMBEDDING_POOLING","EMBEDDING_BATCH_SIZE","EMBEDDING_CACHE_MB",
+            "TRACE","TRACE_DIR","TRACE_PROFILE_INTERVAL_MS","REPLICAS","REPLICA_THREADS",
+            "GRAMMAR_CACHE_SIZE","STREAM_CHUNK_TOKENS","STREAM_CHUNK_MS"
         }:
             os.environ.pop(k, None)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from benchmarks.tiny_model import build_tiny_model
+
+    return build_tiny_model(tmp_path_factory.mktemp("tiny-model"))
+
+
+@pytest.fixture(scope="session")
+def tiny_engine(tiny_model_dir):
+    from src.config import Config
+    from src.llm.engine import LLMEngine
+
+    eng = LLMEngine(Config(model_id=tiny_model_dir, device_map="cpu", max_batch_size=4))
+    eng.load()
+    yield eng
+    eng.scheduler.stop()
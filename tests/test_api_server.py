@@ -0,0 +1,103 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("flask")
+
+import api_server
+
+
+@pytest.fixture
+def client(tiny_engine, monkeypatch):
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    monkeypatch.setattr(tiny_engine.response_cache, "max_bytes", 0)  # exercise generation, not memoized replies
+    return api_server.app.test_client()
+
+
+def _body(**extra):
+    return {"messages": [{"role": "user", "content": "hello world"}], "max_tokens": 8, "temperature": 0, **extra}
+
+
+def test_completion_returns_message(client):
+    resp = client.post("/v1/chat/completions", json=_body())
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["object"] == "chat.completion"
+    assert isinstance(data["choices"][0]["message"]["content"], str)
+
+
+def test_missing_user_message_is_rejected(client):
+    resp = client.post("/v1/chat/completions", json={"messages": [{"role": "system", "content": "x"}]})
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize("body", ["{not json", "[1, 2]", '"hi"', '{"messages": "hi"}', '{"messages": [1]}'])
+def test_malformed_body_is_rejected(client, body):
+    resp = client.post("/v1/chat/completions", data=body, content_type="application/json")
+    assert resp.status_code == 400 and "error" in resp.get_json()
+
+
+def test_streaming_matches_non_streaming(client):
+    full = client.post("/v1/chat/completions", json=_body()).get_json()
+    resp = client.post("/v1/chat/completions", json=_body(stream=True))
+    assert resp.mimetype == "text/event-stream"
+
+    events = [line[len("data: "):] for line in resp.get_data(as_text=True).split("\n\n") if line]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    assert all(c["object"] == "chat.completion.chunk" for c in chunks)
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert chunks[-1]["choices"][0]["finish_reason"] == full["choices"][0]["finish_reason"]
+
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+    assert text == full["choices"][0]["message"]["content"]
+
+
+def test_usage_counts_tokens(client, tiny_engine):
+    data = client.post("/v1/chat/completions", json=_body()).get_json()
+    usage = data["usage"]
+    assert usage["prompt_tokens"] > 0
+    assert 0 < usage["completion_tokens"] <= 8
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+    if data["choices"][0]["finish_reason"] == "length":
+        assert usage["completion_tokens"] == 8
+
+
+def test_health_gathers_engine_stats_once(client, tiny_engine, monkeypatch):
+    calls = []
+    stats = tiny_engine.stats
+    monkeypatch.setattr(tiny_engine, "stats", lambda: calls.append(1) or stats())
+    health = client.get("/health").get_json()
+    assert len(calls) == 1
+    assert health["context"] is not None and health["grammars"] is not None and health["replicas"] is None
+
+
+def test_metrics_endpoint(client):
+    client.post("/v1/chat/completions", json=_body())
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    text = resp.get_data(as_text=True)
+    for name in (
+        "llm_queue_wait_seconds_count",
+        "llm_tokenize_seconds_count",
+        "llm_prefill_seconds_count",
+        "llm_inter_token_seconds_bucket",
+        "llm_requests_in_flight 0",
+        "llm_prefix_cache_hit_ratio",
+    ):
+        assert name in text
+
+
+def test_client_disconnect_cancels_generation(client, tiny_engine):
+    body = _body(stream=True, max_tokens=1_500, ignore_eos=True)  # long, but within the context
+    resp = client.post("/v1/chat/completions", json=body, buffered=False)
+    next(iter(resp.response))
+    resp.close()
+    deadline = time.monotonic() + 5
+    while tiny_engine.scheduler.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert tiny_engine.scheduler.active == 0
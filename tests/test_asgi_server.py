@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")
+
+from starlette.testclient import TestClient
+
+import asgi_server
+from src.llm.admission import AdmissionController, Saturated
+from src.llm.registry import ModelRegistry
+
+BODY = {"messages": [{"role": "user", "content": "hello world"}], "max_tokens": 8, "temperature": 0}
+
+
+@pytest.fixture
+def client(tiny_engine, monkeypatch):
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    asgi_server.registry.add(tiny_engine, pinned=True)
+    monkeypatch.setattr(asgi_server, "admission", AdmissionController(2, 2))
+    monkeypatch.setattr(tiny_engine.response_cache, "max_bytes", 0)  # exercise generation, not memoized replies
+    return TestClient(asgi_server.app)  # no lifespan: the engine is already loaded
+
+
+def test_completion_and_stream_agree(client):
+    full = client.post("/v1/chat/completions", json=BODY).json()
+    resp = client.post("/v1/chat/completions", json={**BODY, "stream": True})
+    events = [e[len("data: "):] for e in resp.text.split("\n\n") if e]
+    assert events[-1] == "[DONE]"
+    text = "".join(json.loads(e)["choices"][0]["delta"].get("content", "") for e in events[:-1])
+    assert text == full["choices"][0]["message"]["content"]
+    assert asgi_server.admission.running == 0
+
+
+@pytest.mark.parametrize("body", ["{not json", "[1, 2]", '"hi"', '{"messages": "hi"}', '{"messages": [1]}'])
+def test_malformed_body_is_rejected(client, body):
+    resp = client.post("/v1/chat/completions", content=body, headers={"Content-Type": "application/json"})
+    assert resp.status_code == 400 and "error" in resp.json()
+
+
+def test_not_ready_returns_503(client, monkeypatch):
+    monkeypatch.setattr(asgi_server, "engine", None)
+    resp = client.post("/v1/chat/completions", json=BODY)
+    assert resp.status_code == 503
+    assert "Retry-After" in resp.headers
+
+
+def test_saturated_returns_429(client, monkeypatch):
+    full = AdmissionController(1, 0, retry_after=2)
+    full.running = 1
+    monkeypatch.setattr(asgi_server, "admission", full)
+    resp = client.post("/v1/chat/completions", json=BODY)
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "2"
+
+
+def test_admission_queue_timeout():
+    async def scenario():
+        ctl = AdmissionController(1, 1)
+        slot = await ctl.acquire()
+        with pytest.raises(Saturated) as err:
+            await ctl.acquire(timeout=0.01)
+        assert err.value.status == 503
+        slot.release()
+        slot.release()  # idempotent
+        assert (await ctl.acquire(timeout=0.01)) is not None
+        assert ctl.running == 1
+
+    asyncio.run(scenario())
+
+
+def test_embeddings(client):
+    resp = client.post("/v1/embeddings", json={"input": ["hello", "world"], "encoding_format": "base64"})
+    assert resp.status_code == 200
+    assert [d["index"] for d in resp.json()["data"]] == [0, 1]
+    assert client.post("/v1/embeddings", json={"input": 3}).status_code == 400
+    assert asgi_server.admission.running == 0
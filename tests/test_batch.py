@@ -0,0 +1,127 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+
+from src.llm.batch import BatchItem, BatchJob
+
+QUESTIONS = ["hi", "the quick brown fox jumps over the lazy dog. " * 6, "café naïve", "how are you today?" * 3, "ok"]
+
+
+def _write_requests(path, questions=QUESTIONS, **body):
+    with open(path, "w", encoding="utf-8") as f:
+        for i, q in enumerate(questions):
+            request = {"messages": [{"role": "user", "content": q}], "max_tokens": 6, "temperature": 0, **body}
+            f.write(json.dumps({"custom_id": f"q{i}", "body": request}) + "\n")
+
+
+def _read(path) -> dict[str, dict]:
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    results = {line["custom_id"]: line for line in lines}
+    assert len(results) == len(lines)  # each request answered once
+    return results
+
+
+def test_generate_batch_matches_streaming(tiny_engine):
+    prompts = [tiny_engine.encode_prompt("sys", [], q, 8) for q in QUESTIONS]
+    results = tiny_engine.generate_batch(prompts, 8, temperature=0, top_p=1.0)
+    for q, (ids, reason) in zip(QUESTIONS, results):
+        stream = tiny_engine.generate_stream("sys", [], q, max_new_tokens=8, temperature=0)
+        assert tiny_engine.tokenizer.decode(ids, skip_special_tokens=True) == "".join(stream)
+        assert reason == stream.finish_reason
+
+
+def test_live_streams_keep_decoding_during_a_batch(tiny_engine):
+    live = tiny_engine.generate_stream("sys", [], "live", max_new_tokens=400, ignore_eos=True)
+    next(live)
+    before = live.request.completion_tokens
+    prompts = [tiny_engine.encode_prompt("sys", [], q, 30) for q in QUESTIONS * 2]
+    tiny_engine.generate_batch(prompts, 30, temperature=0, top_p=1.0)
+    assert live.request.completion_tokens - before >= 30  # decoded alongside the batch, not stalled by it
+    live.close()
+
+
+def test_buckets_group_sampling_settings_and_sort_by_length(tiny_engine):
+    job = BatchJob(tiny_engine, "in.jsonl", "out.jsonl", batch_size=2)
+    items = [BatchItem(f"r{n}", [0] * n, 8, t, 1.0) for n, t in [(5, 0), (1, 0.7), (9, 0), (3, 0), (2, 0.7)]]
+    buckets = [[i.custom_id for i in bucket] for bucket in job._buckets(items)]
+    assert buckets == [["r3", "r5"], ["r9"], ["r1", "r2"]]
+
+
+def test_job_writes_results_and_resumes(tiny_engine, tmp_path):
+    src, out = tmp_path / "requests.jsonl", tmp_path / "results.jsonl"
+    _write_requests(src)
+    hi = [{"role": "user", "content": "hi"}]
+    with open(src, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"custom_id": "bad", "body": {"messages": []}}) + "\n")
+        f.write(json.dumps({"custom_id": "str", "body": {"messages": hi, "max_tokens": "16"}}) + "\n")
+        f.write(json.dumps({"custom_id": "temp", "body": {"messages": hi, "temperature": None}}) + "\n")
+        f.write(json.dumps({"custom_id": "top_p", "body": {"messages": hi, "top_p": 2}}) + "\n")
+
+    job = BatchJob(tiny_engine, str(src), str(out), batch_size=2)
+    job.run()
+    status = job.status()
+    assert status["status"] == "completed"
+    assert status["request_counts"] == {"total": 9, "completed": 5, "failed": 4, "resumed": 0}
+    full = _read(out)
+    assert full["bad"]["error"]["message"] == "No user message provided"
+    assert "max_tokens" in full["str"]["error"]["message"]
+    assert "temperature" in full["temp"]["error"]["message"] and "top_p" in full["top_p"]["error"]["message"]
+    body = full["q2"]["response"]["body"]
+    assert body["object"] == "chat.completion" and body["usage"]["completion_tokens"] > 0
+
+    # Simulate a crash after two results, halfway through writing the third
+    lines = out.read_text(encoding="utf-8").splitlines(keepends=True)
+    out.write_text("".join(lines[:2]) + lines[2][:10], encoding="utf-8")
+    resumed = BatchJob(tiny_engine, str(src), str(out), batch_size=2)
+    resumed.run()
+    assert resumed.status()["request_counts"]["resumed"] == 2
+    results = _read(out)
+    assert results.keys() == full.keys()
+    for custom_id, line in results.items():
+        if line["response"]:
+            assert line["response"]["body"]["choices"] == full[custom_id]["response"]["body"]["choices"]
+
+
+def test_batches_endpoint(tiny_engine, tmp_path, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    src = tmp_path / "requests.jsonl"
+    _write_requests(src)
+    client = api_server.app.test_client()
+    assert client.post("/v1/batches", json={"input_file": str(src)}).status_code == 403  # no ADMIN_TOKEN
+
+    monkeypatch.setattr(api_server.config, "admin_token", "s3cret")
+    monkeypatch.setattr(api_server.config, "batch_dir", str(tmp_path))
+    headers = {"Authorization": "Bearer s3cret"}
+    assert client.post("/v1/batches", json={"input_file": "requests.jsonl"}).status_code == 401
+    for body in (
+        {"input_file": "missing.jsonl"},
+        {"input_file": str(tmp_path / ".." / "requests.jsonl")},
+        {"input_file": "requests.jsonl", "output_file": "/tmp/out.jsonl"},
+        {"input_file": 7},
+    ):
+        assert client.post("/v1/batches", json=body, headers=headers).status_code == 400, body
+    (tmp_path / "link").symlink_to("/etc")
+    assert client.post("/v1/batches", json={"input_file": "link/hostname"}, headers=headers).status_code == 400
+
+    resp = client.post("/v1/batches", json={"input_file": "requests.jsonl", "batch_size": 4}, headers=headers)
+    assert resp.status_code == 200
+    batch_id = resp.get_json()["id"]
+    deadline = time.monotonic() + 60
+    while (status := client.get(f"/v1/batches/{batch_id}").get_json())["status"] != "completed":
+        assert status["status"] in ("validating", "in_progress") and time.monotonic() < deadline, status
+        time.sleep(0.01)
+    assert status["request_counts"]["completed"] == len(QUESTIONS)
+    assert len(_read(status["output_file"])) == len(QUESTIONS)
+    while api_server.registry.stats()["models"][0]["in_use"]:  # the lease is released as the job ends
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert client.get("/v1/batches/batch_nope").status_code == 404
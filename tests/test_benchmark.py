@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from benchmarks.run import compare_precisions, percentiles, run_benchmark
+
+
+def test_percentiles():
+    p = percentiles([float(i) for i in range(1, 101)])
+    assert (p["p50"], p["p95"], p["p99"]) == (51.0, 95.0, 99.0)
+    assert percentiles([])["p50"] is None
+
+
+@pytest.mark.parametrize("mode", ["engine", "api"])
+def test_benchmark_report(tiny_model_dir, mode):
+    report = run_benchmark(
+        mode=mode, model=tiny_model_dir, concurrency=2, requests=4, prompt_tokens=16, max_new_tokens=4
+    )
+    assert report["requests"] == 4
+    assert report["completion_tokens"] == 16  # ignore_eos makes output length exact
+    assert report["latency_s"]["p99"] >= report["latency_s"]["p50"] > 0
+    assert report["ttft_s"]["p50"] is not None
+    assert report["tokens_per_s"] > 0
+
+
+def test_compare_precisions(tiny_model_dir):
+    report = compare_precisions(["fp32", "cpu-int8"], model=tiny_model_dir, concurrency=2, requests=2,
+                                prompt_tokens=16, max_new_tokens=4)
+    assert report["relative"]["fp32"]["tokens_per_s"] == 1.0
+    assert report["runs"]["cpu-int8"]["completion_tokens"] == 8
+    assert report["relative"]["cpu-int8"]["model_mb"] < 1.0  # int8 weights
@@ -0,0 +1,99 @@
+import json
+import time
+
+import pytest
+
+from src.llm.tracing import Trace
+
+
+def _collect(choices, n: int) -> list[str]:
+    texts = [""] * n
+    for index, chunk in choices:
+        texts[index] += chunk
+    return texts
+
+
+def test_choices_share_one_prefill(tiny_engine):
+    trace = Trace()
+    choices = tiny_engine.generate_choices("sys", [], "tell me a story", 3, max_new_tokens=12, temperature=1.0, trace=trace)
+    texts = _collect(choices, 3)
+    assert len(set(texts)) > 1  # independently sampled
+    assert [e["name"] for e in trace.to_chrome()["traceEvents"]].count("prefill") == 1
+
+    prompt = choices.usage["prompt_tokens"]
+    assert prompt > 0 and all(r.cached_tokens == choices.requests[0].cached_tokens for r in choices.requests)
+    assert choices.usage["completion_tokens"] == sum(r.completion_tokens for r in choices.requests)
+    assert choices.finish_reasons == [r.finish_reason for r in choices.requests]
+
+    single = "".join(tiny_engine.generate_stream("sys", [], "tell me a story", max_new_tokens=12, temperature=0))
+    assert _collect(tiny_engine.generate_choices("sys", [], "tell me a story", 2, max_new_tokens=12, temperature=0), 2) == [single] * 2
+
+
+def test_choices_wait_for_room_in_the_batch(tiny_engine):
+    long = tiny_engine.generate_stream("sys", [], "long", max_new_tokens=60, ignore_eos=True)
+    next(long)
+    # 1 + 4 rows exceed max_batch_size=4: the group is held until the long request retires
+    texts = _collect(tiny_engine.generate_choices("sys", [], "four", 4, max_new_tokens=5, ignore_eos=True), 4)
+    assert all(texts)
+    assert "".join(long) and long.finish_reason == "length"
+
+
+def test_cancelling_choices_stops_every_fork(tiny_engine):
+    choices = tiny_engine.generate_choices("sys", [], "go", 3, max_new_tokens=2000, ignore_eos=True)
+    next(choices)  # the first chunk can arrive before the rows have joined the batch
+    choices.close()
+    deadline = time.monotonic() + 10
+    while (None in choices.finish_reasons or tiny_engine.scheduler.active) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert choices.finish_reasons == ["cancelled"] * 3 and choices.finish_reason == "cancelled"
+    assert all(r.completion_tokens < 2000 for r in choices.requests)
+
+
+def test_flask_n(tiny_engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    client = api_server.app.test_client()
+    body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 8, "n": 3}
+
+    data = client.post("/v1/chat/completions", json=body).get_json()
+    assert [c["index"] for c in data["choices"]] == [0, 1, 2]
+    assert data["usage"]["completion_tokens"] <= 3 * 8
+
+    resp = client.post("/v1/chat/completions", json={**body, "stream": True})
+    events = [json.loads(line[6:]) for line in resp.get_data(as_text=True).splitlines()
+              if line.startswith("data: {")]
+    finished = {e["choices"][0]["index"] for e in events if e["choices"][0]["finish_reason"]}
+    assert finished == {0, 1, 2}
+
+    for bad in (0, 5, "2", True):
+        assert client.post("/v1/chat/completions", json={**body, "n": bad}).status_code == 400
+
+
+def test_asgi_n(tiny_engine, monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("httpx")
+    from starlette.testclient import TestClient
+
+    import asgi_server
+    from src.llm.registry import ModelRegistry
+
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    asgi_server.registry.add(tiny_engine, pinned=True)
+    client = TestClient(asgi_server.app)
+    body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 6, "n": 2, "temperature": 0}
+
+    plain = client.post("/v1/chat/completions", json=body).json()
+    assert len(plain["choices"]) == 2 and plain["choices"][0]["message"] == plain["choices"][1]["message"]
+    streamed = ["", ""]
+    for line in client.post("/v1/chat/completions", json={**body, "stream": True}).text.splitlines():
+        if line.startswith("data: {"):
+            choice = json.loads(line[6:])["choices"][0]
+            streamed[choice["index"]] += choice["delta"].get("content", "")
+    assert streamed == [plain["choices"][0]["message"]["content"]] * 2
+    assert client.post("/v1/chat/completions", json={**body, "n": 9}).status_code == 400
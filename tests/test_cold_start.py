@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+
+from src.config import Config
+from src.llm.engine import LLMEngine
+
+
+def _generate(engine: LLMEngine) -> str:
+    return "".join(engine.generate_stream("sys", [], "hello world", max_new_tokens=8, temperature=0, ignore_eos=True))
+
+
+def test_weight_cache_is_written_once_then_mapped(tiny_model_dir, tmp_path):
+    cfg = Config(model_id=tiny_model_dir, device_map="cpu", weight_cache_dir=str(tmp_path))
+    first = LLMEngine(cfg)
+    first.load()
+    try:
+        expected = _generate(first)
+        stats = first.progress.stats()
+        assert stats["phase"] == "ready" and stats["weight_cache"] == "miss"
+        assert {"imports", "tokenizer", "weights", "weight_cache_write", "scheduler"} <= set(stats["timings"])
+    finally:
+        first.unload()
+
+    (cached,) = os.listdir(tmp_path)
+    assert any(name.endswith(".safetensors") for name in os.listdir(tmp_path / cached))
+
+    second = LLMEngine(cfg)
+    second.load()
+    try:
+        assert second.progress.stats()["weight_cache"] == "hit"
+        assert "weight_cache_write" not in second.progress.timings
+        assert _generate(second) == expected
+    finally:
+        second.unload()
+
+
+def test_failed_load_is_reported(tmp_path):
+    engine = LLMEngine(Config(model_id=str(tmp_path / "missing"), device_map="cpu"))
+    with pytest.raises(Exception):
+        engine.load()
+    stats = engine.progress.stats()
+    assert stats["phase"] == "failed" and stats["error"]
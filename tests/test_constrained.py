@@ -0,0 +1,196 @@
+import json
+import re
+
+import pytest
+
+from src.llm.constrained import GrammarError, response_format_regex, schema_to_regex
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "maxLength": 6},
+        "mood": {"enum": ["happy", "sad"]},
+        "ok": {"type": "boolean"},
+        "count": {"type": "integer", "minimum": 0},
+        "tags": {"type": "array", "items": {"type": "string", "maxLength": 3}, "maxItems": 2},
+    },
+    "required": ["name", "mood", "ok"],
+}
+BIG_REGEX = "(a{1000}|b{1000}){25}"  # a valid regex with too many states to constrain decoding
+
+
+def _valid(value: dict) -> bool:
+    return (
+        isinstance(value["name"], str) and len(value["name"]) <= 6
+        and value["mood"] in ("happy", "sad")
+        and isinstance(value["ok"], bool)
+        and isinstance(value.get("count", 0), int) and value.get("count", 0) >= 0
+        and len(value.get("tags", [])) <= 2
+    )
+
+
+def test_schema_regex_matches_valid_documents_only():
+    pattern = schema_to_regex(SCHEMA)
+    for doc in (
+        '{"name": "bob", "mood": "sad", "ok": true}',
+        '{"name":"a\\"b","mood":"happy","ok":false,"count":12,"tags":["x", "yz"]}',
+        '{"name": "", "mood": "sad", "ok": true, "tags": []}',
+    ):
+        assert re.fullmatch(pattern, doc), doc
+        assert _valid(json.loads(doc))
+    for doc in (
+        '{"name": "bob", "ok": true}',  # missing required
+        '{"name": "toolongname", "mood": "sad", "ok": true}',
+        '{"name": "bob", "mood": "angry", "ok": true}',
+        '{"name": "bob", "mood": "sad", "ok": true, "count": -1}',
+    ):
+        assert not re.fullmatch(pattern, doc), doc
+
+    optional = schema_to_regex({"type": "object", "properties": {"a": {"type": "null"}, "b": {"const": 1}}})
+    assert all(re.fullmatch(optional, d) for d in ('{}', '{"a": null}', '{"b": 1}', '{"a":null,"b":1}'))
+    assert not re.fullmatch(optional, '{,"b": 1}')
+
+
+def test_schema_pattern_is_anchored_and_stays_valid_json():
+    pattern = schema_to_regex({"type": "string", "pattern": "^a.c|x[^y]*$"})
+    for doc in ('"abc"', '"a c"', '"x"', '"xzz"'):
+        assert re.fullmatch(pattern, doc), doc
+    for doc in ('"abcd"', '"zabc"', '"xy"', '"a"c"', '"a\\c"', '"a\nc"', '"x"}"'):
+        assert not re.fullmatch(pattern, doc), doc
+    # A pattern made only of characters JSON must escape matches nothing
+    assert not re.fullmatch(schema_to_regex({"type": "string", "pattern": '["]'}), '"""')
+
+
+def test_response_format_validation():
+    assert response_format_regex(None) is None
+    assert response_format_regex({"type": "text"}) is None
+    assert re.fullmatch(response_format_regex({"type": "json_object"}), '{"a": [1, {"b": null}], "c": "d"}')
+    assert response_format_regex({"type": "regex", "regex": r"\d{3}"}) == r"\d{3}"
+    for bad in (
+        "json",
+        {"type": "yaml"},
+        {"type": "json_schema", "json_schema": {}},
+        {"type": "json_schema", "json_schema": {"schema": {"type": "tuple"}}},
+        {"type": "regex", "regex": "(?=lookahead)"},
+        {"type": "regex", "regex": "(unclosed"},
+        {"type": "json_schema", "json_schema": {"schema": {"$ref": "#"}}},  # recursive
+    ):
+        with pytest.raises(GrammarError):
+            response_format_regex(bad)
+
+
+def test_constrained_generation_matches_schema_and_regex(tiny_engine):
+    schema = response_format_regex({"type": "json_schema", "json_schema": {"schema": SCHEMA}})
+    before = tiny_engine.grammars.stats()
+    for seed in range(3):
+        import torch
+
+        torch.manual_seed(seed)
+        stream = tiny_engine.generate_stream(
+            "sys", [], f"describe {seed}", max_new_tokens=200, temperature=1.0, grammar=schema,
+        )
+        text = "".join(stream)
+        assert stream.finish_reason == "stop", text
+        assert re.fullmatch(schema, text) and _valid(json.loads(text))
+
+    pattern = r"[a-c]{3}-\d{2}"
+    text = "".join(tiny_engine.generate_stream("sys", [], "code?", max_new_tokens=50, temperature=0, grammar=pattern))
+    assert re.fullmatch(pattern, text)
+
+    # The schema is compiled once; its masks are reused across requests
+    stats = tiny_engine.grammars.stats()
+    assert stats["misses"] - before["misses"] == 2 and stats["hits"] - before["hits"] == 2
+    assert stats["cached_masks"] > 0
+
+
+def test_masks_are_worked_out_when_the_grammar_is_compiled(tiny_engine, monkeypatch):
+    from src.llm.constrained import TokenAutomaton
+
+    pattern = r"(?:ab|cd){1,3}-[0-9]{2}"
+    automaton = tiny_engine.grammars.automaton(pattern)
+    assert automaton.token_states > 1
+
+    # Decoding on the scheduler thread never walks the vocabulary
+    def walk(self, state):
+        raise AssertionError(f"vocabulary walked for state {state} while decoding")
+
+    monkeypatch.setattr(TokenAutomaton, "_walk", walk)
+    for seed in range(3):
+        import torch
+
+        torch.manual_seed(seed)
+        stream = tiny_engine.generate_stream("sys", [], f"go {seed}", max_new_tokens=30, temperature=1.0, grammar=pattern)
+        text = "".join(stream)
+        assert stream.finish_reason == "stop" and re.fullmatch(pattern, text), text
+
+
+def test_speculative_decoding_respects_the_grammar(tiny_model_dir):
+    from src.config import Config
+    from src.llm.engine import LLMEngine
+
+    eng = LLMEngine(Config(model_id=tiny_model_dir, device_map="cpu", draft_model_id=tiny_model_dir, response_cache_mb=0))
+    eng.load()
+    try:
+        pattern = schema_to_regex(SCHEMA)
+        for temperature in (0, 1.0):
+            stream = eng.generate_stream("sys", [], "json please", max_new_tokens=200, temperature=temperature, grammar=pattern)
+            text = "".join(stream)
+            assert stream.finish_reason == "stop" and _valid(json.loads(text)), text
+        assert eng.scheduler.stats()["draft_tokens_proposed"] > 0
+    finally:
+        eng.unload()
+
+
+def test_api_response_format(tiny_engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    client = api_server.app.test_client()
+
+    bad = client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}],
+        "response_format": {"type": "json_schema", "json_schema": {"schema": {"type": "tuple"}}},
+    })
+    assert bad.status_code == 400 and "tuple" in bad.get_json()["error"]
+    # Parses as a regex, but is rejected when compiled for the vocabulary, before anything is queued
+    big = client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}],
+        "response_format": {"type": "regex", "regex": BIG_REGEX},
+    })
+    assert big.status_code == 400 and "too large" in big.get_json()["error"]
+    assert tiny_engine.scheduler.active == 0
+
+    resp = client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}],
+        "max_tokens": 200,
+        "temperature": 0,
+        "response_format": {"type": "json_schema", "json_schema": {"schema": SCHEMA}},
+    })
+    assert resp.status_code == 200
+    assert _valid(json.loads(resp.get_json()["choices"][0]["message"]["content"]))
+    assert client.get("/health").get_json()["grammars"]["compiled"] >= 1
+
+
+def test_asgi_rejects_an_oversized_grammar(tiny_engine, monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("httpx")
+    from starlette.testclient import TestClient
+
+    import asgi_server
+    from src.llm.admission import AdmissionController
+    from src.llm.registry import ModelRegistry
+
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    asgi_server.registry.add(tiny_engine, pinned=True)
+    monkeypatch.setattr(asgi_server, "admission", AdmissionController(2, 2))
+    resp = TestClient(asgi_server.app).post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}],
+        "response_format": {"type": "regex", "regex": BIG_REGEX},
+    })
+    assert resp.status_code == 400 and "too large" in resp.json()["error"]
+    assert tiny_engine.grammars.stats()["rejected"] >= 1
@@ -0,0 +1,103 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from src.llm.context import SUMMARY_HEADER, ContextManager, ContextOverflow, TokenCounter
+
+HISTORY = [(f"question number {i} about the quick brown fox", f"answer number {i}: the lazy dog") for i in range(30)]
+
+
+def _manager(tiny_engine, **kwargs) -> ContextManager:
+    return ContextManager(TokenCounter(tiny_engine.tokenizer), tiny_engine._build_prompt, 300, **kwargs)
+
+
+def _prompt_len(tiny_engine, system, history, user):
+    return len(tiny_engine.tokenizer(tiny_engine._build_prompt(system, history, user))["input_ids"])
+
+
+def test_drop_oldest_fits_budget_and_keeps_latest_turns(tiny_engine):
+    ctx = _manager(tiny_engine)
+    system, kept = ctx.fit("be brief", HISTORY, "and now?", max_new_tokens=50)
+    assert system == "be brief"
+    assert 0 < len(kept) < len(HISTORY) and kept == HISTORY[-len(kept):]
+    assert _prompt_len(tiny_engine, system, kept, "and now?") <= ctx.budget(50) + 2  # estimate vs. exact
+    assert ctx.stats()["truncated_prompts"] == 1
+    # Reading only max_turns of the history keeps the same turns
+    limit = ctx.max_turns(50)
+    assert len(kept) <= limit < len(HISTORY)
+    assert ctx.fit("be brief", HISTORY[-limit:], "and now?", max_new_tokens=50)[1] == kept
+
+    # Next turn: every earlier message is counted from the cache
+    misses = ctx.count.misses
+    ctx.fit("be brief", HISTORY + [("and now?", "nothing")], "next", max_new_tokens=50)
+    assert ctx.count.misses == misses + 2
+
+
+def test_last_n_keeps_only_recent_turns(tiny_engine):
+    ctx = _manager(tiny_engine, policy="last_n", keep_turns=2)
+    assert ctx.fit("sys", HISTORY, "hi", max_new_tokens=10)[1] == HISTORY[-2:]
+    assert ctx.max_turns(10) == 2
+
+
+def test_summarize_folds_dropped_turns(tiny_engine):
+    calls = []
+
+    def summarize(turns):
+        calls.append(turns)
+        return "they talked about foxes"
+
+    ctx = _manager(tiny_engine, policy="summarize", summary_tokens=20, summarize=summarize)
+    for _ in range(2):
+        system, kept = ctx.fit("sys", HISTORY, "hi", max_new_tokens=50)
+    assert system.endswith(f"{SUMMARY_HEADER}\nthey talked about foxes")
+    assert calls[0] + kept == HISTORY
+    assert len(calls) == 1  # the same fold is summarized once
+    assert ctx.max_turns(50) is None  # the summary needs every dropped turn
+
+
+def test_oversized_message_is_rejected(tiny_engine):
+    with pytest.raises(ContextOverflow):
+        _manager(tiny_engine).fit("sys", [], "fox " * 400, max_new_tokens=50)
+
+
+def test_engine_trims_long_history(tiny_engine):
+    long_history = HISTORY * 20
+    stream = tiny_engine.generate_stream("sys", long_history, "hello", max_new_tokens=4, temperature=0)
+    "".join(stream)
+    assert stream.usage["prompt_tokens"] <= tiny_engine.context.context_tokens - 4
+
+
+def test_api_rejects_prompt_that_cannot_fit(tiny_engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    body = {"messages": [{"role": "user", "content": "fox " * 3000}], "max_tokens": 8}
+    client = api_server.app.test_client()
+    for extra in ({}, {"stream": True}, {"stream": True, "n": 2}, {"n": 2}):
+        resp = client.post("/v1/chat/completions", json={**body, **extra})
+        assert resp.status_code == 400, extra
+        assert "fit" in resp.get_json()["error"]
+
+
+def test_asgi_rejects_prompt_that_cannot_fit(tiny_engine, monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("httpx")
+    from starlette.testclient import TestClient
+
+    import asgi_server
+    from src.llm.registry import ModelRegistry
+
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    asgi_server.registry.add(tiny_engine, pinned=True)
+    client = TestClient(asgi_server.app)
+    body = {"messages": [{"role": "user", "content": "fox " * 3000}], "max_tokens": 8, "temperature": 0.5}
+    for extra in ({}, {"stream": True}, {"stream": True, "n": 2}):
+        resp = client.post("/v1/chat/completions", json={**body, **extra})
+        assert resp.status_code == 400, extra
+        assert "fit" in resp.json()["error"]
+    assert asgi_server.admission.stats()["running"] == 0  # the slot was given back
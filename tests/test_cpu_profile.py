@@ -0,0 +1,40 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.config import Config
+from src.llm.engine import LLMEngine
+
+
+@pytest.fixture(scope="module")
+def int8_engine(tiny_model_dir):
+    eng = LLMEngine(Config(model_id=tiny_model_dir, precision="cpu-int8", device_map="auto", response_cache_mb=0))
+    eng.load()
+    yield eng
+    eng.unload()
+
+
+def test_cpu_int8_quantizes_linear_layers(int8_engine, tiny_engine):
+    quantized = [m for m in int8_engine.model.modules() if isinstance(m, torch.ao.nn.quantized.dynamic.Linear)]
+    assert quantized and not any(type(m) is torch.nn.Linear for m in int8_engine.model.modules())
+    assert int8_engine.model.device.type == "cpu"
+    assert "quantize" in int8_engine.progress.timings
+    assert 0 < int8_engine.model_bytes < tiny_engine.model_bytes
+
+    stream = int8_engine.generate_stream("sys", [], "hello", max_new_tokens=6, temperature=0, ignore_eos=True)
+    "".join(stream)
+    assert stream.usage["completion_tokens"] == 6
+
+
+def test_thread_counts_and_compile_from_config(tiny_model_dir, monkeypatch):
+    compiled = []
+    monkeypatch.setattr(torch, "compile", lambda fn, **kwargs: compiled.append(kwargs) or fn)
+    threads = torch.get_num_threads()
+    eng = LLMEngine(Config(model_id=tiny_model_dir, device_map="cpu", cpu_threads=threads + 1, torch_compile=True))
+    try:
+        eng.load()
+        assert torch.get_num_threads() == threads + 1
+        assert compiled == [{"dynamic": True}]
+    finally:
+        torch.set_num_threads(threads)
+        eng.unload()
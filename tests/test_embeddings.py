@@ -0,0 +1,83 @@
+import base64
+
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from src.llm.embeddings import EmbeddingCache, decode_vector
+
+TEXTS = ["hello world", "the quick brown fox jumps over the lazy dog. " * 4, "café", "how are you today?"]
+
+
+def _vectors(blobs) -> np.ndarray:
+    return np.stack([np.frombuffer(b, dtype="<f4") for b in blobs])
+
+
+@pytest.fixture
+def engine(tiny_engine, monkeypatch):
+    monkeypatch.setattr(tiny_engine, "embedding_cache", EmbeddingCache(max_bytes=1 << 20))
+    return tiny_engine
+
+
+def test_batched_embeddings_match_one_at_a_time(engine, monkeypatch):
+    monkeypatch.setattr(engine.cfg, "embedding_batch_size", 2)  # several buckets, with padding
+    batched, tokens = engine.embed(TEXTS)
+    vectors = _vectors(batched)
+    assert vectors.shape == (len(TEXTS), engine.model.config.hidden_size)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0, atol=1e-5)
+    assert tokens == sum(len(engine.tokenizer(t)["input_ids"]) for t in TEXTS)
+
+    engine.embedding_cache.clear()
+    single = _vectors([engine.embed([t])[0][0] for t in TEXTS])
+    assert np.allclose(vectors, single, atol=1e-5)
+
+
+def test_last_token_pooling(engine):
+    ids = engine.tokenizer(TEXTS[1])["input_ids"]
+    with torch.inference_mode():
+        hidden = engine.model.base_model(input_ids=torch.tensor([ids])).last_hidden_state[0, -1]
+    expected = torch.nn.functional.normalize(hidden, dim=-1).numpy()
+    last = _vectors(engine.embed(TEXTS, pooling="last")[0])
+    assert np.allclose(last[1], expected, atol=1e-5)
+    assert not np.allclose(last, _vectors(engine.embed(TEXTS, pooling="mean")[0]))
+
+
+def test_cached_texts_skip_the_model(engine, monkeypatch):
+    first, tokens = engine.embed(TEXTS)
+    calls = []
+    run = engine.scheduler.run_exclusive
+    monkeypatch.setattr(engine.scheduler, "run_exclusive", lambda fn: calls.append(fn) or run(fn))
+    again, cached_tokens = engine.embed(TEXTS + ["brand new text", "brand new text"])
+    assert again[:len(TEXTS)] == first and cached_tokens > tokens
+    assert again[-1] == again[-2]
+    assert len(calls) == 1 and calls[0].args[1] == [engine.tokenizer("brand new text")["input_ids"]]
+    assert engine.embedding_cache.stats()["hits"] == len(TEXTS)
+
+
+def test_embeddings_api(engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(engine)
+    client = api_server.app.test_client()
+
+    floats = client.post("/v1/embeddings", json={"input": TEXTS}).get_json()
+    assert [d["index"] for d in floats["data"]] == list(range(len(TEXTS)))
+    assert floats["usage"]["prompt_tokens"] > 0
+    b64 = client.post("/v1/embeddings", json={"input": TEXTS[0], "encoding_format": "base64"}).get_json()
+    decoded = np.frombuffer(base64.b64decode(b64["data"][0]["embedding"]), dtype="<f4")
+    assert np.allclose(decoded, floats["data"][0]["embedding"])
+
+    assert client.post("/v1/embeddings", json={"input": []}).status_code == 400
+    assert client.post("/v1/embeddings", json={"input": [""]}).status_code == 400
+    assert client.post("/v1/embeddings", json={"input": "x", "pooling": "max"}).status_code == 400
+    assert client.post("/v1/embeddings", json={"input": "x", "encoding_format": "int8"}).status_code == 400
+
+
+def test_decode_vector_roundtrip():
+    blob = np.array([0.5, -1.25], dtype="<f4").tobytes()
+    assert decode_vector(blob) == [0.5, -1.25]
+    assert base64.b64decode(decode_vector(blob, "base64")) == blob
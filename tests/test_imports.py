@@ -6,3 +6,15 @@ def test_modules_importable():
     import src.llm.worker  # noqa: F401
     import src.ui.main_window  # noqa: F401
     import src.utils.logging  # noqa: F401
+
+
+def test_engine_import_defers_torch():
+    # Servers answer /health while the model loads; importing them must not pay for torch/transformers
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    code = "import sys, src.llm.engine, src.llm.registry; print('torch' in sys.modules, 'transformers' in sys.modules)"
+    root = Path(__file__).resolve().parents[1]
+    out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ["False", "False"]
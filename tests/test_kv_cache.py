@@ -0,0 +1,113 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.llm.kv_cache import ConversationCache, common_prefix_len, kv_nbytes
+from src.llm.prefix_cache import PrefixCache
+from src.llm.scheduler import GenerationRequest
+
+
+def _kv(seq_len, layers=2):
+    return [(torch.zeros(1, 2, seq_len, 4), torch.zeros(1, 2, seq_len, 4)) for _ in range(layers)]
+
+
+def test_common_prefix_len():
+    assert common_prefix_len([1, 2, 3], [1, 2, 4]) == 2
+    assert common_prefix_len([1, 2], [1, 2, 3]) == 2
+    assert common_prefix_len([], [1]) == 0
+
+
+def test_lookup_returns_shared_prefix_only():
+    cache = ConversationCache(max_bytes=1 << 20)
+    cache.store("c", [1, 2, 3, 4], _kv(4))
+    n, kv = cache.lookup("c", [1, 2, 9])
+    assert n == 2
+    assert kv[0][0].shape[2] == 2
+    assert cache.lookup("other", [1, 2, 3]) == (0, [])
+
+
+def test_lru_eviction_by_bytes():
+    entry = kv_nbytes(_kv(4))
+    cache = ConversationCache(max_bytes=2 * entry)
+    cache.store("a", [1, 2, 3, 4], _kv(4))
+    cache.store("b", [1, 2, 3, 4], _kv(4))
+    cache.lookup("a", [1])  # touch a so b is the oldest
+    cache.store("c", [1, 2, 3, 4], _kv(4))
+    assert cache.lookup("b", [1])[0] == 0
+    assert cache.lookup("a", [1])[0] == 1
+    assert cache.nbytes <= 2 * entry
+
+
+def _run(engine, ids, key):
+    req = GenerationRequest(input_ids=ids, max_new_tokens=6, temperature=0.0, top_p=1.0, cache_key=key)
+    return req, list(engine.scheduler.submit(req))
+
+
+def test_second_turn_reuses_cache_with_same_output(tiny_engine):
+    tok = tiny_engine.tokenizer
+    turn1 = tok(tiny_engine._build_prompt("sys", [], "hello world"))["input_ids"]
+    _, reply = _run(tiny_engine, turn1, "conv-1")
+
+    turn2 = tok(tiny_engine._build_prompt("sys", [("hello world", tok.decode(reply))], "the lazy dog"))["input_ids"]
+    cold_req, cold = _run(tiny_engine, turn2, None)
+    warm_req, warm = _run(tiny_engine, turn2, "conv-1")
+
+    assert warm_req.cached_tokens >= len(turn1) - 1
+    assert warm_req.cached_tokens > cold_req.cached_tokens
+    assert warm == cold
+
+
+def _seq_kv(seq_len):
+    # Distinct values per position so concatenated blocks can be checked
+    k = torch.arange(seq_len, dtype=torch.float32).view(1, 1, seq_len, 1).expand(1, 2, seq_len, 4)
+    return [(k.clone(), k.clone() + 100)]
+
+
+def test_prefix_cache_matches_whole_blocks():
+    cache = PrefixCache(max_bytes=1 << 20, block_size=4)
+    cache.insert(list(range(10)), _seq_kv(10))  # two full blocks; the tail is not cached
+    n, kv = cache.match(list(range(8)) + [42, 43])
+    assert n == 8
+    assert kv[0][0][0, 0, :, 0].tolist() == list(range(8))
+    assert cache.match([99, 1, 2, 3])[0] == 0
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["blocks"]) == (1, 1, 2)
+
+
+def test_prefix_cache_evicts_lru_leaves():
+    block = kv_nbytes(_seq_kv(4))
+    cache = PrefixCache(max_bytes=3 * block, block_size=4)
+    cache.insert([0, 0, 0, 0, 1, 1, 1, 1], _seq_kv(8))
+    cache.insert([0, 0, 0, 0, 2, 2, 2, 2], _seq_kv(8))
+    cache.match([0, 0, 0, 0, 1, 1, 1, 1])
+    cache.insert([3, 3, 3, 3], _seq_kv(4))
+    assert cache.match([0, 0, 0, 0, 2, 2, 2, 2])[0] == 4  # leaf evicted, shared parent kept
+    assert cache.match([0, 0, 0, 0, 1, 1, 1, 1])[0] == 8
+
+
+def test_prefix_cache_evicts_parents_once_their_leaves_are_gone():
+    block = kv_nbytes(_seq_kv(4))
+    cache = PrefixCache(max_bytes=3 * block, block_size=4)
+    cache.insert([5] * 4 + [6] * 4 + [7] * 4, _seq_kv(12))  # one chain of three blocks
+    cache.insert([8] * 4, _seq_kv(4))
+    assert cache.stats()["blocks"] == 3  # the chain's leaf went first
+    cache.insert([9] * 8, _seq_kv(8))
+    # Then its parent, now a leaf, and the chain's root block before the newer [8] block
+    assert cache.match([5] * 4 + [6] * 4)[0] == 0
+    assert cache.match([8] * 4)[0] == 4 and cache.match([9] * 8)[0] == 8
+    assert cache.stats()["blocks"] == 3
+
+
+def test_shared_system_prompt_hits_prefix_cache(tiny_engine):
+    tok = tiny_engine.tokenizer
+    system = "you are a helpful assistant. " * 8
+    first = tok(tiny_engine._build_prompt(system, [], "hello world"))["input_ids"]
+    second = tok(tiny_engine._build_prompt(system, [], "the lazy dog"))["input_ids"]
+
+    _, a = _run(tiny_engine, first, None)
+    req, b = _run(tiny_engine, second, None)
+    assert req.cached_tokens >= tiny_engine.prefix_cache.block_size
+
+    tiny_engine.prefix_cache.clear()
+    _, b_cold = _run(tiny_engine, second, None)
+    assert b == b_cold
@@ -0,0 +1,90 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from src.config import Config
+from src.llm.registry import ModelRegistry, UnknownModel
+
+
+@pytest.fixture(scope="module")
+def model_dirs(tmp_path_factory):
+    from benchmarks.tiny_model import build_tiny_model
+
+    return [build_tiny_model(tmp_path_factory.mktemp(f"tiny-{i}"), seed=i) for i in range(3)]
+
+
+def _registry(model_dirs, budget_models: float):
+    cfg = Config(model_id=model_dirs[0], device_map="cpu")
+    registry = ModelRegistry(cfg, allowed=set(model_dirs))
+    lease = registry.acquire(model_dirs[0])
+    lease.release()
+    size = lease.engine.model_bytes
+    registry.max_bytes = int(size * budget_models)
+    return registry
+
+
+def test_loads_on_demand_and_evicts_least_recently_used(model_dirs):
+    registry = _registry(model_dirs, budget_models=2.5)
+    try:
+        a = registry.acquire(model_dirs[0])
+        a.release()
+        b = registry.acquire(model_dirs[1])
+        b.release()
+        assert a.engine.model is not None  # two models fit
+
+        registry.acquire(model_dirs[0]).release()  # touch: model 1 is now least recently used
+        c = registry.acquire(model_dirs[2])
+        c.release()
+
+        loaded = [m["model"] for m in registry.stats()["models"]]
+        assert sorted(loaded) == sorted([model_dirs[0], model_dirs[2]])
+        # Weights released deterministically, not left to the garbage collector
+        assert b.engine.model is None and b.engine.scheduler is None
+        assert registry.stats()["bytes"] <= registry.max_bytes
+    finally:
+        registry.unload_all()
+
+
+def test_leased_model_is_not_evicted(model_dirs):
+    registry = _registry(model_dirs, budget_models=1.5)
+    try:
+        held = registry.acquire(model_dirs[0])
+        other = registry.acquire(model_dirs[1])
+        assert held.engine.model is not None  # over budget, but in use
+        other.release()
+        held.release()
+        # Releasing the last lease brings the set back within budget
+        assert len(registry.stats()["models"]) == 1
+    finally:
+        registry.unload_all()
+
+
+def test_unknown_model_is_rejected(model_dirs):
+    registry = ModelRegistry(Config(model_id=model_dirs[0], device_map="cpu"))
+    with pytest.raises(UnknownModel):
+        registry.acquire("someone/else")
+
+
+def test_api_routes_requests_by_model(tiny_engine, model_dirs, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    api_server.registry.allowed = {model_dirs[1]}
+    client = api_server.app.test_client()
+    try:
+        body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 4, "model": model_dirs[1]}
+        resp = client.post("/v1/chat/completions", json=body)
+        assert resp.status_code == 200
+        assert resp.get_json()["model"] == model_dirs[1]
+
+        listed = {m["id"]: m for m in client.get("/v1/models").get_json()["data"]}
+        assert listed[model_dirs[1]]["loaded"] and listed[model_dirs[1]]["bytes"] > 0
+        assert listed[tiny_engine.cfg.model_id]["loaded"]
+
+        resp = client.post("/v1/chat/completions", json={**body, "model": "nope"})
+        assert resp.status_code == 404
+    finally:
+        api_server.registry.unload_all()
@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("flask")
+
+import api_server
+from src.config import Config
+from src.llm.engine import LLMEngine
+from src.llm.reload import EngineReloader
+
+
+@pytest.fixture(scope="module")
+def other_model_dir(tmp_path_factory):
+    from benchmarks.tiny_model import build_tiny_model
+
+    return build_tiny_model(tmp_path_factory.mktemp("tiny-next"), seed=1)
+
+
+@pytest.fixture
+def client(tiny_model_dir, monkeypatch):
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    monkeypatch.setattr(api_server, "shared", False)
+    monkeypatch.setattr(api_server, "reloader", EngineReloader(lambda new: api_server.set_engine(new, unload_old=True)))
+    owned = LLMEngine(Config(model_id=tiny_model_dir, device_map="cpu", response_cache_mb=0, admin_token="s3cret"))
+    owned.load()
+    api_server.set_engine(owned)
+    yield api_server.app.test_client()
+    api_server.engine.unload()
+    owned.unload()
+
+
+ADMIN = {"Authorization": "Bearer s3cret"}
+
+
+def _wait_for(state: str, timeout: float = 60.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while (status := api_server.reloader.status())["state"] != state:
+        assert status["state"] != "failed", status
+        assert time.monotonic() < deadline, status
+        time.sleep(0.01)
+    return status
+
+
+def test_reload_switches_new_requests_and_drains_old(client, other_model_dir, monkeypatch):
+    old = api_server.engine
+    monkeypatch.setattr(api_server.registry, "allowed", {other_model_dir})
+    lease = api_server.registry.acquire()
+    in_flight = old.generate_stream("sys", [], "hello", max_new_tokens=12, temperature=0, ignore_eos=True)
+    first = next(iter(in_flight))
+
+    resp = client.post("/admin/reload", json={"model": other_model_dir, "precision": "fp32"}, headers=ADMIN)
+    assert resp.status_code == 202
+    assert client.post("/admin/reload", json={}, headers=ADMIN).status_code == 409  # one reload at a time
+    _wait_for("draining")
+
+    # New requests are served by the new model while the old one finishes its generation
+    body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 4}
+    assert client.post("/v1/chat/completions", json=body).get_json()["model"] == other_model_dir
+    assert old.model is not None
+    "".join(in_flight)
+    assert first and in_flight.finish_reason == "length"
+
+    lease.release()
+    status = _wait_for("done")
+    assert status["model"] == other_model_dir and status["load_s"] >= 0
+    assert old.model is None and old.scheduler is None
+    assert [m["model"] for m in client.get("/health").get_json()["models"]["models"]] == [other_model_dir]
+
+
+def test_reload_is_refused_when_not_allowed(client, other_model_dir, monkeypatch):
+    assert client.post("/admin/reload").status_code == 401
+    # A model outside SERVED_MODELS is refused even with the token
+    resp = client.post("/admin/reload", json={"model": other_model_dir}, headers=ADMIN)
+    assert resp.status_code == 404 and "not served" in resp.get_json()["error"]
+
+    monkeypatch.setattr(api_server.config, "admin_token", "")  # no token configured: reloading is off
+    assert client.post("/admin/reload", headers={"Authorization": "Bearer "}).status_code == 403
+    monkeypatch.setattr(api_server.config, "admin_token", "s3cret")
+
+    monkeypatch.setattr(api_server, "shared", True)  # the GUI owns the engine
+    assert client.post("/admin/reload", headers=ADMIN).status_code == 409
+    assert api_server.reloader.status()["state"] == "idle"
+
+
+def test_asgi_reload_needs_a_token_and_a_served_model(tiny_engine, other_model_dir, monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("httpx")
+    from starlette.testclient import TestClient
+
+    import asgi_server
+    from src.llm.registry import ModelRegistry
+
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    client = TestClient(asgi_server.app)
+    assert client.post("/admin/reload", json={"model": other_model_dir}).status_code == 403
+
+    monkeypatch.setattr(tiny_engine.cfg, "admin_token", "s3cret")
+    assert client.post("/admin/reload", json={"model": other_model_dir}).status_code == 401
+    resp = client.post("/admin/reload", json={"model": other_model_dir}, headers=ADMIN)
+    assert resp.status_code == 404 and "not served" in resp.json()["error"]
+    assert asgi_server.reloader.status()["state"] != "loading"
+
+
+def test_gui_reload_swaps_through_the_api_without_cutting_requests(client, other_model_dir, monkeypatch):
+    import dataclasses
+    import os
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    pytest.importorskip("PyQt6.QtWidgets")
+    from PyQt6.QtWidgets import QApplication
+
+    from src.ui import main_window
+
+    app = QApplication.instance() or QApplication([])
+    old = api_server.engine
+    monkeypatch.setattr(main_window.SettingsDialog, "exec", lambda self: True)
+    monkeypatch.setattr(main_window.SettingsDialog, "values", lambda self: (other_model_dir, "fp32"))
+    monkeypatch.setattr(main_window, "save_env", lambda *args: None)
+    win = main_window.MainWindow(
+        dataclasses.replace(old.cfg, chat_db=":memory:"), engine=old,
+        swap=lambda new: api_server.set_engine(new, unload_old=True),
+    )
+
+    lease = api_server.registry.acquire()  # an API request in flight on the current model
+    in_flight = old.generate_stream("sys", [], "hi", max_new_tokens=40, ignore_eos=True)
+    next(in_flight)
+    win.open_settings()
+    deadline = time.monotonic() + 60
+    while api_server.engine is old:
+        assert time.monotonic() < deadline
+        app.processEvents()
+        time.sleep(0.01)
+
+    assert win.engine is api_server.engine and api_server.config.model_id == other_model_dir
+    assert old.cfg.model_id != other_model_dir  # the API's config was not changed under it
+    "".join(in_flight)
+    assert in_flight.finish_reason == "length" and old.model is not None
+    lease.release()
+    assert old.model is None  # drained, then unloaded by the registry
+    win.close()
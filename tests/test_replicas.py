@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from src.config import Config
+from src.llm.engine import create_engine
+from src.llm.replicas import ReplicaEngine
+from src.llm.tracing import Trace
+
+
+@pytest.fixture(scope="module")
+def replica_engine(tiny_model_dir, tmp_path_factory):
+    eng = create_engine(Config(
+        model_id=tiny_model_dir, replicas=2, max_batch_size=4, response_cache_mb=0,
+        weight_cache_dir=str(tmp_path_factory.mktemp("weights")),
+    ))
+    assert isinstance(eng, ReplicaEngine)
+    eng.load()
+    yield eng
+    eng.unload()
+
+
+def _replicas(engine) -> list[dict]:
+    return engine.stats()["replicas"]
+
+
+def test_replicas_share_mapped_weights_and_match_the_in_process_engine(replica_engine, tiny_engine):
+    replicas = _replicas(replica_engine)
+    assert len({r["pid"] for r in replicas} | {os.getpid()}) == 3
+    for r in replicas:
+        # Parameters live in the one safetensors file every replica maps, not in private memory
+        assert r["mapped_weight_bytes"] >= 0.99 * r["model_bytes"]
+    assert replica_engine.model is None and replica_engine.model_bytes == replicas[0]["model_bytes"]
+
+    expected = tiny_engine.generate_stream("sys", [], "hello there", max_new_tokens=12, temperature=0)
+    expected_text = "".join(expected)
+    stream = replica_engine.generate_stream("sys", [], "hello there", max_new_tokens=12, temperature=0)
+    assert "".join(stream) == expected_text
+    assert stream.usage == expected.usage and stream.finish_reason == expected.finish_reason
+
+
+def _wait_idle(engine) -> None:
+    deadline = time.monotonic() + 10
+    while engine.scheduler.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert engine.scheduler.active == 0
+
+
+def test_least_loaded_dispatch(replica_engine):
+    before = [r["served"] for r in _replicas(replica_engine)]
+    streams = [
+        replica_engine.generate_stream("sys", [], f"prompt {i}", max_new_tokens=2000, ignore_eos=True)
+        for i in range(4)
+    ]
+    for s in streams:
+        next(s)  # submitted one by one; each stays in flight
+    assert [r["in_flight"] for r in _replicas(replica_engine)] == [2, 2]
+    assert [r["served"] - b for r, b in zip(_replicas(replica_engine), before)] == [2, 2]
+    for s in streams:
+        s.close()
+    _wait_idle(replica_engine)
+
+
+def test_conversation_sticks_to_its_replica_when_idle(replica_engine):
+    before = [r["served"] for r in _replicas(replica_engine)]
+    for turn in range(3):
+        "".join(replica_engine.generate_stream("sys", [], f"turn {turn}", max_new_tokens=3, conversation_id="conv-1"))
+    served = sorted(r["served"] - b for r, b in zip(_replicas(replica_engine), before))
+    assert served == [0, 3]
+
+
+def test_cancel_reaches_the_replica(replica_engine):
+    stream = replica_engine.generate_stream("sys", [], "long", max_new_tokens=2000, ignore_eos=True)
+    next(stream)
+    stream.close()
+    _wait_idle(replica_engine)
+    assert stream.finish_reason == "cancelled" and stream.usage["completion_tokens"] < 2000
+
+
+def test_cancel_reaches_a_queued_request_before_it_produces_a_token(replica_engine):
+    busy = [
+        replica_engine.generate_stream("sys", [], f"busy {i}", max_new_tokens=2000, ignore_eos=True)
+        for i in range(8)
+    ]
+    for s in busy:
+        next(s)  # every batch slot on both replicas is taken
+    queued = replica_engine.generate_stream("sys", [], "queued", max_new_tokens=2000, ignore_eos=True).start()
+    queued.cancel()
+    for s in busy:
+        s.close()
+    _wait_idle(replica_engine)
+    # The worker dropped it from its queue; without the cancel it would have been prefilled first
+    assert queued.finish_reason == "cancelled" and queued.request.completion_tokens == 0
+    assert queued.request.prefill_started_at is None
+
+
+def test_async_stream_embeddings_and_trace(replica_engine, tiny_engine):
+    async def run():
+        stream = replica_engine.agenerate_stream("sys", [], "hi", max_new_tokens=8, temperature=0)
+        return "".join([chunk async for chunk in stream])
+
+    assert asyncio.run(run()) == "".join(tiny_engine.generate_stream("sys", [], "hi", max_new_tokens=8, temperature=0))
+
+    texts = ["hello world", "a longer piece of text to embed"]
+    vectors, tokens = replica_engine.embed(texts)
+    expected, expected_tokens = tiny_engine.embed(texts)
+    assert tokens == expected_tokens
+    for got, want in zip(vectors, expected):
+        assert np.allclose(np.frombuffer(got, dtype="<f4"), np.frombuffer(want, dtype="<f4"), atol=1e-5)
+
+    trace = Trace()
+    "".join(replica_engine.generate_stream("sys", [], "hi", max_new_tokens=4, trace=trace))
+    events = trace.to_chrome()["traceEvents"]
+    prefill = next(e for e in events if e["name"] == "prefill")
+    assert prefill["pid"] != os.getpid()  # recorded in the replica
+    tokenize = next(e for e in events if e["name"] == "tokenize")
+    assert tokenize["pid"] == os.getpid() and tokenize["ts"] <= prefill["ts"]
+
+
+def test_choices_fork_on_one_replica(replica_engine, tiny_engine):
+    before = [r["served"] for r in _replicas(replica_engine)]
+    choices = replica_engine.generate_choices("sys", [], "hello there", 3, max_new_tokens=10, temperature=0)
+    texts = [""] * 3
+    for index, chunk in choices:
+        texts[index] += chunk
+    expected = "".join(tiny_engine.generate_stream("sys", [], "hello there", max_new_tokens=10, temperature=0))
+    assert texts == [expected] * 3 and choices.finish_reasons == [choices.finish_reason] * 3
+    assert sorted(r["served"] - b for r, b in zip(_replicas(replica_engine), before)) == [0, 1]
+
+
+def test_batch_jobs_spread_over_the_replicas(replica_engine, tiny_engine):
+    before = [r["served"] for r in _replicas(replica_engine)]
+    prompts = [tiny_engine.encode_prompt("sys", [], f"q{i}", 6) for i in range(6)]
+    assert replica_engine.generate_batch(prompts, 6, temperature=0, top_p=1.0) == tiny_engine.generate_batch(
+        prompts, 6, temperature=0, top_p=1.0
+    )
+    assert all(r["served"] > b for r, b in zip(_replicas(replica_engine), before))
+
+
+def test_oversized_grammar_is_rejected_and_the_replicas_survive(replica_engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+    from src.llm.scheduler import GenerationRequest
+
+    big = "(a{1000}|b{1000}){25}"  # parses, but reaches too many states token by token
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(replica_engine)
+    resp = api_server.app.test_client().post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}],
+        "response_format": {"type": "regex", "regex": big},
+    })
+    assert resp.status_code == 400 and "too large" in resp.get_json()["error"]
+
+    # Past the front's check, the replica fails only the request that carried it
+    request = replica_engine.scheduler.submit(GenerationRequest(
+        input_ids=replica_engine.tokenizer.encode("hi"), max_new_tokens=4, temperature=0, top_p=1.0, grammar=big,
+    ))
+    with pytest.raises(RuntimeError, match="GrammarError"):
+        list(request)
+    assert all(r["alive"] for r in _replicas(replica_engine))
+    assert len("".join(replica_engine.generate_stream("sys", [], "hi", max_new_tokens=4, temperature=0))) > 0
@@ -0,0 +1,115 @@
+import json
+import os
+
+import pytest
+
+from src.llm.response_cache import CachedResponse, ResponseCache, response_key
+
+
+def _key(user_msg, **params):
+    return response_key("m", "sys", [], user_msg, max_new_tokens=8, **params)
+
+
+def test_key_depends_on_messages_and_params():
+    assert _key("hi") == _key("hi")
+    assert _key("hi") != _key("hello")
+    assert _key("hi") != _key("hi", ignore_eos=True)
+    assert response_key("m", "sys", [("a", "b")], "hi") == response_key("m", "sys", [["a", "b"]], "hi")
+    assert _key("hi", settings={"precision": "fp32"}) != _key("hi", settings={"precision": "fp16"})
+
+
+def test_engine_keys_and_disk_tier_follow_the_server_settings(tiny_model_dir, tmp_path):
+    from src.config import Config
+    from src.llm.engine import LLMEngine
+
+    def engine(**overrides):
+        return LLMEngine(Config(model_id=tiny_model_dir, response_cache_dir=str(tmp_path), **overrides))
+
+    base = engine()
+    key = base.response_cache_key("sys", [], "hi", temperature=0)
+    assert key == engine().response_cache_key("sys", [], "hi", temperature=0)
+    # Completions made under another precision or context policy are not served after a restart
+    for changed in (
+        engine(precision="cpu-int8"), engine(context_tokens=256),
+        engine(context_policy="summarize"), engine(context_keep_turns=2),
+    ):
+        assert changed.response_cache_key("sys", [], "hi", temperature=0) != key
+    # Each model and precision keeps its own directory, bounded by its own disk budget
+    assert base.response_cache.disk_dir != engine(precision="cpu-int8").response_cache.disk_dir
+    assert os.path.dirname(base.response_cache.disk_dir) == str(tmp_path)
+
+
+def test_memory_tier_lru_by_size():
+    cache = ResponseCache(max_bytes=700)
+    for name in "abc":
+        cache.put(name, CachedResponse(name * 100))
+    assert cache.get("a") is None  # evicted: three entries exceed the budget
+    assert cache.get("c").text == "c" * 100
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["bytes"] <= 700
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    first = ResponseCache(max_bytes=1 << 20, disk_dir=str(tmp_path), disk_max_bytes=1 << 20)
+    first.put("k", CachedResponse("persisted", "length", {"completion_tokens": 3}))
+
+    second = ResponseCache(max_bytes=1 << 20, disk_dir=str(tmp_path), disk_max_bytes=1 << 20)
+    hit = second.get("k")
+    assert (hit.text, hit.finish_reason, hit.usage) == ("persisted", "length", {"completion_tokens": 3})
+    assert second.stats()["disk_hits"] == 1
+    assert second.get("k") is hit  # promoted to memory
+    assert second.stats()["hits"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    size = len(json.dumps({"text": "x" * 100, "finish_reason": "stop", "usage": {}}))
+    cache = ResponseCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=2 * size)
+    cache.put("a", CachedResponse("x" * 100))
+    cache.put("b", CachedResponse("y" * 100))
+    os.utime(tmp_path / "a.json", (1, 1))
+    os.utime(tmp_path / "b.json", (2, 2))
+    cache.put("c", CachedResponse("z" * 100))
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+    assert cache.stats()["disk_bytes"] == 2 * size
+
+
+@pytest.fixture
+def api_client(tiny_engine, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    tiny_engine.response_cache.clear()
+    yield api_server.app.test_client()
+    tiny_engine.response_cache.clear()
+
+
+def _body(**extra):
+    return {"messages": [{"role": "user", "content": "memoize me"}], "max_tokens": 6, "temperature": 0, **extra}
+
+
+def test_identical_deterministic_requests_hit_cache(api_client, tiny_engine):
+    hits = tiny_engine.response_cache.stats()["hits"]
+    first = api_client.post("/v1/chat/completions", json=_body()).get_json()
+    second = api_client.post("/v1/chat/completions", json=_body()).get_json()
+    assert second["choices"][0]["message"] == first["choices"][0]["message"]
+    assert second["usage"] == first["usage"]
+    assert tiny_engine.response_cache.stats()["hits"] == hits + 1
+
+    resp = api_client.post("/v1/chat/completions", json=_body(stream=True))
+    events = [e[len("data: "):] for e in resp.get_data(as_text=True).split("\n\n") if e]
+    text = "".join(json.loads(e)["choices"][0]["delta"].get("content", "") for e in events[:-1])
+    assert text == first["choices"][0]["message"]["content"]
+    assert tiny_engine.response_cache.stats()["hits"] == hits + 2
+
+
+def test_sampled_requests_are_not_cached(api_client, tiny_engine):
+    before = tiny_engine.response_cache.stats()
+    api_client.post("/v1/chat/completions", json=_body(temperature=0.7))
+    api_client.post("/v1/chat/completions", json=_body(temperature=0.7))
+    after = tiny_engine.response_cache.stats()
+    assert after["entries"] == 0
+    assert (after["hits"], after["misses"]) == (before["hits"], before["misses"])
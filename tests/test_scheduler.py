@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.llm.scheduler import CancelToken, GenerationRequest
+
+
+@pytest.fixture
+def engine(tiny_engine):
+    return tiny_engine
+
+
+PROMPTS = ["hello world", "the quick brown fox jumps over", "café", "how are you today? the lazy dog"]
+
+
+def _greedy(engine, prompt, max_new_tokens=12):
+    ids = engine.tokenizer(prompt)["input_ids"]
+    req = GenerationRequest(input_ids=ids, max_new_tokens=max_new_tokens, temperature=0.0, top_p=1.0)
+    return list(engine.scheduler.submit(req))
+
+
+def test_scheduler_matches_generate(engine):
+    ids = engine.tokenizer(PROMPTS[1], return_tensors="pt")["input_ids"]
+    ref = engine.model.generate(ids, max_new_tokens=12, do_sample=False)[0, ids.shape[1]:].tolist()
+    eos = engine.tokenizer.eos_token_id
+    if eos in ref:
+        ref = ref[:ref.index(eos)]
+    assert _greedy(engine, PROMPTS[1]) == ref
+
+
+def test_concurrent_requests_match_solo_runs(engine):
+    solo = [_greedy(engine, p) for p in PROMPTS]
+
+    results = [None] * len(PROMPTS)
+
+    def worker(i):
+        results[i] = _greedy(engine, PROMPTS[i])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(PROMPTS))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+
+    assert results == solo
+
+
+def test_generate_stream_yields_text(engine):
+    text = "".join(engine.generate_stream("sys", [], "hi", max_new_tokens=8, temperature=0.7))
+    assert isinstance(text, str)
+
+
+def _wait_idle(scheduler, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while scheduler.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return scheduler.active == 0
+
+
+def test_cancel_stops_request_within_a_step(engine):
+    ids = engine.tokenizer(PROMPTS[0])["input_ids"]
+    req = engine.scheduler.submit(GenerationRequest(
+        input_ids=ids, max_new_tokens=10_000, temperature=0.0, top_p=1.0, ignore_eos=True
+    ))
+    received = []
+    for token in req:
+        received.append(token)
+        if len(received) == 3:
+            req.cancel()
+    assert req.finish_reason == "cancelled"
+    assert len(received) < 10_000
+    assert _wait_idle(engine.scheduler)
+
+
+def test_cancel_token_runs_callbacks_once_when_set():
+    token, calls = CancelToken(), []
+    token.on_cancel(lambda: calls.append("early"))
+    assert calls == []
+    token.set()
+    token.set()
+    token.on_cancel(lambda: calls.append("late"))  # already set: runs right away
+    assert calls == ["early", "late"] and token.is_set()
+
+
+def test_closing_stream_cancels_generation(engine):
+    stream = engine.generate_stream("sys", [], "hi", max_new_tokens=1_500, temperature=0, ignore_eos=True)
+    next(stream)  # the first chunk can arrive before the request has joined the batch
+    stream.close()
+    deadline = time.monotonic() + 5
+    while stream.finish_reason is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _wait_idle(engine.scheduler)
+    assert stream.finish_reason == "cancelled"
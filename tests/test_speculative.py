@@ -0,0 +1,97 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.config import Config
+from src.llm.engine import LLMEngine
+from src.llm.scheduler import BatchScheduler, GenerationRequest
+from src.llm.speculative import SpeculativeScheduler
+
+PROMPTS = ["hello world", "the quick brown fox jumps over", "how are you today? the lazy dog"]
+
+
+@pytest.fixture(scope="module")
+def draft_model_dir(tmp_path_factory):
+    from benchmarks.tiny_model import build_tiny_model
+
+    # Same tokenizer (deterministic BPE training), different random weights
+    return build_tiny_model(tmp_path_factory.mktemp("tiny-draft"), seed=1)
+
+
+def _run(scheduler, tokenizer, prompt, temperature=0.0, max_new_tokens=16):
+    ids = tokenizer(prompt)["input_ids"]
+    req = GenerationRequest(input_ids=ids, max_new_tokens=max_new_tokens, temperature=temperature,
+                            top_p=1.0, ignore_eos=True)
+    return list(scheduler.submit(req))
+
+
+def _scheduler(tiny_engine, draft):
+    scheduler = SpeculativeScheduler(tiny_engine.model, tiny_engine.tokenizer, draft, num_speculative_tokens=3)
+    scheduler.start()
+    return scheduler
+
+
+def test_greedy_output_matches_plain_decoding(tiny_engine, draft_model_dir):
+    from transformers import AutoModelForCausalLM
+
+    draft = AutoModelForCausalLM.from_pretrained(draft_model_dir).eval()
+    plain = BatchScheduler(tiny_engine.model, tiny_engine.tokenizer)
+    plain.start()
+    spec = _scheduler(tiny_engine, draft)
+    try:
+        for prompt in PROMPTS:
+            assert _run(spec, tiny_engine.tokenizer, prompt) == _run(plain, tiny_engine.tokenizer, prompt)
+        assert spec.proposed > 0
+    finally:
+        plain.stop()
+        spec.stop()
+
+
+def test_concurrent_sequences_decode_batched_then_speculate_alone(tiny_engine, draft_model_dir):
+    from transformers import AutoModelForCausalLM
+
+    draft = AutoModelForCausalLM.from_pretrained(draft_model_dir).eval()
+    plain = BatchScheduler(tiny_engine.model, tiny_engine.tokenizer)
+    plain.start()
+    spec = _scheduler(tiny_engine, draft)
+    try:
+        lengths = [6, 12, 24]
+        requests = [
+            spec.submit(GenerationRequest(input_ids=tiny_engine.tokenizer(p)["input_ids"], max_new_tokens=n,
+                                          temperature=0.0, top_p=1.0, ignore_eos=True))
+            for p, n in zip(PROMPTS, lengths)
+        ]
+        outputs = [list(r) for r in requests]
+        for prompt, n, out in zip(PROMPTS, lengths, outputs):
+            assert out == _run(plain, tiny_engine.tokenizer, prompt, max_new_tokens=n)
+        # One batched pass per token while several run; the last one speculates once it is alone
+        stats = spec.stats()
+        assert 0 < stats["batched_steps"] <= lengths[0] + lengths[1] and stats["draft_tokens_proposed"] > 0
+    finally:
+        plain.stop()
+        spec.stop()
+
+
+def test_identical_draft_is_always_accepted(tiny_engine):
+    spec = _scheduler(tiny_engine, tiny_engine.model)
+    try:
+        out = _run(spec, tiny_engine.tokenizer, PROMPTS[1], max_new_tokens=13)
+        assert len(out) == 13
+        assert spec.stats()["acceptance_rate"] == 1.0
+        # Sampled requests stop at the length limit too
+        assert len(_run(spec, tiny_engine.tokenizer, PROMPTS[0], temperature=0.8)) == 16
+    finally:
+        spec.stop()
+
+
+def test_engine_loads_draft_model(tiny_model_dir, draft_model_dir):
+    engine = LLMEngine(Config(model_id=tiny_model_dir, draft_model_id=draft_model_dir, device_map="cpu"))
+    engine.load()
+    try:
+        assert isinstance(engine.scheduler, SpeculativeScheduler)
+        stream = engine.generate_stream("sys", [], "hello", max_new_tokens=8, temperature=0)
+        "".join(stream)
+        assert engine.stats()["speculative"]["draft_tokens_proposed"] > 0
+        assert "llm_speculative_acceptance_rate" in engine.metrics_gauges()
+    finally:
+        engine.scheduler.stop()
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt6.QtWidgets")
+
+from PyQt6.QtWidgets import QApplication
+
+from src.ui.stream_renderer import StreamRenderer
+
+
+@pytest.fixture(scope="module")
+def qapp():
+    return QApplication.instance() or QApplication([])
+
+
+def test_tokens_are_coalesced_per_frame(qapp):
+    frames = []
+    renderer = StreamRenderer(frames.append, interval_ms=1000)
+    for _ in range(500):
+        renderer.push("tok ")
+    assert frames == []  # nothing rendered until the frame timer fires
+    renderer.flush()
+    assert frames == ["tok " * 500]
+    renderer.flush()
+    assert len(frames) == 1
+
+
+def test_per_token_ui_cost_is_constant(qapp, tiny_engine):
+    from src.config import Config
+    from src.ui.main_window import MainWindow
+    from src.ui.transcript import DocumentRole
+
+    cfg = Config(model_id=tiny_engine.cfg.model_id, device_map="cpu", chat_db=":memory:")
+    win = MainWindow(cfg, engine=tiny_engine)
+    win.begin_reply()
+    reply = win.transcript.index(win.transcript.rowCount() - 1)
+    edits = []
+
+    frame, frames = "word " * 10, 400
+    for i in range(frames):
+        for token in frame.split(" ")[:-1]:
+            win.on_token(token + " ")
+        edits.clear()
+        win._renderer.flush()  # one frame
+        if i == 0:
+            # The first text replaces the "Thinking" placeholder; from then on the document is appended to
+            doc = reply.data(DocumentRole)  # laid out once, as when the row is first painted
+            doc.contentsChange.connect(lambda pos, removed, added: edits.append((removed, added)))
+            continue
+        # Each frame only inserts what arrived since the last one, however long the reply already is
+        assert edits == [(0, len(frame))]
+
+    assert reply.data() == "Assistant: " + frame * frames
+    win.close()
@@ -0,0 +1,130 @@
+import json
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from transformers import AutoTokenizer, TextIteratorStreamer
+
+from src.llm.streamer import IncrementalDetokenizer
+
+CORPUS = [
+    "Hello world! This is a test.",
+    "naïve café — déjà vu",
+    "emoji 🎉🚀 and CJK 漢字かな",
+    "line one\nline two\n\nline four",
+    "tabs\tand  double  spaces",
+    "math: 3.14 * (2 + 2) = 12.56",
+    "  leading and trailing  ",
+    "Привет, мир",
+]
+
+
+def _sentencepiece_tokenizer():
+    """A small Llama-style tokenizer: "▁" word prefixes, byte fallback, leading space stripped on decode"""
+    from tokenizers import Tokenizer, decoders, models, normalizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE(byte_fallback=True, unk_token="<unk>"))
+    tok.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    tok.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0),
+    ])
+    tok.train_from_iterator(CORPUS * 20, trainers.BpeTrainer(vocab_size=400, special_tokens=["<unk>", "<s>", "</s>"]))
+    # Byte tokens are ordinary vocabulary entries, as in Llama's tokenizer
+    spec = json.loads(tok.to_str())
+    vocab = spec["model"]["vocab"]
+    for b in range(256):
+        vocab.setdefault(f"<0x{b:02X}>", len(vocab))
+    tok = Tokenizer.from_str(json.dumps(spec))
+    return PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+
+
+@pytest.fixture(scope="module")
+def tokenizers(tiny_model_dir):
+    return [AutoTokenizer.from_pretrained(tiny_model_dir), _sentencepiece_tokenizer()]
+
+
+def _reference(tokenizer, ids: list[int]) -> str:
+    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    for token_id in ids:
+        streamer.put(torch.tensor([token_id]))
+    streamer.end()
+    return "".join(streamer)
+
+
+def _stream(tokenizer, ids: list[int], **kwargs) -> list[str]:
+    detokenizer = IncrementalDetokenizer(tokenizer, **kwargs)
+    chunks = []
+    for token_id in ids:
+        detokenizer.put_token(token_id)
+        chunks += detokenizer.drain()
+    detokenizer.end()
+    return chunks + detokenizer.drain()
+
+
+def test_matches_text_iterator_streamer_on_golden_corpus(tokenizers):
+    for tokenizer in tokenizers:
+        for text in CORPUS:
+            ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+            assert "".join(_stream(tokenizer, ids)) == _reference(tokenizer, ids) == tokenizer.decode(ids)
+
+
+def test_matches_full_decode_of_arbitrary_tokens(tokenizers):
+    # Split multi-byte characters, invalid UTF-8, byte-fallback runs, special tokens in between
+    rng = random.Random(0)
+    for tokenizer in tokenizers:
+        for _ in range(300):
+            ids = [rng.randrange(len(tokenizer)) for _ in range(rng.randrange(1, 40))]
+            assert "".join(_stream(tokenizer, ids, every_tokens=3)) == tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def test_keeps_the_space_textstreamer_drops_after_a_line_break(tokenizers):
+    sp = tokenizers[1]
+    ids = sp("one\n  two", add_special_tokens=False)["input_ids"]
+    # TextStreamer restarts decoding after "\n", so the Strip decoder eats the next token's space
+    assert _reference(sp, ids) == "one\n two"
+    assert "".join(_stream(sp, ids)) == "one\n  two"
+
+
+def test_split_characters_are_held_until_complete(tokenizers):
+    tiny, sp = tokenizers
+    # Byte-level BPE: "�" until the character's last byte arrives
+    detokenizer = IncrementalDetokenizer(tiny)
+    tokens = tiny.convert_ids_to_tokens(tiny("é🎉", add_special_tokens=False)["input_ids"])
+    byte_ids = tiny.convert_tokens_to_ids(list("".join(tokens)))  # one base token per byte
+    for token_id in byte_ids[:-1]:
+        detokenizer.put_token(token_id)
+    assert "".join(detokenizer.drain()) == "é"
+    detokenizer.put_token(byte_ids[-1])
+    assert detokenizer.drain() == ["🎉"]
+
+    # Byte fallback: a run of byte tokens decodes as a whole, so it waits for the next regular token
+    detokenizer = IncrementalDetokenizer(sp)
+    for token_id in sp.convert_tokens_to_ids([f"<0x{b:02X}>" for b in "🎉".encode()]):
+        detokenizer.put_token(token_id)
+        assert detokenizer.drain() == []
+    detokenizer.put_token(sp.convert_tokens_to_ids("!"))
+    assert detokenizer.drain() == ["🎉!"]
+
+
+def test_chunks_are_batched_by_tokens_or_time(tokenizers, monkeypatch):
+    tiny = tokenizers[0]
+    ids = tiny(" ".join(["word"] * 40), add_special_tokens=False)["input_ids"]
+    assert len(_stream(tiny, ids)) == len(ids)
+    batched = _stream(tiny, ids, every_tokens=8)
+    assert len(batched) == -(-len(ids) // 8) and "".join(batched) == tiny.decode(ids)
+
+    clock = iter(range(0, 10_000, 10))  # 10 ms per reading
+    monkeypatch.setattr("src.llm.streamer.time.perf_counter", lambda: next(clock) / 1000)
+    timed = _stream(tiny, ids, every_tokens=1000, every_ms=25)
+    assert 1 < len(timed) < len(ids) and "".join(timed) == tiny.decode(ids)
+
+
+def test_engine_streams_through_batched_detokenizer(tiny_engine, monkeypatch):
+    expected = "".join(tiny_engine.generate_stream("sys", [], "hello", max_new_tokens=20, temperature=0))
+    monkeypatch.setattr(tiny_engine.cfg, "stream_chunk_tokens", 5)
+    chunks = list(tiny_engine.generate_stream("sys", [], "hello", max_new_tokens=20, temperature=0))
+    assert "".join(chunks) == expected and len(chunks) <= 20 // 5 + 1  # + text held back until end()
@@ -0,0 +1,108 @@
+import dataclasses
+import json
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+
+from src.llm.tracing import Trace, trace_requested
+
+
+def _names(chrome: dict) -> list[str]:
+    return [e["name"] for e in chrome["traceEvents"] if e["ph"] == "X"]
+
+
+def test_engine_records_every_stage(tiny_engine):
+    trace = Trace()
+    stream = tiny_engine.generate_stream("sys", [], "hello", max_new_tokens=5, temperature=0, ignore_eos=True,
+                                         trace=trace)
+    "".join(stream)
+    chrome = json.loads(json.dumps(trace.to_chrome()))  # plain JSON, as Perfetto loads it
+    names = _names(chrome)
+    for stage in ("context_fit", "template", "tokenize", "queue_wait", "to_device", "prefill", "generate"):
+        assert names.count(stage) == 1, stage
+    assert names.count("decode_step") == 4  # the first token comes from prefill
+    assert names.count("handoff") == names.count("detokenize") == 5
+
+    threads = {e["tid"]: e["args"]["name"] for e in chrome["traceEvents"] if e["ph"] == "M"}
+    prefill = next(e for e in chrome["traceEvents"] if e["name"] == "prefill")
+    assert threads[prefill["tid"]] == "llm-scheduler"
+    generate = next(e for e in chrome["traceEvents"] if e["name"] == "generate")
+    assert generate["args"]["completion_tokens"] == 5
+    assert all(e["ts"] >= 0 and e["dur"] >= 0 for e in chrome["traceEvents"] if e["ph"] == "X")
+
+
+def test_untraced_requests_record_nothing(tiny_engine):
+    stream = tiny_engine.generate_stream("sys", [], "hello", max_new_tokens=3, temperature=0)
+    "".join(stream)
+    assert stream.request.trace is None and stream.request.emitted_at == []
+
+
+def test_sampling_profiler_builds_a_flame_chart_of_the_decode_loop(tiny_engine):
+    trace = Trace(profile_interval_s=0.0005)
+    stream = tiny_engine.generate_stream("sys", [], "hello", max_new_tokens=200, temperature=0, ignore_eos=True,
+                                         trace=trace)
+    "".join(stream)
+    profiler_tid = tiny_engine.scheduler.thread.ident + 1
+    frames = [e for e in trace.to_chrome()["traceEvents"] if e["tid"] == profiler_tid and e["ph"] == "X"]
+    assert any(e["name"].startswith("_run (scheduler.py") for e in frames)
+    # Spans on the track nest: each one lies inside or after every one that started before it
+    ends = []
+    for e in sorted(frames, key=lambda e: (e["ts"], -e["dur"])):
+        while ends and ends[-1] <= e["ts"] + 1e-3:
+            ends.pop()
+        assert not ends or e["ts"] + e["dur"] <= ends[-1] + 1e-3
+        ends.append(e["ts"] + e["dur"])
+
+
+def test_trace_requested():
+    assert trace_requested(None, "", 2) is None
+    assert trace_requested("0", "1", 2) is None  # the header overrides TRACE
+    assert trace_requested(None, "1", 2).profile_interval_s == 0
+    assert trace_requested("profile", "", 2).profile_interval_s == 0.002
+
+
+def test_flask_trace_header_and_export(tiny_engine, tmp_path, monkeypatch):
+    pytest.importorskip("flask")
+    import api_server
+
+    for name in ("engine", "config", "registry"):
+        monkeypatch.setattr(api_server, name, None)
+    api_server.set_engine(tiny_engine)
+    monkeypatch.setattr(api_server, "config", dataclasses.replace(tiny_engine.cfg, trace_dir=str(tmp_path)))
+    client = api_server.app.test_client()
+    body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 4, "temperature": 0.5}
+
+    assert "X-Trace-Id" not in client.post("/v1/chat/completions", json=body).headers
+    resp = client.post("/v1/chat/completions", json=body, headers={"X-Trace": "1"})
+    trace_id = resp.headers["X-Trace-Id"]
+    chrome = client.get(f"/debug/traces/{trace_id}").get_json()
+    assert {"request", "acquire_model", "tokenize", "prefill", "serialize"} <= set(_names(chrome))
+    with open(os.path.join(tmp_path, f"trace-{trace_id}.json"), encoding="utf-8") as f:
+        assert json.load(f)["otherData"]["trace_id"] == trace_id
+
+    streamed = client.post("/v1/chat/completions", json={**body, "stream": True}, headers={"X-Trace": "1"})
+    assert streamed.get_data(as_text=True).endswith("data: [DONE]\n\n")
+    assert "request" in _names(client.get(f"/debug/traces/{streamed.headers['X-Trace-Id']}").get_json())
+    assert client.get("/debug/traces").get_json()["traces"][-2:] == [trace_id, streamed.headers["X-Trace-Id"]]
+
+
+def test_asgi_streaming_trace(tiny_engine, monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("httpx")
+    from starlette.testclient import TestClient
+
+    import asgi_server
+    from src.llm.registry import ModelRegistry
+
+    monkeypatch.setattr(asgi_server, "engine", tiny_engine)
+    monkeypatch.setattr(asgi_server, "config", tiny_engine.cfg)
+    monkeypatch.setattr(asgi_server, "registry", ModelRegistry(tiny_engine.cfg))
+    asgi_server.registry.add(tiny_engine, pinned=True)
+    client = TestClient(asgi_server.app)
+    body = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 4, "temperature": 0.5, "stream": True}
+
+    resp = client.post("/v1/chat/completions", json=body, headers={"X-Trace": "1"})
+    chrome = client.get(f"/debug/traces/{resp.headers['X-Trace-Id']}").json()
+    assert {"request", "admission", "prefill", "handoff"} <= set(_names(chrome))
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt6.QtWidgets")
+
+from PyQt6.QtWidgets import QApplication
+
+from src.ui.conversation_store import ConversationStore
+from src.ui.transcript import TranscriptModel
+
+
+@pytest.fixture(scope="module")
+def qapp():
+    return QApplication.instance() or QApplication([])
+
+
+def _texts(model):
+    return [model.index(row).data() for row in range(model.rowCount())]
+
+
+def test_store_pages_and_rebuilds_turns(tmp_path):
+    store = ConversationStore(str(tmp_path / "chat.sqlite3"))
+    for i in range(5):
+        store.append("c", "user", f"q{i}")
+        store.append("c", "assistant", f"a{i}")
+    store.append("other", "user", "elsewhere")
+
+    latest = store.page("c", limit=4)
+    assert [m.content for m in latest] == ["q3", "a3", "q4", "a4"]
+    assert [m.content for m in store.page("c", before_id=latest[0].id, limit=2)] == ["q2", "a2"]
+    assert store.turns("c")[-1] == ("q4", "a4") and len(store.turns("c")) == 5
+    assert store.turns("c", limit=2) == [("q3", "a3"), ("q4", "a4")] and store.turns("c", limit=0) == []
+    assert [m.content for m in store.page("c", after_id=latest[0].id, limit=2)] == ["a3", "q4"]
+    store.close()
+
+    reopened = ConversationStore(str(tmp_path / "chat.sqlite3"))
+    assert reopened.count("c") == 10
+
+
+def test_loaded_rows_stay_bounded_and_older_pages_load_on_demand(qapp):
+    store = ConversationStore(":memory:")
+    model = TranscriptModel(store, "c", page_size=20, max_rows=50)
+    for i in range(1000):
+        model.add_message("user", f"m{i}")
+    assert store.count("c") == 1000
+    assert model.rowCount() == 50  # memory stays flat however long the conversation runs
+    assert _texts(model)[-1] == "You: m999"
+
+    assert model.has_older
+    assert model.load_older() == 20
+    assert _texts(model)[:2] == ["You: m930", "You: m931"]
+
+    # Scrolling up drops the newest rows; scrolling back down pages them in and drops the oldest
+    while model.has_older:
+        model.load_older()
+        assert model.rowCount() <= 50
+    assert _texts(model)[0] == "You: m0" and model.has_newer
+    while model.has_newer:
+        model.load_newer()
+        assert model.rowCount() <= 50
+    assert _texts(model)[-1] == "You: m999" and model.has_older
+
+    # A fresh view of the same conversation starts from the latest page
+    reopened = TranscriptModel(store, "c", page_size=20)
+    assert _texts(reopened)[-1] == "You: m999" and reopened.rowCount() == 20
+
+
+def test_streamed_reply_is_persisted_when_finished(qapp):
+    store = ConversationStore(":memory:")
+    model = TranscriptModel(store, "c")
+    model.add_message("user", "hi")
+    reply = model.add_message("assistant", status="Thinking")
+    assert _texts(model)[-1] == "Assistant: Thinking"
+    for token in ["Hel", "lo", "!"]:
+        model.append_text(reply, token)
+    assert model.finish(reply) == "Hello!"
+    assert store.turns("c") == [("hi", "Hello!")]
+
+
+def test_reply_streams_while_paged_out_and_sending_returns_to_the_end(qapp):
+    store = ConversationStore(":memory:")
+    model = TranscriptModel(store, "c", page_size=10, max_rows=20)
+    for i in range(100):
+        model.add_message("user", f"m{i}")
+    reply = model.add_message("assistant", status="Thinking")
+    for _ in range(5):
+        model.load_older()
+    assert "Assistant: Thinking" not in _texts(model)
+    model.append_text(reply, "still ")
+    model.append_text(reply, "here")
+    while model.load_newer():
+        pass
+    assert _texts(model)[-1] == "Assistant: still here"
+    assert model.finish(reply) == "still here" and store.page("c", limit=1)[0].content == "still here"
+
+    model.load_older()
+    model.load_older()
+    model.add_message("user", "back")
+    assert not model.has_newer and _texts(model)[-2:] == ["Assistant: still here", "You: back"]